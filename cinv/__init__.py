@@ -25,7 +25,6 @@ VERSION="2.0"
 import logging
 import os.path
 import cinv
-import subprocess
 
 #from cinv.netipv4 import NetIPv4
 #from cinv.host import Host
@@ -47,28 +46,40 @@ def get_base_dir(area):
 
     return base_dir
 
-def backend_exec(area, command, args, missing_ok=True):
-    command = os.path.join(get_base_dir("backend"), area, command)
-    db_path = os.path.join(get_base_dir("db"), area)
+def get_config(name, default=None):
+    """Return setting from $CINV_<NAME> or ~/.cinv/config/<name>"""
+    env_name = ("CINV_%s" % name.upper()).replace("-", "_")
+    if env_name in os.environ:
+        return os.environ[env_name]
 
-    env = os.environ.copy()
-    env_name = ('__cinv_db_%s' % area).replace("-","_")
-    env[env_name] = db_path
+    try:
+        with open(os.path.join(get_base_dir("config"), name), "r") as fd:
+            return fd.read().strip()
+    except EnvironmentError:
+        return default
 
-    subprocess_args = [ command ]
-    subprocess_args.extend(args)
+def backend_exec(area, command, args, missing_ok=True, defer=False):
+    """Execute backend command of area
 
+    Within a cinv.backend.session() the command runs in the background
+    (or at the end of the session, if deferred), else synchronously.
+    If the area has a coprocess, the command is passed to it instead.
+    """
+    import cinv.backend
 
-    log.debug("Exec %s=%s %s %s" % (env_name, env[env_name], 
-        command, " ".join(args)))
+    path = os.path.join(get_base_dir("backend"), area, command)
 
     log.debug("%s" % args)
 
-    if not os.path.exists(command):
+    if not cinv.backend.exists(area, command):
         if missing_ok:
-            log.debug("%s ignores missing backend command: %s" % (area, command))
+            log.debug("%s ignores missing backend command: %s" % (area, path))
             return True
         else:
-            raise Error("%s misses backend command: %s" % (area, command))
+            raise Error("%s misses backend command: %s" % (area, path))
 
-    return subprocess.call(subprocess_args, env=env)
+    executor = cinv.backend.get_executor()
+    if executor:
+        return executor.submit(area, command, args, defer=defer)
+
+    return cinv.backend.Hook(area, command, args).run()
@@ -0,0 +1,598 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2012-2014 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+"""Execution of backend commands
+
+A backend command is an executable ~/.cinv/backend/<area>/<command>,
+called with the arguments of the event.
+
+Alternatively an area may provide a long running backend,
+~/.cinv/backend/<area>/coprocess. It is started once per session and
+receives one JSON object per event on stdin:
+
+    {"id": 1, "command": "del", "args": ["host.example.org"]}
+
+and acknowledges every event with one line on stdout:
+
+    {"id": 1, "status": 0, "message": "optional text"}
+
+A status other than 0 marks the event as failed. At the end of the
+session stdin is closed and the backend is expected to exit.
+
+Backend commands receiving many targets (apply) get them as arguments,
+one per line on stdin or in a file named by $__cinv_targets_file,
+depending on $__cinv_targets_via (args, stdin or file).
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import os
+import os.path
+import select
+import sys
+import time
+
+import cinv
+
+log = logging.getLogger(__name__)
+
+# Interval used to check running hooks
+POLL_INTERVAL = 0.01
+
+# Time a coprocess may take to exit after stdin was closed
+COPROCESS_STOP_TIMEOUT = 5
+
+# How targets are passed to backend commands
+TARGETS_VIA = ["args", "stdin", "file"]
+
+class Error(cinv.Error):
+    pass
+
+def get_timeout(area, command):
+    """Return timeout in seconds of a backend command or None
+
+    Set per command (f.i. ~/.cinv/config/backend-timeout-host-del)
+    or for all commands (~/.cinv/config/backend-timeout).
+    """
+    timeout = cinv.get_config("backend-timeout-%s-%s" % (area, command),
+        cinv.get_config("backend-timeout"))
+    if not timeout:
+        return None
+
+    try:
+        return float(timeout)
+    except ValueError as e:
+        raise Error("Invalid backend timeout for %s %s: %s" % (area,
+            command, e))
+
+def get_env(area):
+    """Return environment of backends with the database path of area"""
+    env = os.environ.copy()
+    env_name = ('__cinv_db_%s' % area).replace("-","_")
+    env[env_name] = os.path.join(cinv.get_base_dir("db"), area)
+    return env
+
+def exists(area, command):
+    """Check whether area has a backend for command"""
+    return (Coprocess.exists(area) or
+        os.path.exists(os.path.join(cinv.get_base_dir("backend"), area, command)))
+
+class Hook(object):
+    """One execution of a backend command"""
+
+    def __init__(self, area, command, args, via="args", label=None,
+            jobs=None):
+        if via not in TARGETS_VIA:
+            raise Error("Targets can be passed via %s" % " ".join(TARGETS_VIA))
+
+        self.area = area
+        self.command = command
+        self.args = list(args)
+        self.via = via
+        self.label = label
+        self.jobs = jobs
+        self.timeout = get_timeout(area, command)
+
+        self.path = os.path.join(cinv.get_base_dir("backend"), area, command)
+
+        self.process = None
+        self.deadline = None
+        self.returncode = None
+        self.timed_out = False
+        self.message = None
+        self.targets_file = None
+        self.started = None
+        self.duration = None
+
+    @property
+    def key(self):
+        return (self.area, self.command, tuple(self.args), self.via)
+
+    @property
+    def object_key(self):
+        """Hooks with the same key run one after the other, in order"""
+        return (self.area, self.args[0] if self.args else None)
+
+    def __str__(self):
+        if self.label:
+            return " ".join([self.area, self.command, self.label])
+        return " ".join([self.area, self.command] + self.args)
+
+    def popen(self):
+        # Imported on demand, as most commands never execute a backend
+        import subprocess
+        import tempfile
+
+        env = get_env(self.area)
+        argv = [self.path]
+        stdin = None
+
+        if self.via == "args":
+            argv.extend(self.args)
+        else:
+            # A file instead of a pipe: the backend reads at its own pace
+            self.targets_file = tempfile.NamedTemporaryFile("w+",
+                prefix="cinv-targets-")
+            self.targets_file.write("".join([arg + "\n" for arg in self.args]))
+            self.targets_file.flush()
+            self.targets_file.seek(0)
+
+            env["__cinv_targets_via"] = self.via
+            if self.via == "stdin":
+                stdin = self.targets_file
+            else:
+                env["__cinv_targets_file"] = self.targets_file.name
+
+        log.debug("Exec %s (%d targets via %s)" % (self.path, len(self.args),
+            self.via))
+
+        try:
+            self.process = subprocess.Popen(argv, env=env, stdin=stdin)
+        except OSError as e:
+            self.cleanup()
+            raise Error("Cannot execute backend %s: %s" % (self.path, e))
+
+        self.started = time.monotonic()
+        if self.timeout:
+            self.deadline = time.monotonic() + self.timeout
+
+    def poll(self):
+        """Return True if the hook finished (or was killed)"""
+        returncode = self.process.poll()
+
+        if returncode is None and self.deadline and time.monotonic() > self.deadline:
+            log.debug("Killing %s after %ss" % (self, self.timeout))
+            self.timed_out = True
+            self.process.kill()
+            returncode = self.process.wait()
+
+        self.returncode = returncode
+        if returncode is None:
+            return False
+
+        self.duration = time.monotonic() - self.started
+        self.cleanup()
+        return True
+
+    def cleanup(self):
+        if self.targets_file:
+            self.targets_file.close()
+            self.targets_file = None
+
+    @property
+    def failed(self):
+        return self.timed_out or self.returncode != 0
+
+    def status(self):
+        if self.timed_out:
+            return "timed out after %ss" % self.timeout
+
+        status = "exit code %d" % self.returncode
+        if self.message:
+            status += " (%s)" % self.message
+        return status
+
+    def send(self, coprocess):
+        """Pass hook to coprocess, see Coprocess.send()"""
+        started = time.monotonic()
+        if not coprocess.send(self):
+            return False
+
+        self.duration = time.monotonic() - started
+        return True
+
+    def run(self):
+        """Execute synchronously and return the exit code"""
+        if Coprocess.exists(self.area):
+            coprocess = Coprocess(self.area)
+            try:
+                if self.send(coprocess):
+                    return self.returncode
+            finally:
+                coprocess.stop()
+
+        self.popen()
+        while not self.poll():
+            time.sleep(POLL_INTERVAL)
+        return self.returncode
+
+
+class Coprocess(object):
+    """Long running backend of an area, see module documentation"""
+
+    def __init__(self, area):
+        self.area = area
+        self.path = self.get_path(area)
+        self.process = None
+        self.buffer = b""
+        self.next_id = 1
+        self.broken = False
+
+    @staticmethod
+    def get_path(area):
+        return os.path.join(cinv.get_base_dir("backend"), area, "coprocess")
+
+    @classmethod
+    def exists(cls, area):
+        return os.access(cls.get_path(area), os.X_OK)
+
+    def start(self):
+        # Imported on demand, as most commands never execute a backend
+        import subprocess
+
+        log.debug("Starting coprocess %s" % self.path)
+        try:
+            self.process = subprocess.Popen([self.path],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                env=get_env(self.area))
+        except OSError as e:
+            self.broken = True
+            log.warning("Cannot start coprocess %s, using backend commands: %s"
+                % (self.path, e))
+            return False
+
+        return True
+
+    def readline(self, deadline):
+        """Return next line of the coprocess or None on timeout/exit"""
+        fd = self.process.stdout.fileno()
+
+        while b"\n" not in self.buffer:
+            timeout = None
+            if deadline:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return None
+
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if not ready:
+                return None
+
+            data = os.read(fd, 65536)
+            if not data:
+                return None
+            self.buffer += data
+
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line
+
+    def send(self, hook):
+        """Pass hook to the coprocess and wait for its acknowledgement
+
+        Returns False if the coprocess is not usable and the hook
+        needs to be executed by its backend command.
+        """
+        if self.broken:
+            return False
+        if not self.process and not self.start():
+            return False
+
+        event_id = self.next_id
+        self.next_id += 1
+
+        event = {"id": event_id, "command": hook.command, "args": hook.args}
+        log.debug("Sending to coprocess %s: %s" % (self.path, event))
+
+        deadline = time.monotonic() + hook.timeout if hook.timeout else None
+
+        try:
+            self.process.stdin.write((json.dumps(event) + "\n").encode())
+            self.process.stdin.flush()
+        except OSError as e:
+            hook.returncode = 1
+            hook.message = "coprocess gone: %s" % e
+            self.kill()
+            return True
+
+        while True:
+            line = self.readline(deadline)
+            if line is None:
+                if deadline and time.monotonic() >= deadline:
+                    hook.timed_out = True
+                else:
+                    hook.returncode = 1
+                    hook.message = "coprocess exited"
+                self.kill()
+                return True
+
+            try:
+                ack = json.loads(line.decode())
+                ack_id = ack["id"]
+                status = int(ack.get("status", 0))
+            except (ValueError, KeyError, TypeError) as e:
+                hook.returncode = 1
+                hook.message = "invalid acknowledgement %r: %s" % (line, e)
+                self.kill()
+                return True
+
+            if ack_id == event_id:
+                hook.returncode = status
+                hook.message = ack.get("message")
+                return True
+
+            log.debug("Ignoring acknowledgement of unknown event: %s" % ack)
+
+    def kill(self):
+        """Terminate a misbehaving coprocess, it is restarted if needed"""
+        if self.process:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+            self.buffer = b""
+
+    def stop(self):
+        if not self.process:
+            return
+
+        # Imported on demand, as most commands never execute a backend
+        import subprocess
+
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+        try:
+            self.process.wait(COPROCESS_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            log.warning("Coprocess %s did not exit, killing it" % self.path)
+            self.process.kill()
+            self.process.wait()
+
+        self.process.stdout.close()
+        self.process = None
+
+
+class Executor(object):
+    """Run backend hooks on a bounded number of processes
+
+    Deferred hooks are started by flush(), identical deferred hooks are
+    only run once. Results are collected and reported by flush().
+    Events of areas with a coprocess are passed to it one by one.
+    In a dry run, hooks are only printed.
+    """
+
+    def __init__(self, jobs=None, dry_run=False):
+        if jobs is None:
+            jobs = cinv.get_config("backend-jobs", "4")
+
+        try:
+            self.jobs = max(1, int(jobs))
+        except ValueError as e:
+            raise Error("Invalid backend-jobs setting: %s" % e)
+
+        self.dry_run = dry_run
+        self.deferred = collections.OrderedDict()
+        self.queue = collections.deque()
+        self.running = []
+        self.results = []
+        self.finished = []
+        self.coprocesses = {}
+
+    def submit(self, area, command, args, defer=False, via="args",
+            label=None, jobs=None):
+        """Queue a hook, with jobs it limits its own command instead"""
+        hook = Hook(area, command, args, via, label, jobs)
+
+        if defer:
+            if hook.key in self.deferred:
+                log.debug("Merging duplicate backend hook: %s" % hook)
+            else:
+                self.deferred[hook.key] = hook
+        else:
+            self.queue.append(hook)
+            self.start()
+
+        return hook
+
+    def coprocess(self, area):
+        if area not in self.coprocesses:
+            self.coprocesses[area] = (Coprocess(area)
+                if Coprocess.exists(area) else None)
+        return self.coprocesses[area]
+
+    def can_start(self, hook):
+        if hook.jobs:
+            command = (hook.area, hook.command)
+            return sum(1 for other in self.running
+                if (other.area, other.command) == command) < hook.jobs
+        return len(self.running) < self.jobs
+
+    def start(self):
+        busy = set(hook.object_key for hook in self.running)
+        index = 0
+        while index < len(self.queue):
+            hook = self.queue[index]
+            if hook.object_key in busy or not self.can_start(hook):
+                # Later hooks of the same object wait, too
+                busy.add(hook.object_key)
+                index += 1
+                continue
+            del self.queue[index]
+
+            if self.dry_run:
+                print("Would run backend hook %s" % hook, file=sys.stderr)
+                hook.returncode = 0
+                self.results.append(hook)
+                continue
+
+            coprocess = self.coprocess(hook.area)
+            if coprocess and hook.send(coprocess):
+                self.results.append(hook)
+                continue
+
+            try:
+                hook.popen()
+            except Error as e:
+                log.error(e)
+                hook.returncode = 127
+                self.results.append(hook)
+                continue
+            self.running.append(hook)
+            busy.add(hook.object_key)
+
+    def reap(self):
+        for hook in list(self.running):
+            if hook.poll():
+                self.running.remove(hook)
+                self.results.append(hook)
+                log.info("Backend hook %s: %s" % (hook, hook.status()))
+
+    def wait(self):
+        """Wait until all started and queued hooks finished"""
+        while self.queue or self.running:
+            self.reap()
+            self.start()
+            if self.running:
+                time.sleep(POLL_INTERVAL)
+
+    def discard(self):
+        """Drop deferred hooks, f.i. because the command failed"""
+        for hook in self.deferred.values():
+            log.debug("Discarding deferred backend hook: %s" % hook)
+        self.deferred.clear()
+
+    def settle(self):
+        """Wait for queued and running hooks and return failed ones
+
+        Deferred hooks are kept for flush().
+        """
+        self.wait()
+
+        failed = [hook for hook in self.results if hook.failed]
+        self.finished.extend(self.results)
+        self.results = []
+        return failed
+
+    def flush(self):
+        """Run deferred hooks, wait for all and return failed ones"""
+        self.queue.extend(self.deferred.values())
+        self.deferred.clear()
+        return self.settle()
+
+    def timings(self):
+        """Return list of (hook, seconds) of all hooks that ran"""
+        return [(hook, hook.duration) for hook in self.finished + self.results
+            if hook.duration is not None]
+
+    def close(self):
+        for coprocess in self.coprocesses.values():
+            if coprocess:
+                coprocess.stop()
+        self.coprocesses = {}
+
+
+_executor = None
+
+@contextlib.contextmanager
+def session(dry_run=False):
+    """Run backend hooks of the enclosed commands concurrently
+
+    Hooks sharing area and first argument keep their order.
+    Nested sessions join the outer one. At the end all hooks are
+    waited for and failed hooks are reported in one error.
+    With dry_run, hooks are printed instead of executed.
+    """
+    global _executor
+
+    if _executor:
+        yield _executor
+        return
+
+    _executor = Executor(dry_run=dry_run)
+    try:
+        yield _executor
+    except BaseException:
+        _executor.discard()
+        _executor.wait()
+        raise
+    else:
+        failed = _executor.flush()
+    finally:
+        _executor.close()
+        _executor = None
+
+    for hook in failed:
+        log.error("Backend hook %s failed: %s" % (hook, hook.status()))
+    if failed:
+        raise Error("%d backend hook(s) failed" % len(failed))
+
+def get_executor():
+    """Return executor of the current session or None"""
+    return _executor
+
+def apply(area, targets, via="args", chunk_size=0, jobs=None):
+    """Pass targets to the apply backend command of area
+
+    With a chunk size, every chunk is a hook of its own and up to
+    jobs chunks run in parallel. The chunks run at the end of the
+    session, identical chunks only once.
+    """
+    if not exists(area, "apply"):
+        log.debug("%s ignores missing backend command: apply" % area)
+        return
+
+    if chunk_size and chunk_size > 0:
+        chunks = [targets[i:i + chunk_size]
+            for i in range(0, len(targets), chunk_size)]
+    else:
+        chunks = [targets]
+
+    with session() as executor:
+        for number, chunk in enumerate(chunks, 1):
+            label = None
+            if len(chunks) > 1:
+                label = "chunk %d/%d (%d targets)" % (number, len(chunks),
+                    len(chunk))
+            executor.submit(area, "apply", chunk, defer=True, via=via,
+                label=label, jobs=jobs)
+
+def add_apply_arguments(parser):
+    parser.add_argument('--targets-via', choices=TARGETS_VIA, default="args",
+        help='Pass targets to the backend as arguments (default), '
+            'on stdin or in a file')
+    parser.add_argument('--chunk-size', type=int, default=0,
+        help='Call the backend for at most this many targets at once')
+    parser.add_argument('-j', '--jobs', type=int,
+        help='Number of chunks to apply in parallel')
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2012-2014 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import argparse
+import logging
+import shlex
+import sys
+
+import cinv
+import cinv.backend
+
+log = logging.getLogger(__name__)
+
+# Global options of the whole process, not of a single line
+BATCH_OPTIONS = ("dry-run", "timings", "profile")
+
+class Error(cinv.Error):
+    pass
+
+class Batch(object):
+    """Run many cinv commands in one process"""
+
+    def __init__(self, parser, stop_on_error=False):
+        self.parser = parser
+        self.stop_on_error = stop_on_error
+        self.failed = 0
+        self.total = 0
+
+    def run_line(self, line):
+        """Parse and execute a single command line, return error or None"""
+
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            return str(e)
+
+        try:
+            args = self.parser.parse_args(words)
+        except SystemExit:
+            return "invalid arguments"
+
+        if not hasattr(args, "func"):
+            return "no command given"
+
+        if args.func == self.commandline_batch:
+            return "batch cannot be nested"
+
+        for option in BATCH_OPTIONS:
+            if getattr(args, option.replace("-", "_"), None):
+                return "--%s applies to the whole batch only (cinv --%s batch)" % (
+                    option, option)
+
+        # Log levels given on the line apply to this line only
+        level = logging.root.level
+        if getattr(args, "verbose", False):
+            logging.root.setLevel(logging.INFO)
+        if getattr(args, "debug", False):
+            logging.root.setLevel(logging.DEBUG)
+
+        log.debug(args)
+
+        try:
+            args.func(args)
+        except cinv.Error as e:
+            return str(e)
+        except Exception as e:
+            log.debug("Command failed", exc_info=True)
+            return "%s: %s" % (e.__class__.__name__, e)
+        finally:
+            logging.root.setLevel(level)
+
+        # Backend hooks of this line belong to its status, deferred
+        # hooks like apply still run once at the end of the batch
+        executor = cinv.backend.get_executor()
+        if executor:
+            failed = executor.settle()
+            for hook in failed:
+                log.error("Backend hook %s failed: %s" % (hook, hook.status()))
+            if failed:
+                return "%d backend hook(s) failed" % len(failed)
+
+        return None
+
+    def run(self, lines):
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            self.total += 1
+            error = self.run_line(line)
+
+            # Flush command output before the status line
+            sys.stdout.flush()
+            if error:
+                self.failed += 1
+                print("%d: FAILED: %s: %s" % (lineno, line, error),
+                    file=sys.stderr)
+                if self.stop_on_error:
+                    break
+            else:
+                print("%d: OK: %s" % (lineno, line), file=sys.stderr)
+
+        if self.failed:
+            raise Error("%d of %d commands failed" % (self.failed, self.total))
+
+    @classmethod
+    def commandline_batch(cls, args):
+        batch = cls(args.main_parser, args.stop_on_error)
+
+        with args.file:
+            batch.run(args.file)
+
+    @classmethod
+    def commandline_args(cls, parent_parser, parents, main_parser):
+        """Add us to the parent parser, commands are parsed by main_parser"""
+
+        parent_parser.add_argument('file', nargs='?', default='-',
+            type=argparse.FileType('r'),
+            help='File containing one command per line (default: stdin)')
+        parent_parser.add_argument('-s', '--stop-on-error',
+            help='Stop at the first failing command', action='store_true')
+        parent_parser.set_defaults(func=cls.commandline_batch,
+            main_parser=main_parser)
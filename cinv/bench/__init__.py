@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+#
+# 2012-2014 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+
+"""Benchmarks of cinv on synthetic inventories
+
+Run with python3 -m cinv.bench, see --help. Results are written as
+JSON and can be compared with an earlier run to find regressions.
+"""
+
+import json
+import logging
+import os
+import os.path
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import cinv
+
+log = logging.getLogger(__name__)
+
+top_dir = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", ".."))
+cinv_script = os.path.join(top_dir, "scripts", "cinv")
+
+class Error(cinv.Error):
+    pass
+
+class Bench(object):
+    """Time functions on an inventory in a temporary HOME"""
+
+    def __init__(self, repeat=5, home=None):
+        self.repeat = repeat
+        self.results = {}
+        self.meta = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "time": int(time.time()),
+        }
+
+        self.keep = home is not None
+        self.home = home or tempfile.mkdtemp(prefix="cinv-bench-")
+        self.old_home = os.environ.get("HOME")
+        os.environ["HOME"] = self.home
+
+    def close(self):
+        if self.old_home is None:
+            del os.environ["HOME"]
+        else:
+            os.environ["HOME"] = self.old_home
+
+        if not self.keep:
+            shutil.rmtree(self.home)
+
+    def time(self, name, function, cleanup=None):
+        """Run function repeat times, cleanup after each run (not timed)
+
+        The fs operations of the last run are recorded as well.
+        """
+        from cinv import fsproperty
+
+        times = []
+        for run in range(self.repeat):
+            fsproperty.reset_counters()
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+            operations = fsproperty.counters()
+            if cleanup:
+                cleanup()
+
+        self.results[name] = {
+            "min": min(times),
+            "median": statistics.median(times),
+            "runs": len(times),
+            "operations": operations,
+        }
+        log.info("%s: %.6fs" % (name, min(times)))
+
+    def generate(self, hosts, networks, fill, macs):
+        # Imported on demand, only needed for new inventories
+        from cinv import fsproperty
+        import cinv.bench.generate
+
+        self.meta.update({ "hosts": hosts, "networks": networks,
+            "fill": fill, "macs": macs })
+
+        # The inventory is throw away data
+        policy = fsproperty.get_fsync_policy()
+        fsproperty.set_fsync_policy("none")
+        try:
+            cinv.bench.generate.hosts(hosts)
+            self.networks = [cinv.bench.generate.network(
+                "10.%d.0.0" % number, str(mask), fill)
+                for number, mask in enumerate(networks)]
+            cinv.bench.generate.mac_free(macs)
+        finally:
+            fsproperty.set_fsync_policy(policy)
+
+    def run_hosts(self):
+        import cinv.catalog
+        import cinv.host
+
+        Host = cinv.host.Host
+
+        for catalog in (False, True):
+            suffix = " (catalog)" if catalog else ""
+            if catalog:
+                cinv.catalog.Catalog.open(create=True).rebuild()
+
+            self.time("host_list" + suffix, lambda: Host.host_list())
+            self.time("host_list type" + suffix,
+                lambda: Host.host_list(host_type="vm"))
+            self.time("host_list tag" + suffix,
+                lambda: Host.host_list(tags=["web"]))
+            self.time("host_list type tag" + suffix,
+                lambda: Host.host_list(host_type="hw", tags=["db", "web"]))
+            self.time("vmhosts_vms_list" + suffix,
+                lambda: Host.vmhosts_vms_list())
+
+        os.remove(cinv.catalog.get_path())
+        cinv.catalog.Catalog._instances.clear()
+
+    def run_networks(self):
+        for network in self.networks:
+            name = "/%s" % network.mask
+            self.time("get_next_ipv4_address " + name,
+                network.get_next_ipv4_address)
+
+            fqdn = "bench.example.org"
+            self.time("host_add " + name,
+                lambda: network.host_add(fqdn, "02:ff:ff:ff:ff:ff"),
+                lambda: network.host_del(fqdn))
+
+    def run_mac(self):
+        import cinv.bench.generate
+        import cinv.mac
+
+        mac = cinv.mac.Mac()
+        taken = []
+        self.time("mac get_next", lambda: taken.append(mac.get_next()),
+            lambda: mac.free_append(taken.pop()))
+
+        # First address after the generated free pool
+        address = cinv.bench.generate.mac_address(self.meta["macs"])
+        prefix, suffix = mac.mac_split(address)
+        self.time("mac free_append", lambda: mac.free_append(address),
+            lambda: mac.free_pool(prefix).clear(suffix))
+
+    def run_startup(self):
+        if not os.path.exists(cinv_script):
+            log.warning("Skipping startup, %s not found" % cinv_script)
+            return
+
+        env = os.environ.copy()
+        env["PYTHONPATH"] = top_dir
+        command = [sys.executable, cinv_script, "host", "cores-get",
+            "host000000.example.org"]
+
+        self.time("interpreter startup", lambda: subprocess.run(
+            [sys.executable, "-c", "pass"], check=True))
+        self.time("cli host cores-get", lambda: subprocess.run(command,
+            env=env, check=True, stdout=subprocess.DEVNULL))
+
+    def run(self):
+        self.run_hosts()
+        self.run_networks()
+        self.run_mac()
+        self.run_startup()
+
+    def save(self, path):
+        with open(path, "w") as fd:
+            json.dump({ "meta": self.meta, "results": self.results }, fd,
+                indent=1, sort_keys=True)
+            fd.write("\n")
+
+def load(path):
+    try:
+        with open(path, "r") as fd:
+            return json.load(fd)
+    except (EnvironmentError, ValueError) as e:
+        raise Error("Cannot read benchmark results %s: %s" % (path, e))
+
+def compare(old, new, threshold=0.2):
+    """Return list of (name, old, new, ratio) and list of regressions
+
+    A benchmark regressed if its best time grew by more than threshold.
+    """
+    rows = []
+    regressions = []
+
+    for name in sorted(new["results"]):
+        if name not in old["results"]:
+            continue
+
+        old_time = old["results"][name]["min"]
+        new_time = new["results"][name]["min"]
+        ratio = new_time / old_time if old_time else float("inf")
+
+        rows.append((name, old_time, new_time, ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+
+    return rows, regressions
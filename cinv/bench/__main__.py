@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2012-2014 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+
+import argparse
+import logging
+import sys
+
+import cinv
+import cinv.bench
+
+log = logging.getLogger("cinv")
+
+def commandline():
+    parser = argparse.ArgumentParser(prog="python3 -m cinv.bench",
+        description="Benchmark cinv on a synthetic inventory")
+    parser.add_argument('--hosts', type=int, default=10000,
+        help='Number of hosts (default: 10000)')
+    parser.add_argument('--networks', default="24,20,16",
+        help='Comma separated masks of the networks (default: 24,20,16)')
+    parser.add_argument('--fill', type=float, default=0.5,
+        help='Used ratio of the network addresses (default: 0.5)')
+    parser.add_argument('--macs', type=int, default=100000,
+        help='Length of the mac free list (default: 100000)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+        help='Runs per benchmark, the best one counts (default: 5)')
+    parser.add_argument('-o', '--output', help='Write results as JSON')
+    parser.add_argument('-c', '--compare',
+        help='Compare with results of an earlier run')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+        help='Allowed slowdown before failing the comparison (default: 0.2)')
+    parser.add_argument('--home',
+        help='Use and keep this directory as HOME instead of a temporary one')
+    parser.add_argument('-v', '--verbose',
+        help='Show progress', action='store_true')
+
+    args = parser.parse_args()
+    if args.verbose:
+        logging.root.setLevel(logging.INFO)
+
+    try:
+        masks = [int(mask) for mask in args.networks.split(",") if mask]
+    except ValueError as e:
+        parser.error("Invalid --networks: %s" % e)
+
+    bench = cinv.bench.Bench(args.repeat, args.home)
+    try:
+        bench.generate(args.hosts, masks, args.fill, args.macs)
+        bench.run()
+    finally:
+        bench.close()
+
+    for name in sorted(bench.results):
+        print("%-36s %10.6fs" % (name, bench.results[name]["min"]))
+
+    if args.output:
+        bench.save(args.output)
+
+    if args.compare:
+        old = cinv.bench.load(args.compare)
+        new = { "meta": bench.meta, "results": bench.results }
+        rows, regressions = cinv.bench.compare(old, new, args.threshold)
+
+        print()
+        for name, old_time, new_time, ratio in rows:
+            print("%-36s %10.6fs %10.6fs %6.2fx%s" % (name, old_time, new_time,
+                ratio, "  REGRESSION" if name in regressions else ""))
+
+        if regressions:
+            log.error("%d benchmark(s) more than %.0f%% slower than %s" % (
+                len(regressions), args.threshold * 100, args.compare))
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+    try:
+        sys.exit(commandline())
+    except cinv.Error as e:
+        log.error(e)
+        sys.exit(1)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# 2012-2014 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+
+"""Synthetic inventories for benchmarks
+
+All data is written below cinv.get_base_dir("db") of the current
+HOME, so callers point HOME to a temporary directory first.
+"""
+
+import logging
+import random
+
+import cinv.host
+import cinv.mac
+import cinv.netipv4
+from cinv import fsproperty
+
+log = logging.getLogger(__name__)
+
+TAGS = ["web", "db", "cache", "batch", "edge", "mail", "dns", "monitoring"]
+
+def host_name(number):
+    return "host%06d.example.org" % number
+
+def hosts(count, vm_ratio=0.8, tags=TAGS, seed=0):
+    """Create count hosts, vm_ratio of them VMs spread over the others
+
+    Every host gets one or two random tags, so that a tag filter
+    matches roughly 1/4 of the hosts with the default tags.
+    """
+    rand = random.Random(seed)
+    hardware = max(1, int(count * (1 - vm_ratio)))
+
+    for number in range(count):
+        fqdn = host_name(number)
+        host = cinv.host.Host(fqdn)
+        host_type = "hw" if number < hardware else "vm"
+
+        fsproperty.makedirs(host.base_dir)
+        with fsproperty.transaction():
+            host.host_type = host_type
+            host.cores = str(rand.choice([1, 2, 4, 8, 16]))
+            host.memory = "%dG" % rand.choice([1, 2, 4, 8, 32])
+            if host_type == "vm":
+                host.vm_host = host_name(number % hardware)
+
+            for tag in rand.sample(tags, rand.randint(1, 2)):
+                host.tag[tag] = ""
+
+    log.info("Created %d hosts (%d hardware)" % (count, hardware))
+
+def network(network, mask, fill=0.5):
+    """Create network and fill the given ratio of its addresses
+
+    Host directories are written directly, the allocation map and
+    the indexes are rebuilt once at the end.
+    """
+    net = cinv.netipv4.NetIPv4(network)
+    net.validate_mask(mask)
+    net._init_base_dir(mask)
+
+    count = int((net.size - 2) * fill)
+    base = net.network_decimal()
+
+    for offset in range(1, count + 1):
+        fqdn = "ip%d-%s.example.org" % (offset, network.replace(".", "-"))
+        net.host_create(fqdn)
+        with fsproperty.transaction():
+            net.host_ipv4_address_set(fqdn,
+                net.ipv4_address_dotted_quad(base + offset))
+            net.host_mac_address_set(fqdn, mac_address(base + offset))
+
+    net.hosts_rebuild()
+
+    log.info("Created network %s/%s with %d hosts" % (network, mask, count))
+    return net
+
+def mac_address(number, prefix="02:00:00"):
+    """Return the mac address with the lower 24 bits of number"""
+    suffix = "%06x" % (number & 0xffffff)
+    return "%s:%s:%s:%s" % (prefix, suffix[0:2], suffix[2:4], suffix[4:6])
+
+def mac_free(count, prefix="02:00:00"):
+    """Set the mac prefix and put count addresses into the free pool"""
+    mac = cinv.mac.Mac()
+    mac.prefix = prefix
+    mac.free_add([mac_address(number, prefix) for number in range(count)])
+
+    log.info("Created mac free pool with %d addresses" % count)
+    return mac
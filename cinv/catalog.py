@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2012-2014 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import contextlib
+import logging
+import os
+import os.path
+
+import cinv
+import cinv.storage
+from cinv import fsproperty
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS host (fqdn TEXT PRIMARY KEY, host_type TEXT,
+    cores TEXT, memory TEXT, vm_host TEXT);
+CREATE TABLE IF NOT EXISTS tag (fqdn TEXT, name TEXT, value TEXT,
+    PRIMARY KEY (fqdn, name));
+CREATE TABLE IF NOT EXISTS disk (fqdn TEXT, name TEXT, size TEXT,
+    PRIMARY KEY (fqdn, name));
+CREATE TABLE IF NOT EXISTS nic (fqdn TEXT, name TEXT, mac_address TEXT,
+    PRIMARY KEY (fqdn, name));
+CREATE TABLE IF NOT EXISTS stamp (fqdn TEXT PRIMARY KEY, stamp TEXT);
+CREATE INDEX IF NOT EXISTS host_type_index ON host (host_type);
+CREATE INDEX IF NOT EXISTS host_vm_host_index ON host (vm_host);
+CREATE INDEX IF NOT EXISTS tag_name_index ON tag (name);
+"""
+
+# Attribute tables of a host: table -> (directory, value column)
+HOST_TABLES = {
+    "tag":  ("tag", "value"),
+    "disk": ("disk", "size"),
+    "nic":  ("nic", "mac_address"),
+}
+
+HOST_FILES = ["host_type", "cores", "memory", "vm_host"]
+
+
+class Error(cinv.Error):
+    pass
+
+
+def get_path():
+    return os.path.join(cinv.get_home_dir(), "db.sqlite")
+
+
+def get_host_base_dir():
+    return os.path.join(cinv.get_base_dir("db"), "host")
+
+
+def format_stamp(path):
+    stamp = fsproperty.stamp(path)
+    if stamp is None:
+        return "-"
+    return "%d:%d:%d" % stamp
+
+
+def host_stamp(fqdn):
+    """Return the stamps of all files of a host the catalog indexes"""
+    host_dir = os.path.join(get_host_base_dir(), fqdn)
+
+    stamps = [format_stamp(host_dir)]
+    for name in HOST_FILES:
+        stamps.append(format_stamp(os.path.join(host_dir, name)))
+
+    for directory, column in HOST_TABLES.values():
+        path = os.path.join(host_dir, directory)
+        stamps.append(format_stamp(path))
+        try:
+            entries = fsproperty.scandir(path)
+        except OSError:
+            continue
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            stamps.append("%s=%s" % (entry.name, format_stamp(entry.path)))
+
+    return " ".join(stamps)
+
+
+def _read_value(path):
+    try:
+        return fsproperty.read_file(path)
+    except EnvironmentError:
+        return ""
+
+def read_host(fqdn):
+    """Read the record of a host (without fqdn) from the filesystem
+
+    Raises FileNotFoundError if the host does not exist.
+    """
+    record = dict.fromkeys(HOST_FILES, "")
+    directories = {}
+    for table, (directory, column) in HOST_TABLES.items():
+        record[table] = directories[directory] = {}
+
+    for entry in fsproperty.scandir(os.path.join(get_host_base_dir(), fqdn)):
+        if entry.name in HOST_FILES:
+            record[entry.name] = _read_value(entry.path)
+        elif entry.name in directories and entry.is_dir:
+            directories[entry.name].update((item.name,
+                _read_value(item.path))
+                for item in fsproperty.scandir(entry.path))
+
+    return record
+
+
+class Catalog(object):
+    """SQLite index of the host database
+
+    The filesystem stays the source of truth: the catalog is only
+    used if it exists and no hosts were added or removed behind its back.
+    Host files changed in place without cinv are found by verify() and
+    read again by refresh() or rebuild().
+    """
+
+    _instances = {}
+
+    def __init__(self, path):
+        # Imported on demand, the catalog is optional
+        import sqlite3
+
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    @classmethod
+    def open(cls, create=False):
+        """Return catalog if present (or create is set), else None"""
+
+        # Changes kept in memory must not reach the catalog on disk
+        if not cinv.storage.get_storage().persistent:
+            return None
+
+        path = get_path()
+
+        if path not in cls._instances:
+            if not create and not os.path.exists(path):
+                return None
+            cls._instances[path] = cls(path)
+
+        return cls._instances[path]
+
+    @staticmethod
+    def host_dir_mtime():
+        try:
+            return str(fsproperty.mtime(get_host_base_dir()))
+        except OSError:
+            return ""
+
+    def meta_get(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def meta_set(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, value))
+
+    def fresh(self):
+        """Check that no hosts were added or removed outside of cinv"""
+        fresh = self.meta_get("host_dir_mtime") == self.host_dir_mtime()
+        if not fresh:
+            log.debug("Catalog %s is outdated - use cinv db index rebuild"
+                      % self.path)
+
+        return fresh
+
+    def refresh(self):
+        """Read hosts again whose files changed since they were cataloged
+
+        Returns the names of the hosts read again.
+        """
+        stamps = dict(self.connection.execute("SELECT fqdn, stamp FROM stamp"))
+        fqdns = [row[0] for row in self.connection.execute(
+            "SELECT fqdn FROM host")]
+
+        changed = []
+        for fqdn in fqdns:
+            if stamps.get(fqdn) != host_stamp(fqdn):
+                log.debug("Host %s changed outside of cinv" % fqdn)
+                self.host_sync(fqdn)
+                changed.append(fqdn)
+
+        return changed
+
+    def mark_fresh(self):
+        with self.connection:
+            self.meta_set("host_dir_mtime", self.host_dir_mtime())
+
+    def _host_insert(self, fqdn, record, stamp):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO stamp (fqdn, stamp) VALUES (?, ?)",
+            (fqdn, stamp))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO host (fqdn, host_type, cores, memory, "
+            "vm_host) VALUES (?, ?, ?, ?, ?)",
+            (fqdn, record["host_type"], record["cores"], record["memory"],
+             record["vm_host"]))
+
+        for table, (directory, column) in HOST_TABLES.items():
+            self.connection.execute(
+                "DELETE FROM %s WHERE fqdn = ?" % table, (fqdn,))
+            self.connection.executemany(
+                "INSERT INTO %s (fqdn, name, %s) VALUES (?, ?, ?)" % (
+                    table, column),
+                [(fqdn, name, value)
+                 for name, value in record[table].items()])
+
+    def host_sync(self, fqdn):
+        """Update catalog entry of host from the filesystem"""
+        with self.connection:
+            if fsproperty.isdir(os.path.join(get_host_base_dir(), fqdn)):
+                # Stamp first, so changes while reading are noticed later
+                stamp = host_stamp(fqdn)
+                self._host_insert(fqdn, read_host(fqdn), stamp)
+            else:
+                self._host_delete(fqdn)
+
+    def _host_delete(self, fqdn):
+        self.connection.execute("DELETE FROM host WHERE fqdn = ?", (fqdn,))
+        self.connection.execute("DELETE FROM stamp WHERE fqdn = ?", (fqdn,))
+        for table in HOST_TABLES:
+            self.connection.execute(
+                "DELETE FROM %s WHERE fqdn = ?" % table, (fqdn,))
+
+    def host_remove(self, fqdn):
+        with self.connection:
+            self._host_delete(fqdn)
+
+    def rebuild(self):
+        """Recreate the catalog from the filesystem"""
+        try:
+            fqdns = fsproperty.listdir(get_host_base_dir())
+        except FileNotFoundError:
+            fqdns = []
+
+        with self.connection:
+            self.connection.execute("DELETE FROM host")
+            self.connection.execute("DELETE FROM stamp")
+            for table in HOST_TABLES:
+                self.connection.execute("DELETE FROM %s" % table)
+
+            for fqdn in fqdns:
+                stamp = host_stamp(fqdn)
+                self._host_insert(fqdn, read_host(fqdn), stamp)
+
+            self.meta_set("host_dir_mtime", self.host_dir_mtime())
+
+        log.debug("Catalog %s rebuilt with %d hosts" % (self.path, len(fqdns)))
+
+    def host_record(self, fqdn):
+        row = self.connection.execute(
+            "SELECT host_type, cores, memory, vm_host FROM host "
+            "WHERE fqdn = ?", (fqdn,)).fetchone()
+        if not row:
+            return None
+
+        record = dict(zip(HOST_FILES, row))
+        for table, (directory, column) in HOST_TABLES.items():
+            record[table] = dict(self.connection.execute(
+                "SELECT name, %s FROM %s WHERE fqdn = ?" % (column, table),
+                (fqdn,)))
+
+        return record
+
+    def verify(self):
+        """Return list of differences between catalog and filesystem"""
+        drift = []
+
+        try:
+            fqdns = set(fsproperty.listdir(get_host_base_dir()))
+        except FileNotFoundError:
+            fqdns = set()
+
+        cataloged = set(row[0] for row in
+                        self.connection.execute("SELECT fqdn FROM host"))
+
+        for fqdn in sorted(fqdns | cataloged):
+            if fqdn not in cataloged:
+                drift.append("%s: missing in catalog" % fqdn)
+            elif fqdn not in fqdns:
+                drift.append("%s: cataloged, but does not exist" % fqdn)
+            else:
+                record = read_host(fqdn)
+                cataloged_record = self.host_record(fqdn)
+                for key in sorted(record):
+                    if record[key] != cataloged_record[key]:
+                        drift.append("%s: %s differs (%s != %s)" % (
+                            fqdn, key, cataloged_record[key], record[key]))
+
+        return drift
+
+    def host_list(self, host_type=None, tags=[]):
+        query = "SELECT fqdn FROM host"
+        conditions = []
+        parameters = []
+
+        if host_type:
+            conditions.append("host_type = ?")
+            parameters.append(host_type)
+
+        for tag in tags:
+            conditions.append("fqdn IN (SELECT fqdn FROM tag WHERE name = ?)")
+            parameters.append(tag)
+
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        return [row[0] for row in self.connection.execute(query, parameters)]
+
+    def vm_host_list(self, tags=[]):
+        vm_hosts = {}
+        fqdns = set(self.host_list(tags=tags))
+
+        for fqdn, vm_host in self.connection.execute(
+                "SELECT fqdn, vm_host FROM host WHERE vm_host != '' "
+                "ORDER BY fqdn"):
+            if fqdn in fqdns:
+                vm_hosts.setdefault(vm_host, []).append(fqdn)
+
+        return vm_hosts
+
+    ######################################################################
+    @classmethod
+    def commandline_index_rebuild(cls, args):
+        catalog = cls.open(create=True)
+        catalog.rebuild()
+
+        log.info("Rebuilt catalog %s" % catalog.path)
+
+    @classmethod
+    def commandline_index_refresh(cls, args):
+        catalog = cls.open()
+        if not catalog or not catalog.fresh():
+            raise Error("Catalog missing or outdated - use cinv db index rebuild")
+
+        for fqdn in catalog.refresh():
+            print(fqdn)
+
+    @classmethod
+    def commandline_index_verify(cls, args):
+        catalog = cls.open()
+        if not catalog:
+            raise Error("No catalog present - use cinv db index rebuild")
+
+        drift = catalog.verify()
+        for line in drift:
+            print(line)
+
+        if drift:
+            raise Error("Catalog differs from filesystem - "
+                        "use cinv db index refresh or rebuild")
+
+    @classmethod
+    def commandline_compact(cls, args):
+        # Imported on demand, only needed for compaction
+        import cinv.storage
+
+        cinv.storage.get_storage().compact()
+
+    @classmethod
+    def commandline_args(cls, parent_parser, parents):
+        """Add us to the parent parser and add all parents to our parsers"""
+
+        parser = {}
+        parser['sub'] = parent_parser.add_subparsers(title="DB Commands")
+
+        parser['index'] = parser['sub'].add_parser('index', parents=parents)
+        parser['index-sub'] = parser['index'].add_subparsers(
+            title="Catalog Commands")
+
+        parser['rebuild'] = parser['index-sub'].add_parser(
+            'rebuild', parents=parents,
+            help="Create or recreate the catalog from the filesystem")
+        parser['rebuild'].set_defaults(func=cls.commandline_index_rebuild)
+
+        parser['refresh'] = parser['index-sub'].add_parser(
+            'refresh', parents=parents,
+            help="Read hosts again that were changed in place without cinv")
+        parser['refresh'].set_defaults(func=cls.commandline_index_refresh)
+
+        parser['verify'] = parser['index-sub'].add_parser(
+            'verify', parents=parents,
+            help="Report differences between catalog and filesystem")
+        parser['verify'].set_defaults(func=cls.commandline_index_verify)
+
+        parser['compact'] = parser['sub'].add_parser('compact', parents=parents,
+            help="Compact the database logs (log storage only)")
+        parser['compact'].set_defaults(func=cls.commandline_compact)
+
+
+@contextlib.contextmanager
+def host_dir_change():
+    """Keep the catalog fresh while cinv adds or removes hosts"""
+    catalog = Catalog.open()
+    fresh = catalog is not None and catalog.fresh()
+
+    yield catalog
+
+    if fresh:
+        catalog.mark_fresh()
+
+
+def fs_changed(path):
+    """Keep catalog in sync with changes below the host directory"""
+    host_base_dir = get_host_base_dir() + os.sep
+
+    if not path.startswith(host_base_dir):
+        return
+
+    catalog = Catalog.open()
+    if not catalog:
+        return
+
+    fqdn = path[len(host_base_dir):].split(os.sep)[0]
+    catalog.host_sync(fqdn)
+
+fsproperty.change_listeners.append(fs_changed)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2012-2014 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import csv
+import json
+import sys
+
+import cinv
+
+FORMATS = ["jsonl", "csv"]
+
+class Error(cinv.Error):
+    pass
+
+def csv_value(value):
+    """Flatten dicts to name=value;name=value for CSV"""
+    if isinstance(value, dict):
+        return ";".join(["%s=%s" % (name, value[name]) for name in sorted(value)])
+    return value
+
+def write(records, fields, format="jsonl", fd=None):
+    """Write records (dicts) one by one as JSON Lines or CSV"""
+
+    if fd is None:
+        fd = sys.stdout
+
+    if format == "jsonl":
+        for record in records:
+            fd.write(json.dumps(record, sort_keys=True) + "\n")
+    elif format == "csv":
+        writer = csv.writer(fd)
+        writer.writerow(fields)
+        for record in records:
+            writer.writerow([csv_value(record.get(field, ""))
+                for field in fields])
+    else:
+        raise Error("Format must be one of %s" % (" ".join(FORMATS)))
+
+def read(fd, format="jsonl"):
+    """Yield (line number, record, error) of JSON Lines or CSV
+
+    CSV needs a header line naming the fields. Lines that cannot be
+    parsed are yielded with record None and the error.
+    """
+    if format == "jsonl":
+        for number, line in enumerate(fd, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield number, None, "invalid JSON: %s" % e
+                continue
+            if not isinstance(record, dict):
+                yield number, None, "not a JSON object"
+                continue
+            yield number, record, None
+    elif format == "csv":
+        reader = csv.DictReader(fd)
+        for record in reader:
+            yield reader.line_num, record, None
+    else:
+        raise Error("Format must be one of %s" % (" ".join(FORMATS)))
+
+def add_format_argument(parser):
+    parser.add_argument('-F', '--format', help='Output format (default: jsonl)',
+        choices=FORMATS, default="jsonl")
@@ -22,8 +22,373 @@
 import os
 import os.path
 import collections
+import collections.abc
+import contextlib
+import itertools
+import re
+import threading
+import time
 
 import cinv
+import cinv.storage
+
+
+# Callables notified with the path of every file changed through fsproperty
+change_listeners = []
+
+def notify_change(path):
+    with _read_cache_lock:
+        _read_cache.pop(path, None)
+    for listener in change_listeners:
+        listener(path)
+
+
+######################################################################
+# File access
+#
+# All reads and writes go through the functions below, which pass them
+# on to the configured storage (see cinv.storage). Inside of a
+# transaction writes are staged in memory and stored together on commit.
+#
+
+# none: never fsync, batch: fsync on commit, always: fsync every write
+FSYNC_POLICIES = ["none", "batch", "always"]
+
+_fsync_policy = None
+_transaction = None
+
+# Read cache: path -> (stamp, content), least recently used first.
+# Files modified within READ_CACHE_RACY_NS are not cached, as a change
+# within the same timestamp granularity would go unnoticed.
+READ_CACHE_MAX_FILE = 1 << 20
+READ_CACHE_RACY_NS = 2 * 10**9
+
+_read_cache = collections.OrderedDict()
+_read_cache_lock = threading.Lock()
+_read_cache_size = None
+
+# Storage operations by kind and bytes moved, see counters()
+COUNTERS = ["open", "read", "write", "stat", "listdir", "mkdir", "unlink",
+    "bytes_read", "bytes_written"]
+
+_counters = collections.Counter()
+_counters_lock = threading.Lock()
+
+def _count(**amounts):
+    with _counters_lock:
+        _counters.update(amounts)
+
+def _storage(*operations):
+    """Return the storage for one operation, counted as given kinds"""
+    _count(**dict.fromkeys(operations, 1))
+    return cinv.storage.get_storage()
+
+def counters():
+    """Return dict of operations and bytes since start or reset_counters()"""
+    with _counters_lock:
+        return { name: _counters[name] for name in COUNTERS }
+
+def reset_counters():
+    with _counters_lock:
+        _counters.clear()
+
+def format_counters():
+    """Return counters as "open 3, read 2, ..." (only those not 0)"""
+    values = counters()
+    return ", ".join(["%s %d" % (name, values[name])
+        for name in COUNTERS if values[name]])
+
+
+def get_fsync_policy():
+    if _fsync_policy is None:
+        set_fsync_policy(cinv.get_config("fsync", "batch"))
+    return _fsync_policy
+
+def set_fsync_policy(policy):
+    global _fsync_policy
+
+    if policy not in FSYNC_POLICIES:
+        raise cinv.Error("fsync policy must be one of %s" % (
+            " ".join(FSYNC_POLICIES)))
+    _fsync_policy = policy
+
+def get_read_cache_size():
+    global _read_cache_size
+
+    if _read_cache_size is None:
+        try:
+            _read_cache_size = int(cinv.get_config("read-cache-size", "4096"))
+        except ValueError as e:
+            raise cinv.Error("Invalid read-cache-size: %s" % e)
+    return _read_cache_size
+
+def set_read_cache_size(size):
+    global _read_cache_size
+
+    _read_cache_size = size
+    with _read_cache_lock:
+        while len(_read_cache) > max(size, 0):
+            _read_cache.popitem(last=False)
+
+
+class Transaction(object):
+    """Writes staged in memory until commit
+
+    On commit all staged files are handed to the storage at once, which
+    writes them and syncs every affected directory (or log) once.
+    """
+    def __init__(self):
+        # path -> content (bytes) or None if removed
+        self.staged = collections.OrderedDict()
+        self.fsync = get_fsync_policy() != "none"
+
+    def get(self, path):
+        """Return (staged, content) of path"""
+        if path in self.staged:
+            return True, self.staged[path]
+        return False, None
+
+    def stage(self, path, data):
+        self.staged[path] = data
+
+    def listdir(self, path, names):
+        """Adjust directory listing to staged changes"""
+        names = set(names)
+        for staged_path, data in self.staged.items():
+            directory, name = os.path.split(staged_path)
+            if directory == path:
+                if data is None:
+                    names.discard(name)
+                else:
+                    names.add(name)
+        return list(names)
+
+    def commit(self):
+        for data in self.staged.values():
+            if data is None:
+                _count(unlink=1)
+            else:
+                _count(open=1, write=1, bytes_written=len(data))
+
+        try:
+            cinv.storage.get_storage().commit(list(self.staged.items()),
+                self.fsync)
+        except EnvironmentError as e:
+            raise cinv.Error(str(e))
+
+        for path in self.staged:
+            notify_change(path)
+
+
+@contextlib.contextmanager
+def transaction():
+    """Group all writes of the block and commit them at its end
+
+    Nested transactions join the outermost one. If the block raises,
+    all staged writes are discarded.
+
+    The current transaction is module global and not thread-safe:
+    writes of other threads would join it.
+    """
+    global _transaction
+
+    if _transaction is not None:
+        yield _transaction
+        return
+
+    _transaction = Transaction()
+    try:
+        yield _transaction
+        current, _transaction = _transaction, None
+        current.commit()
+    finally:
+        _transaction = None
+
+def staged(path):
+    """Return (staged, content) of path in the current transaction"""
+    if _transaction is None:
+        return False, None
+    return _transaction.get(path)
+
+def read_bytes(path):
+    is_staged, data = staged(path)
+    if is_staged:
+        if data is None:
+            raise FileNotFoundError(path)
+        return data
+
+    cache_size = get_read_cache_size()
+    if cache_size <= 0:
+        data = _storage("open", "read").read(path)
+        _count(bytes_read=len(data))
+        return data
+
+    stamp = _storage("stat").stamp(path)
+
+    with _read_cache_lock:
+        cached = _read_cache.get(path)
+        if cached and cached[0] == stamp:
+            _read_cache.move_to_end(path)
+            return cached[1]
+
+    data = _storage("open", "read").read(path)
+    _count(bytes_read=len(data))
+
+    with _read_cache_lock:
+        if (len(data) == stamp[1] and stamp[1] <= READ_CACHE_MAX_FILE and
+                time.time_ns() - stamp[0] > READ_CACHE_RACY_NS):
+            _read_cache[path] = (stamp, data)
+            _read_cache.move_to_end(path)
+            if len(_read_cache) > cache_size:
+                _read_cache.popitem(last=False)
+        else:
+            _read_cache.pop(path, None)
+
+    return data
+
+def read_file(path):
+    """Return content of path without trailing newline"""
+    return read_bytes(path).decode().rstrip('\n')
+
+def iter_lines(path):
+    """Yield lines of path without reading it completely"""
+    is_staged, data = staged(path)
+    if is_staged:
+        if data is None:
+            raise FileNotFoundError(path)
+        return iter(data.decode().splitlines())
+
+    return _count_lines(_storage("open", "read").iter_lines(path))
+
+def _count_lines(lines):
+    for line in lines:
+        _count(bytes_read=len(line) + 1)
+        yield line
+
+def write_bytes(path, data):
+    if _transaction is not None:
+        _transaction.stage(path, bytes(data))
+        return
+
+    _storage("open", "write").write(path, bytes(data),
+        get_fsync_policy() == "always")
+    _count(bytes_written=len(data))
+    notify_change(path)
+
+def write_file(path, text):
+    write_bytes(path, text.encode())
+
+def append_bytes(path, data):
+    """Append to path in place (outside of transactions)"""
+    _storage("open", "write").append(path, data,
+        get_fsync_policy() == "always")
+    _count(bytes_written=len(data))
+    notify_change(path)
+
+def pop_line(path):
+    """Remove and return the last line of path (outside of transactions)
+
+    The end of the file is read backwards in chunks, then the file is
+    truncated, so popping does not depend on the size of the file.
+    """
+    storage = _storage("open", "read", "write")
+
+    end = storage.stamp(path)[1]
+    if end == 0:
+        raise IndexError('pop from empty list')
+
+    # Last line may lack the trailing newline
+    if storage.read_at(path, end - 1, 1) == b'\n':
+        line_end = end - 1
+    else:
+        line_end = end
+
+    # Search backwards for the start of the last line
+    line_start = 0
+    position = line_end
+    while position > 0:
+        chunk_start = max(0, position - 4096)
+        chunk = storage.read_at(path, chunk_start, position - chunk_start)
+        newline = chunk.rfind(b'\n')
+        if newline != -1:
+            line_start = chunk_start + newline + 1
+            break
+        position = chunk_start
+
+    value = storage.read_at(path, line_start, line_end - line_start)
+    storage.truncate(path, line_start, get_fsync_policy() == "always")
+    _count(bytes_read=len(value) + 1)
+    notify_change(path)
+    return value.decode()
+
+def write_at(path, offset, data):
+    """Overwrite part of path in place (outside of transactions)"""
+    _storage("open", "write").write_at(path, offset, data,
+        get_fsync_policy() == "always")
+    _count(bytes_written=len(data))
+    notify_change(path)
+
+def remove_file(path):
+    if _transaction is not None:
+        if not exists(path):
+            raise FileNotFoundError(path)
+        _transaction.stage(path, None)
+        return
+
+    _storage("unlink").remove(path, get_fsync_policy() == "always")
+    notify_change(path)
+
+def exists(path):
+    """Check whether the file path exists"""
+    is_staged, data = staged(path)
+    if is_staged:
+        return data is not None
+    return _storage("stat").isfile(path)
+
+def stamp(path):
+    """Return (mtime in ns, size, identity) of path or None if missing"""
+    if staged(path)[0]:
+        return None
+    try:
+        return _storage("stat").stamp(path)
+    except EnvironmentError:
+        return None
+
+def mtime(path):
+    """Return modification time of file or directory in ns"""
+    return _storage("stat").mtime(path)
+
+def listdir(path):
+    names = _storage("listdir").listdir(path)
+    if _transaction is not None:
+        names = _transaction.listdir(path, names)
+    return names
+
+def scandir(path):
+    """Return list of entries (name, path, is_dir) of directory path"""
+    return _storage("listdir").scandir(path)
+
+def isdir(path):
+    return _storage("stat").isdir(path)
+
+def mkdir(path):
+    _storage("mkdir").mkdir(path)
+
+def makedirs(path):
+    """Create directory path and its parents unless they exist"""
+    _storage("mkdir").makedirs(path)
+
+def rmtree(path, ignore_errors=False):
+    try:
+        _storage("unlink").rmtree(path)
+    except EnvironmentError:
+        if not ignore_errors:
+            raise
+    notify_change(path)
+
+def utime(path):
+    """Set modification time of file or directory path to now"""
+    _storage("write").utime(path)
 
 
 class AbsolutePathRequiredError(cinv.Error):
@@ -34,47 +399,71 @@ class AbsolutePathRequiredError(cinv.Error):
         return 'Absolute path required, got: %s' % self.path
 
 
-class FileList(collections.MutableSequence):
+class FileList(collections.abc.MutableSequence):
     """A list that stores it's state in a file.
 
+    Appending, popping from the end, iterating and membership tests
+    touch the file only once. With index=True membership tests are
+    answered from an in-memory set, which is reloaded whenever the file
+    changed on disk.
+
     """
-    def __init__(self, path, initial=None):
+    def __init__(self, path, initial=None, index=False):
         if not os.path.isabs(path):
             raise AbsolutePathRequiredError(path)
         self.path = path
+        self.index = index
+        self.__index = None
+        self.__index_stamp = None
         if initial:
-            # delete existing file
-            try:
-                os.unlink(self.path)
-            except EnvironmentError:
-                # ignored
-                pass
-            for i in initial:
-                self.append(i)
+            self.__write(initial)
+
+    def __stamp(self):
+        return stamp(self.path)
 
     def __read(self):
-        lines = []
         # if file does not exist return empty list
-        try:
-            with open(self.path) as fd:
-                for line in fd:
-                    lines.append(line.rstrip('\n'))
-        except EnvironmentError as e:
-            # error ignored
-            pass
-        return lines
+        return [line for line in self]
 
     def __write(self, lines):
         try:
-            with open(self.path, 'w') as fd:
-                for line in lines:
-                    fd.write(str(line) + '\n')
+            write_file(self.path, "".join([str(line) + '\n' for line in lines]))
         except EnvironmentError as e:
             # should never happen
             raise cinv.Error(str(e))
 
+    def __get_index(self):
+        stamp = self.__stamp()
+        if self.__index is None or stamp is None or stamp != self.__index_stamp:
+            self.__index = {line for line in self}
+            self.__index_stamp = stamp
+        return self.__index
+
     def __repr__(self):
-        return repr(list(self))
+        return repr(self.__read())
+
+    def __iter__(self):
+        try:
+            yield from iter_lines(self.path)
+        except EnvironmentError:
+            # error ignored
+            pass
+
+    def __contains__(self, value):
+        value = str(value)
+        if self.index:
+            return value in self.__get_index()
+        for line in self:
+            if line == value:
+                return True
+        return False
+
+    def __bool__(self):
+        is_staged, data = staged(self.path)
+        if is_staged:
+            return bool(data)
+        stamp = self.__stamp()
+        return bool(stamp and stamp[1])
 
     def __getitem__(self, index):
         return self.__read()[index]
@@ -98,12 +487,57 @@ class FileList(collections.MutableSequence):
         lines.insert(index, value)
         self.__write(lines)
 
+    def append(self, value):
+        if _transaction is not None:
+            self.__write(self.__read() + [value])
+            return
+
+        index_valid = (self.index and self.__index is not None and
+                       self.__index_stamp == self.__stamp())
+        try:
+            append_bytes(self.path, (str(value) + '\n').encode())
+        except EnvironmentError as e:
+            raise cinv.Error(str(e))
+
+        if index_valid:
+            self.__index.add(str(value))
+            self.__index_stamp = self.__stamp()
+
+    def extend(self, values):
+        if _transaction is not None:
+            self.__write(self.__read() + list(values))
+            return
+
+        try:
+            append_bytes(self.path, "".join([str(value) + '\n'
+                for value in values]).encode())
+        except EnvironmentError as e:
+            raise cinv.Error(str(e))
+
+    def pop(self, index=-1):
+        """Remove and return item at index (default last)
+
+        Removing the last item only truncates the file.
+        """
+        if index != -1 or _transaction is not None:
+            return super().pop(index)
+
+        try:
+            value = pop_line(self.path)
+        except EnvironmentError:
+            raise IndexError('pop from empty list')
+
+        # The popped value may still be contained in an earlier line
+        self.__index = None
+
+        return value
+
     def sort(self):
         lines = sorted(self)
         self.__write(lines)
 
 
-class DirectoryDict(collections.MutableMapping):
+class DirectoryDict(collections.abc.MutableMapping):
     """A dict that stores it's items as files in a directory.
 
     """
@@ -113,8 +547,8 @@ class DirectoryDict(collections.MutableMapping):
         self.path = path
         try:
             # create directory if it doesn't exist
-            if not os.path.isdir(self.path):
-                os.mkdir(self.path)
+            if not isdir(self.path):
+                mkdir(self.path)
         except EnvironmentError as e:
             raise cinv.Error(str(e))
         if initial is not None:
@@ -127,47 +561,237 @@ class DirectoryDict(collections.MutableMapping):
 
     def __getitem__(self, key):
         try:
-            with open(os.path.join(self.path, key), "r") as fd:
-                return fd.read().rstrip('\n')
+            return read_file(os.path.join(self.path, key))
         except EnvironmentError:
             raise KeyError(key)
 
     def __setitem__(self, key, value):
+        if type(value) == type([]):
+            content = "".join([str(v) + '\n' for v in value])
+        else:
+            content = str(value) + '\n'
+
         try:
-            with open(os.path.join(self.path, key), "w") as fd:
-                if type(value) == type([]):
-                    for v in value:
-                        fd.write(str(v) + '\n')
-                else:
-                    fd.write(str(value) + '\n')
+            write_file(os.path.join(self.path, key), content)
         except EnvironmentError as e:
             raise cinv.Error(str(e))
 
     def __delitem__(self, key):
         try:
-            os.remove(os.path.join(self.path, key))
+            remove_file(os.path.join(self.path, key))
         except EnvironmentError:
             raise KeyError(key)
 
     def __iter__(self):
         try:
-            return iter(os.listdir(self.path))
+            return iter(listdir(self.path))
         except EnvironmentError as e:
             raise cinv.Error(str(e))
 
     def __len__(self):
         try:
-            return len(os.listdir(self.path))
+            return len(listdir(self.path))
         except EnvironmentError as e:
             raise cinv.Error(str(e))
 
 
+# Used to skip clear bytes of bitmaps
+_NONZERO_BYTE = re.compile(b'[^\x00]')
+
+class FileBitmap(object):
+    """A bitmap that stores it's state in a file.
+
+    Bit n is stored in byte n // 8, least significant bit first.
+    Bits beyond the end of the file are clear.
+
+    """
+    def __init__(self, path):
+        if not os.path.isabs(path):
+            raise AbsolutePathRequiredError(path)
+        self.path = path
+
+    def __read(self):
+        try:
+            return read_bytes(self.path)
+        except EnvironmentError:
+            return b''
+
+    def __write_byte(self, index, value):
+        self.__write_bytes(index, bytes([value]))
+
+    def __write_bytes(self, index, values):
+        """Overwrite the bytes starting at index"""
+        if _transaction is not None:
+            data = bytearray(self.__read())
+            if index + len(values) > len(data):
+                data.extend(bytes(index + len(values) - len(data)))
+            data[index:index + len(values)] = values
+            _transaction.stage(self.path, bytes(data))
+            return
+
+        try:
+            write_at(self.path, index, bytes(values))
+        except EnvironmentError as e:
+            raise cinv.Error(str(e))
+
+    def __repr__(self):
+        return '<FileBitmap %s>' % self.path
+
+    def exists(self):
+        return exists(self.path)
+
+    def mtime(self):
+        """Return modification time in ns or None if missing"""
+        try:
+            return mtime(self.path)
+        except EnvironmentError:
+            return None
+
+    def get(self, bit):
+        data = self.__read()
+        index = bit // 8
+        if index >= len(data):
+            return False
+        return bool(data[index] & (1 << (bit % 8)))
+
+    def get_many(self, bits):
+        """Return list of the given bits that are set"""
+        data = self.__read()
+        return [bit for bit in bits
+            if bit // 8 < len(data) and data[bit // 8] & (1 << (bit % 8))]
+
+    def set(self, bit, value=True):
+        """Set (or clear) a single bit in place"""
+        data = self.__read()
+        index = bit // 8
+        current = data[index] if index < len(data) else 0
+        if value:
+            current |= (1 << (bit % 8))
+        else:
+            current &= ~(1 << (bit % 8))
+        self.__write_byte(index, current)
+
+    def clear(self, bit):
+        self.set(bit, False)
+
+    def set_many(self, bits, value=True):
+        """Set (or clear) many bits, written at once"""
+        bits = list(bits)
+        if not bits:
+            return
+
+        data = bytearray(self.__read())
+        low = min(bits) // 8
+        high = max(bits) // 8
+        if high >= len(data):
+            data.extend(bytes(high + 1 - len(data)))
+
+        for bit in bits:
+            if value:
+                data[bit // 8] |= (1 << (bit % 8))
+            else:
+                data[bit // 8] &= ~(1 << (bit % 8))
+
+        self.__write_bytes(low, data[low:high + 1])
+
+    def reset(self, size, bits):
+        """Replace the bitmap by a bitmap of size bits with the given bits set"""
+        data = bytearray((size + 7) // 8)
+        for bit in bits:
+            data[bit // 8] |= (1 << (bit % 8))
+        try:
+            write_bytes(self.path, data)
+        except EnvironmentError as e:
+            raise cinv.Error(str(e))
+
+    def first_clear(self, start=0, end=None):
+        """Return the lowest clear bit in [start, end) or None"""
+        data = self.__read()
+        if end is None:
+            end = len(data) * 8
+
+        bit = start
+        while bit < end:
+            index = bit // 8
+            if index >= len(data):
+                return bit
+
+            # Skip completely used bytes in one go
+            if bit % 8 == 0 and data[index] == 0xff:
+                chunk = data[index:(end + 7) // 8]
+                bit = (index + len(chunk) - len(chunk.lstrip(b'\xff'))) * 8
+                continue
+
+            if not data[index] & (1 << (bit % 8)):
+                return bit
+            bit += 1
+
+        return None
+
+    def last_clear(self, start=0, end=None):
+        """Return the highest clear bit in [start, end) or None"""
+        data = self.__read()
+        if end is None:
+            end = len(data) * 8
+
+        bit = end - 1
+        while bit >= start:
+            index = bit // 8
+            if index >= len(data):
+                return bit
+
+            # Skip completely used bytes in one go
+            if bit % 8 == 7 and data[index] == 0xff:
+                chunk = data[start // 8:index + 1]
+                bit = (start // 8 + len(chunk.rstrip(b'\xff'))) * 8 - 1
+                continue
+
+            if not data[index] & (1 << (bit % 8)):
+                return bit
+            bit -= 1
+
+        return None
+
+    @staticmethod
+    def __iter_set(data, start=0):
+        """Yield set bits of data from start on in ascending order"""
+        match = _NONZERO_BYTE.search(data, start // 8)
+        while match:
+            index = match.start()
+            for bit in range(index * 8, index * 8 + 8):
+                if bit >= start and data[index] & (1 << (bit % 8)):
+                    yield bit
+            match = _NONZERO_BYTE.search(data, index + 1)
+
+    def first_set(self, start=0, end=None):
+        """Return the lowest set bit in [start, end) or None"""
+        bit = next(self.__iter_set(self.__read(), start), None)
+        if bit is None or (end is not None and bit >= end):
+            return None
+        return bit
+
+    def pop_first(self, count):
+        """Clear and return up to count of the lowest set bits"""
+        bits = list(itertools.islice(self.__iter_set(self.__read()), count))
+        self.set_many(bits, False)
+        return bits
+
+    def count(self):
+        """Return number of set bits"""
+        return bin(int.from_bytes(self.__read(), "little")).count("1")
+
+    def __iter__(self):
+        """Yield set bits in ascending order"""
+        return self.__iter_set(self.__read())
+
+
 class FileBasedProperty(object):
     attribute_class = None
 
-    def __init__(self, path):
+    def __init__(self, path, **kwargs):
         """
         :param path: string or callable
+        :param kwargs: passed on to attribute_class
 
         Abstract super class. Subclass and set the class member attribute_class accordingly.
 
@@ -184,6 +808,7 @@ class FileBasedProperty(object):
 
         """
         self.path = path
+        self.kwargs = kwargs
 
     def _get_path(self, instance):
         path = self.path
@@ -201,7 +826,7 @@ class FileBasedProperty(object):
         attribute_name = '__%s' % name
         if not hasattr(instance, attribute_name):
             path = self._get_path(instance)
-            attribute_instance = self.attribute_class(path)
+            attribute_instance = self.attribute_class(path, **self.kwargs)
             setattr(instance, attribute_name, attribute_instance)
         return getattr(instance, attribute_name)
 
@@ -230,13 +855,16 @@ class FileListProperty(FileBasedProperty):
     def __set__(self, instance, value):
         path = self._get_path(instance)
         try:
-            os.unlink(path)
+            remove_file(path)
         except EnvironmentError:
             # ignored
             pass
         attribute_instance = self._get_attribute(instance, instance.__class__)
-        for item in value:
-            attribute_instance.append(item)
+        attribute_instance.extend(value)
+
+
+class FileBitmapProperty(FileBasedProperty):
+    attribute_class = FileBitmap
 
 
 class FileBooleanProperty(FileBasedProperty):
@@ -250,18 +878,18 @@ class FileBooleanProperty(FileBasedProperty):
         if instance is None:
             return self
         path = self._get_path(instance)
-        return os.path.isfile(path)
+        return exists(path)
 
     def __set__(self, instance, value):
         path = self._get_path(instance)
         if value:
             try:
-                open(path, "w").close()
+                write_bytes(path, b'')
             except EnvironmentError as e:
                 raise cinv.Error(str(e))
         else:
             try:
-                os.remove(path)
+                remove_file(path)
             except EnvironmentError:
                 # ignore
                 pass
@@ -277,8 +905,7 @@ class FileStringProperty(FileBasedProperty):
         path = self._get_path(instance)
         value = ""
         try:
-            with open(path, "r") as fd:
-                value = fd.read().rstrip('\n')
+            value = read_file(path)
         except EnvironmentError:
             pass
         return value
@@ -287,12 +914,11 @@ class FileStringProperty(FileBasedProperty):
         path = self._get_path(instance)
         if value:
             try:
-                with open(path, "w") as fd:
-                    fd.write("%s\n" % str(value))
+                write_file(path, "%s\n" % str(value))
             except EnvironmentError as e:
                 raise cinv.Error(str(e))
         else:
             try:
-                os.remove(path)
+                remove_file(path)
             except EnvironmentError:
                 pass
@@ -24,9 +24,12 @@ import argparse
 import logging
 import os.path
 import os
-import shutil
+import types
 
 import cinv
+import cinv.backend
+import cinv.catalog
+import cinv.dump
 from cinv import fsproperty
 
 log = logging.getLogger(__name__)
@@ -36,6 +39,40 @@ HOST_TYPES = ["hw", "vm"]
 class Error(cinv.Error):
     pass
 
+class HostSnapshot(object):
+    """Immutable copy of all attributes of a host, see Host.load()"""
+
+    FILES = ["host_type", "cores", "memory", "vm_host"]
+    DIRECTORIES = ["disk", "nic", "tag"]
+
+    __slots__ = ["fqdn"] + FILES + DIRECTORIES
+
+    def __init__(self, fqdn, **values):
+        object.__setattr__(self, "fqdn", fqdn)
+        for name in self.FILES:
+            object.__setattr__(self, name, values.get(name, ""))
+        for name in self.DIRECTORIES:
+            object.__setattr__(self, name,
+                types.MappingProxyType(dict(values.get(name, {}))))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Host snapshot is read only: %s" % self.fqdn)
+
+    def __str__(self):
+        return self.fqdn
+
+    def __repr__(self):
+        return "<HostSnapshot %s>" % self.fqdn
+
+    def record(self):
+        """Return snapshot as dict (as used by dump)"""
+        record = { "fqdn": self.fqdn }
+        for name in self.FILES:
+            record[name] = getattr(self, name)
+        for name in self.DIRECTORIES:
+            record[name] = dict(getattr(self, name))
+        return record
+
 class Host(object):
 
     ######################################################################
@@ -55,12 +92,13 @@ class Host(object):
 
     def _init_base_dir(self, host_type):
         """Create base directory of host"""
-        try:
-            os.makedirs(self.base_dir, exist_ok=True)
-        except OSError as e:
-            raise Error(e)
+        with cinv.catalog.host_dir_change():
+            try:
+                fsproperty.makedirs(self.base_dir)
+            except OSError as e:
+                raise Error(e)
 
-        self.host_type = host_type
+            self.host_type = host_type
 
     ######################################################################
     # Properties
@@ -133,48 +171,128 @@ class Host(object):
     def get_base_dir(fqdn):
         return os.path.join(cinv.get_base_dir("db"), "host", fqdn)
 
+    @staticmethod
+    def host_matches(base_dir, host_type=None, tags=[]):
+        """Check whether the host stored in base_dir has type and all tags"""
+
+        if host_type:
+            try:
+                if fsproperty.read_file(os.path.join(base_dir, "host_type")) != host_type:
+                    return False
+            except EnvironmentError:
+                return False
+
+        # Only show hosts matching all tags (but can contain other tags)
+        for tag in tags:
+            if not fsproperty.exists(os.path.join(base_dir, "tag", tag)):
+                return False
+
+        return True
+
     @classmethod
-    def host_list(cls, host_type=None, tags=[]):
-        hosts = []
+    def host_iter(cls, host_type=None, tags=[], workers=1):
+        """Yield names of hosts matching type and tags
+
+        The host directory is scanned once and filters are applied
+        while scanning, reusing the type of each entry found by the
+        scan. With workers > 1 the per host checks are spread over a
+        pool of threads.
+        """
 
         if host_type:
-            if host_type not in HOST_TYPES:
-                raise Error("Host type must be one of %s" % (" ".join(HOST_TYPES)))
+            cls.validate_host_type(host_type)
+
+        catalog = cinv.catalog.Catalog.open()
+        if catalog and catalog.fresh():
+            yield from catalog.host_list(host_type, tags)
+            return
 
         base_dir = os.path.join(cinv.get_base_dir("db"), "host")
 
-        if not os.path.isdir(base_dir):
-            return []
+        try:
+            entries = [entry for entry in fsproperty.scandir(base_dir)
+                if entry.is_dir]
+        except FileNotFoundError:
+            return
+
+        if not host_type and not tags:
+            for entry in entries:
+                yield entry.name
+            return
+
+        def match(entry):
+            return cls.host_matches(entry.path, host_type, tags)
+
+        if workers > 1:
+            import concurrent.futures
+
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                for entry, matches in zip(entries, executor.map(match, entries)):
+                    if matches:
+                        yield entry.name
+        else:
+            for entry in entries:
+                if match(entry):
+                    yield entry.name
 
-        for entry in os.listdir(base_dir):
-            if host_type:
-                host = cls(entry)
-                if host.host_type == host_type:
-                    hosts.append(entry)
-            else:
-                hosts.append(entry)
+    @classmethod
+    def host_list(cls, host_type=None, tags=[], workers=1):
+        return list(cls.host_iter(host_type, tags, workers))
 
-        # Only show hosts matching all tags (but can contain other tags)
-        if len(tags) > 0:
-            hosts_with_tags = []
+    @classmethod
+    def load(cls, fqdn):
+        """Read all attributes of a host in one pass into a HostSnapshot"""
+        try:
+            values = cinv.catalog.read_host(fqdn)
+        except FileNotFoundError:
+            raise Error("Host does not exist: %s" % fqdn)
 
-            for host in hosts:
-                host_object = cls(host)
-                has_tags = True
-                for tag in tags:
-                    if not tag in host_object.tag.keys():
-                        has_tags = False
-                        break
-                if has_tags:
-                    hosts_with_tags.append(host)
+        return HostSnapshot(fqdn, **values)
 
-            hosts = hosts_with_tags
+    def snapshot(self):
+        return self.load(self.fqdn)
 
-        return hosts
+    @classmethod
+    def load_many(cls, fqdns=None, host_type=None, tags=[], workers=1):
+        """Yield snapshots of the given or all matching hosts
+
+        Snapshots are taken from the catalog if it is fresh, else
+        from the filesystem, optionally using a pool of threads.
+        """
+        if fqdns is None:
+            fqdns = cls.host_iter(host_type, tags, workers)
+
+        catalog = cinv.catalog.Catalog.open()
+        if catalog and catalog.fresh():
+            for fqdn in fqdns:
+                record = catalog.host_record(fqdn)
+                if record is None:
+                    raise Error("Host does not exist: %s" % fqdn)
+                yield HostSnapshot(fqdn, **record)
+            return
+
+        if workers > 1:
+            import concurrent.futures
+
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                yield from executor.map(cls.load, list(fqdns))
+        else:
+            for fqdn in fqdns:
+                yield cls.load(fqdn)
+
+    DUMP_FIELDS = ["fqdn", "host_type", "cores", "memory", "vm_host",
+        "tag", "disk", "nic"]
+
+    @classmethod
+    def dump_records(cls, host_type=None, tags=[], workers=1):
+        """Yield one record per host"""
+        for host in cls.load_many(host_type=host_type, tags=tags,
+                workers=workers):
+            yield host.record()
 
     @classmethod
     def exists(cls, fqdn):
-        return os.path.exists(cls.get_base_dir(fqdn))
+        return fsproperty.isdir(cls.get_base_dir(fqdn))
 
     @classmethod
     def exists_or_raise_error(cls, fqdn):
@@ -273,7 +391,8 @@ class Host(object):
         else:
             hosts = args.fqdn
 
-        cinv.backend_exec("host", "apply", hosts)
+        cinv.backend.apply("host", hosts, args.targets_via, args.chunk_size,
+            args.jobs)
 
     @classmethod
     def commandline_cores_get(cls, args):
@@ -308,7 +427,10 @@ class Host(object):
                 raise Error("Cannot delete, host contains disk or nic: %s" % args.fqdn)
 
         log.debug("Removing %s ..." % host.base_dir)
-        shutil.rmtree(host.base_dir)
+        with cinv.catalog.host_dir_change() as catalog:
+            fsproperty.rmtree(host.base_dir)
+            if catalog:
+                catalog.host_remove(args.fqdn)
 
         cinv.backend_exec("host", "del", [args.fqdn])
 
@@ -349,9 +471,14 @@ class Host(object):
         print(size)
 
 
+    @classmethod
+    def commandline_dump(cls, args):
+        cinv.dump.write(cls.dump_records(args.type, args.tags, args.jobs),
+            cls.DUMP_FIELDS, args.format)
+
     @classmethod
     def commandline_list(cls, args):
-        for host in cls.host_list(args.type, args.tags):
+        for host in cls.host_iter(args.type, args.tags, args.jobs):
             print(host)
 
     @classmethod
@@ -498,15 +625,18 @@ class Host(object):
 
     @classmethod
     def vmhosts_vms_list(cls, tags=[]):
+        catalog = cinv.catalog.Catalog.open()
+        if catalog and catalog.fresh():
+            return catalog.vm_host_list(tags)
+
         vm_hosts = {}
-        for fqdn in cls.host_list(tags=tags):
-            host = cls(fqdn)
+        for host in cls.load_many(tags=tags):
             if host.vm_host:
                 # Create new array, if not already existing
                 if host.vm_host not in vm_hosts:
                     vm_hosts[host.vm_host] = []
 
-                vm_hosts[host.vm_host].append(fqdn)
+                vm_hosts[host.vm_host].append(host.fqdn)
         
         return vm_hosts
 
@@ -583,11 +713,24 @@ class Host(object):
         parser['disk-list'].add_argument('fqdn', help='Host name')
         parser['disk-list'].set_defaults(func=cls.commandline_disk_list)
 
+        parser['dump'] = parser['sub'].add_parser('dump', parents=parents,
+            help="Dump all attributes of hosts")
+        parser['dump'].add_argument('-t', '--type', help='Host Type',
+            choices=HOST_TYPES, required=False)
+        parser['dump'].add_argument('-T', '--tags', help='Host containing tag', action='append',
+            default=[], required=False)
+        parser['dump'].add_argument('-j', '--jobs', help='Read hosts using JOBS threads',
+            type=int, default=1, required=False)
+        cinv.dump.add_format_argument(parser['dump'])
+        parser['dump'].set_defaults(func=cls.commandline_dump)
+
         parser['list'] = parser['sub'].add_parser('list', parents=parents)
         parser['list'].add_argument('-t', '--type', help='Host Type',
             choices=HOST_TYPES, required=False)
         parser['list'].add_argument('-T', '--tags', help='Host containing tag', action='append',
             default=[], required=False)
+        parser['list'].add_argument('-j', '--jobs', help='Check hosts using JOBS threads',
+            type=int, default=1, required=False)
         parser['list'].set_defaults(func=cls.commandline_list)
 
 
@@ -666,4 +809,5 @@ class Host(object):
             action='store_true')
         parser['apply'].add_argument('-t', '--type', help='Host Type (implies --all)',
             choices=HOST_TYPES, required=False)
+        cinv.backend.add_apply_arguments(parser['apply'])
         parser['apply'].set_defaults(func=cls.commandline_apply)
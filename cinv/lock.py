@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2012-2014 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import fcntl
+import logging
+import os
+import os.path
+import threading
+import time
+
+import cinv
+
+log = logging.getLogger(__name__)
+
+class Error(cinv.Error):
+    pass
+
+# Off while changes are not persistent (f.i. --dry-run), see set_enabled()
+_enabled = True
+
+def set_enabled(enabled):
+    """Take real locks or only track them, return the previous setting"""
+    global _enabled
+    previous, _enabled = _enabled, enabled
+    return previous
+
+class Lock(object):
+    """Exclusive lock of one resource, f.i. Lock("net-ipv4", "10.0.0.0")
+
+    Every resource has its own lock file below ~/.cinv/lock, so
+    allocations in different networks do not wait for each other.
+    Locks are reentrant within a thread. Other threads open the lock
+    file again, so flock() makes them wait like other processes.
+    While locking is disabled, no lock file is opened.
+    """
+
+    # (thread, path) -> [file descriptor or None, depth]
+    _held = {}
+
+    def __init__(self, *name):
+        self.path = os.path.join(cinv.get_base_dir("lock"), *name)
+        self.key = (threading.get_ident(), self.path)
+
+    def held(self):
+        """Return a token of the current acquisition, None if not held"""
+        return self._held.get(self.key)
+
+    def __enter__(self):
+        if self.key in self._held:
+            self._held[self.key][1] += 1
+            return self
+
+        if not _enabled:
+            self._held[self.key] = [None, 1]
+            return self
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            raise Error("Cannot open lock %s: %s" % (self.path, e))
+
+        start = time.monotonic()
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError as e:
+            os.close(fd)
+            raise Error("Cannot lock %s: %s" % (self.path, e))
+
+        log.debug("Locked %s after waiting %.3fs" % (self.path,
+            time.monotonic() - start))
+
+        self._held[self.key] = [fd, 1]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        held = self._held[self.key]
+        held[1] -= 1
+
+        if held[1] == 0:
+            del self._held[self.key]
+            if held[0] is not None:
+                fcntl.flock(held[0], fcntl.LOCK_UN)
+                os.close(held[0])
@@ -27,10 +27,14 @@ import os
 import re
 
 import cinv
+import cinv.lock
 from cinv import fsproperty
 
 log = logging.getLogger(__name__)
 
+# Largest suffix (lower 3 bytes) of an address
+SUFFIX_MAX = 0xffffff
+
 class Error(cinv.Error):
     pass
 
@@ -40,12 +44,13 @@ class Mac(object):
         self.base_dir = self.get_base_dir()
 
     _prefix = fsproperty.FileStringProperty(lambda obj: os.path.join(obj.base_dir, "prefix"))
-    free    = fsproperty.FileListProperty(lambda obj: os.path.join(obj.base_dir, "free"))
+    # Free list of earlier versions, moved into the free pools on first use
+    _free_list = fsproperty.FileListProperty(lambda obj: os.path.join(obj.base_dir, "free"))
     last    = fsproperty.FileStringProperty(lambda obj: os.path.join(obj.base_dir, "last"))
 
     def _init_base_dir(self):
         try:
-            os.makedirs(self.base_dir, exist_ok=True)
+            fsproperty.makedirs(self.base_dir)
         except OSError as e:
             raise Error(e)
 
@@ -54,12 +59,115 @@ class Mac(object):
         if not re.match(r'([0-9A-F]{2}[-:]){5}[0-9A-F]{2}$', mac, re.I):
             raise Error("Not a valid mac address: %s" % mac)
 
+    @staticmethod
+    def mac_split(mac):
+        """Return (prefix, suffix) of mac, prefix lower case with colons"""
+        mac = mac.lower().replace("-", ":")
+        return mac[:8], int(mac[9:].replace(":", ""), 16)
+
+    ######################################################################
+    # Free addresses: one bitmap of free suffixes per prefix
+    #
+
+    @property
+    def free_pool_dir(self):
+        return os.path.join(self.base_dir, "free-pool")
+
+    def free_pool(self, prefix):
+        return fsproperty.FileBitmap(os.path.join(self.free_pool_dir, prefix))
+
+    def free_pools(self):
+        """Return list of (prefix, pool), the current prefix first"""
+        self._free_migrate()
+
+        try:
+            prefixes = sorted(fsproperty.listdir(self.free_pool_dir))
+        except FileNotFoundError:
+            return []
+
+        current = self.prefix.lower().replace("-", ":")
+        prefixes.sort(key=lambda prefix: prefix != current)
+
+        return [(prefix, self.free_pool(prefix)) for prefix in prefixes]
+
+    def _free_migrate(self):
+        """Move the addresses of the old free list into the pools"""
+        if not fsproperty.exists(self._free_list.path):
+            return
+
+        with cinv.lock.Lock("mac"):
+            if not fsproperty.exists(self._free_list.path):
+                return
+
+            addresses = list(self._free_list)
+            log.info("Moving %d free addresses into %s" % (len(addresses),
+                self.free_pool_dir))
+
+            with fsproperty.transaction():
+                self._free_add(addresses, ignore_duplicates=True)
+                fsproperty.remove_file(self._free_list.path)
+
+    def _free_add(self, addresses, ignore_duplicates=False):
+        pools = {}
+        duplicates = []
+
+        for address in addresses:
+            prefix, suffix = self.mac_split(address)
+            suffixes = pools.setdefault(prefix, set())
+            if suffix in suffixes:
+                duplicates.append(address)
+            suffixes.add(suffix)
+
+        for prefix, suffixes in pools.items():
+            duplicates.extend([self.mac_format(prefix, suffix) for suffix in
+                self.free_pool(prefix).get_many(suffixes)])
+
+        if duplicates and not ignore_duplicates:
+            raise Error("%d mac(s) already in free database: %s" % (
+                len(duplicates), " ".join(sorted(duplicates)[:10])))
+
+        try:
+            fsproperty.makedirs(self.free_pool_dir)
+        except OSError as e:
+            raise Error(e)
+
+        with fsproperty.transaction():
+            for prefix, suffixes in pools.items():
+                self.free_pool(prefix).set_many(suffixes)
+
+    def free_add(self, addresses):
+        """Add addresses to the free pools, all or none of them"""
+        for address in addresses:
+            self.validate_mac(address)
+
+        with cinv.lock.Lock("mac"):
+            self._free_migrate()
+            self._free_add(addresses)
+
     def free_append(self, mac):
-        if mac in self.free:
-            raise Error("Mac already in free database: %s" % mac)
+        self.free_add([mac])
 
-        self._init_base_dir()
-        self.free.append(mac)
+    def free_take(self, count):
+        """Remove and return up to count free addresses (lowest first)"""
+        addresses = []
+
+        with cinv.lock.Lock("mac"):
+            for prefix, pool in self.free_pools():
+                if len(addresses) >= count:
+                    break
+                addresses.extend([self.mac_format(prefix, suffix) for suffix
+                    in pool.pop_first(count - len(addresses))])
+
+        return addresses
+
+    def free_count(self):
+        return sum([pool.count() for prefix, pool in self.free_pools()])
+
+    def free_list(self):
+        """Yield all free addresses"""
+        for prefix, pool in self.free_pools():
+            for suffix in pool:
+                yield self.mac_format(prefix, suffix)
 
     @staticmethod
     def get_base_dir():
@@ -67,37 +175,63 @@ class Mac(object):
 
     @classmethod
     def exists(cls):
-        return os.path.exists(cls.get_base_dir())
+        return fsproperty.isdir(cls.get_base_dir())
+
+    @staticmethod
+    def mac_suffix(mac):
+        """Return the lower 3 bytes of mac as integer"""
+        return int(mac[-8:].replace(":", "").replace("-", ""), 16)
+
+    @staticmethod
+    def mac_format(prefix, suffix):
+        return "%s:%02x:%02x:%02x" % (prefix, suffix >> 16,
+            (suffix >> 8) & 0xff, suffix & 0xff)
 
     def get_next(self):
-        self._init_base_dir()
+        return self.reserve(1)[0]
 
-        if self.free:
-            return self.free.pop()
-            
-        if not self.prefix:
-            raise Error("Cannot generate address without prefix - use prefix-set")
+    def reserve(self, count):
+        """Return count addresses, taken from the free pools first
+
+        The remaining addresses are a contiguous block following last,
+        which is updated only once.
+        """
+        if count < 1:
+            raise Error("Number of addresses must be at least 1")
 
-        if self.last:
-            suffix = re.search(r'([0-9A-F]{2}[-:]){2}[0-9A-F]{2}$', self.last, re.I)
-            last_number_hex = "0x%s" % suffix.group().replace(":", "")
-            last_number = int(last_number_hex, 16)
+        with cinv.lock.Lock("mac"):
+            self._init_base_dir()
 
-            if last_number == int('0xffffff', 16):
-                raise Error("Exhausted all possible mac addresses - try to free some")
+            addresses = self.free_take(count)
 
-            next_number = last_number + 1
-        else:
-            next_number = 0
+            if len(addresses) < count:
+                try:
+                    addresses.extend(self.allocate(count - len(addresses)))
+                except Error:
+                    # Give back what was taken from the free pools
+                    if addresses:
+                        self._free_add(addresses)
+                    raise
 
-        next_number_hex = "%0.6x" % next_number
-        next_suffix = "%s:%s:%s" % (next_number_hex[0:2], next_number_hex[2:4], next_number_hex[4:6])
+            return addresses
 
-        next_mac = "%s:%s" % (self.prefix, next_suffix)
+    def allocate(self, count):
+        """Return count new addresses after last"""
+        prefix = self.prefix
+        if not prefix:
+            raise Error("Cannot generate address without prefix - use prefix-set")
 
-        self.last = next_mac
+        last = self.last
+        first = self.mac_suffix(last) + 1 if last else 0
 
-        return next_mac
+        if first + count - 1 > SUFFIX_MAX:
+            raise Error("Exhausted all possible mac addresses - try to free some")
+
+        addresses = [self.mac_format(prefix, suffix)
+            for suffix in range(first, first + count)]
+        self.last = addresses[-1]
+
+        return addresses
 
 
     @property
@@ -115,19 +249,30 @@ class Mac(object):
     @classmethod
     def commandline_generate(cls, args):
         mac = Mac()
-        print(mac.get_next())
+        for address in mac.reserve(args.number):
+            print(address)
 
     @classmethod
     def commandline_free_add(cls, args):
+        addresses = list(args.address)
+        if args.file:
+            with args.file:
+                addresses.extend([line.strip() for line in args.file
+                    if line.strip() and not line.startswith("#")])
+
+        if not addresses:
+            raise Error("No addresses given - pass them as arguments or in a file")
+
         mac = Mac()
-        mac.validate_mac(args.address)
-        mac.free_append(args.address)
+        mac.free_add(addresses)
+
+        log.info("Added %d addresses to the free database" % len(addresses))
 
     @classmethod
     def commandline_free_list(cls, args):
         mac = Mac()
-        for mac in mac.free:
-            print(mac)
+        for address in mac.free_list():
+            print(address)
 
     @classmethod
     def commandline_prefix_set(cls, args):
@@ -152,7 +297,10 @@ class Mac(object):
         parser['sub'] = parent_parser.add_subparsers(title="Mac Commands")
 
         parser['free-add'] = parser['sub'].add_parser('free-add', parents=parents)
-        parser['free-add'].add_argument('address', help='Address to add to free database')
+        parser['free-add'].add_argument('address', nargs='*',
+            help='Addresses to add to free database')
+        parser['free-add'].add_argument('-f', '--file', type=argparse.FileType('r'),
+            help='Read addresses from file, one per line (- for stdin)')
         parser['free-add'].set_defaults(func=cls.commandline_free_add)
 
         parser['free-list'] = parser['sub'].add_parser('free-list', parents=parents,
@@ -160,6 +308,8 @@ class Mac(object):
         parser['free-list'].set_defaults(func=cls.commandline_free_list)
 
         parser['generate'] = parser['sub'].add_parser('generate', parents=parents)
+        parser['generate'].add_argument('-n', '--number', type=int, default=1,
+            help='Number of addresses to generate (default: 1)')
         parser['generate'].set_defaults(func=cls.commandline_generate)
 
         parser['prefix-get'] = parser['sub'].add_parser('prefix-get', parents=parents)
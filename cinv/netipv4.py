@@ -21,25 +21,65 @@
 #
 #
 
+import argparse
 import logging
 import os.path
 import os
 import re
-import shutil
 import socket
 import struct
+import sys
 
 import cinv
+import cinv.backend
+import cinv.dump
+import cinv.lock
 import cinv.mac
 from cinv import fsproperty
 
 log = logging.getLogger(__name__)
 
+# reserved: infrastructure, never handed out automatically
+# dynamic: DHCP pool, never handed out to hosts at all
+# static: only used if explicitly requested via its name
+RANGE_KINDS = ["reserved", "dynamic", "static"]
+
+ALLOCATION_POLICIES = ["bottom-up", "top-down"]
+
 
 class Error(cinv.Error):
     pass
 
 
+def intervals_merge(intervals):
+    """Return sorted (first, last) intervals with overlapping ones joined"""
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def intervals_subtract(first, last, excluded):
+    """Return the parts of [first, last] not covered by merged intervals"""
+    remaining = []
+    for start, end in excluded:
+        if end < first:
+            continue
+        if start > last:
+            break
+        if start > first:
+            remaining.append((first, start - 1))
+        first = end + 1
+
+    if first <= last:
+        remaining.append((first, last))
+
+    return remaining
+
+
 class NetIPv4(object):
 
     def __init__(self, network):
@@ -50,10 +90,21 @@ class NetIPv4(object):
         self.base_dir = self.get_base_dir(network)
         self.network = network
 
+        # Lock acquisition of the last hosts_check()
+        self._hosts_checked = None
+
     _mask = fsproperty.FileStringProperty(
         lambda obj: os.path.join(obj.base_dir, "mask"))
     address = fsproperty.DirectoryDictProperty(
         lambda obj: os.path.join(obj.base_dir, 'address'))
+    address_map = fsproperty.FileBitmapProperty(
+        lambda obj: os.path.join(obj.base_dir, "address_map"))
+    ipv4_address_index = fsproperty.DirectoryDictProperty(
+        lambda obj: os.path.join(obj.base_index_dir, "ipv4_address"))
+    mac_address_index = fsproperty.DirectoryDictProperty(
+        lambda obj: os.path.join(obj.base_index_dir, "mac_address"))
+    _host_dir_stamp = fsproperty.FileStringProperty(
+        lambda obj: os.path.join(obj.base_dir, "host_dir_stamp"))
 
     bootserver = fsproperty.FileStringProperty(
         lambda obj: os.path.join(obj.base_dir, "bootserver"))
@@ -61,13 +112,18 @@ class NetIPv4(object):
         lambda obj: os.path.join(obj.base_dir, "bootfilename"))
     router = fsproperty.FileStringProperty(
         lambda obj: os.path.join(obj.base_dir, "router"))
+    allocation = fsproperty.FileStringProperty(
+        lambda obj: os.path.join(obj.base_dir, "allocation"))
+    _range = fsproperty.FileListProperty(
+        lambda obj: os.path.join(obj.base_dir, "range"))
 
     def _init_base_dir(self, mask):
         """Create base directory"""
 
         try:
-            os.makedirs(self.base_dir, exist_ok=True)
-            os.makedirs(self.base_host_dir, exist_ok=True)
+            fsproperty.makedirs(self.base_dir)
+            fsproperty.makedirs(self.base_host_dir)
+            fsproperty.makedirs(self.base_index_dir)
         except OSError as e:
             raise Error(e)
 
@@ -77,6 +133,10 @@ class NetIPv4(object):
     def base_host_dir(self):
         return os.path.join(self.base_dir, "host")
 
+    @property
+    def base_index_dir(self):
+        return os.path.join(self.base_dir, "index")
+
     @staticmethod
     def network_split(network):
         return network.split('/')
@@ -143,7 +203,7 @@ class NetIPv4(object):
 
         base_dir = os.path.join(cinv.get_base_dir("db"), "net-ipv4")
 
-        for entry in os.listdir(base_dir):
+        for entry in fsproperty.listdir(base_dir):
             # With or without the mask is the question...
             # network = cls(entry)
             # networks.append("%s/%s" % (entry, network.mask))
@@ -153,7 +213,7 @@ class NetIPv4(object):
 
     @classmethod
     def exists(cls, network):
-        return os.path.exists(cls.get_base_dir(network))
+        return fsproperty.isdir(cls.get_base_dir(network))
 
     @staticmethod
     def ipv4_address_decimal(ipv4_address):
@@ -196,6 +256,15 @@ class NetIPv4(object):
         return socket.inet_ntoa(
             struct.pack('>L', (1 << 32) - (1 << (32 - int(self.mask)))))
 
+    @property
+    def size(self):
+        """ Return number of addresses in the network """
+        return 1 << (32 - int(self.mask))
+
+    def ipv4_address_offset(self, ipv4_address):
+        """ Return position of the address inside the network """
+        return self.ipv4_address_decimal(ipv4_address) - self.network_decimal()
+
     def ipv4_address_belongs_to_network(self, ipv4_address):
         return self.network == self.map_ipv4_address_to_network_address(
             ipv4_address)
@@ -204,63 +273,235 @@ class NetIPv4(object):
         return self.network == self.map_ipv4_address_to_network_address(
             ipv4_address)
 
-    def host_add(self, fqdn, mac_address, ipv4_address=None):
+    def host_add(self, fqdn, mac_address, ipv4_address=None, policy=None,
+                 range_name=None):
         """ Add a host to the network"""
 
-        # Ensure given mac address is valid
-        cinv.mac.Mac.validate_mac(mac_address)
+        with cinv.lock.Lock("net-ipv4", self.network):
+            # Ensure given mac address is valid
+            cinv.mac.Mac.validate_mac(mac_address)
 
-        if self.host_exists(fqdn):
-            raise Error("Host %s exists already in network %s" % (
-                fqdn, self.network))
+            if self.host_exists(fqdn):
+                raise Error("Host %s exists already in network %s" % (
+                    fqdn, self.network))
 
-        mac_address_used = self.mac_address_used(mac_address)
-        if mac_address_used:
-            raise Error("Mac %s already used in network %s by %s" % (
-                mac_address, self.network, mac_address_used))
+            mac_address_used = self.mac_address_used(mac_address)
+            if mac_address_used:
+                raise Error("Mac %s already used in network %s by %s" % (
+                    mac_address, self.network, mac_address_used))
 
-        # Adresse given from outside
-        if ipv4_address:
-            if not self.ipv4_address_belongs_to_network(ipv4_address):
-                raise Error("Requested IPv4 address not in network: %s/%s" % (
-                    self.network, ipv4_address))
+            # Adresse given from outside
+            if ipv4_address:
+                if not self.ipv4_address_belongs_to_network(ipv4_address):
+                    raise Error("Requested IPv4 address not in network: %s/%s" % (
+                        self.network, ipv4_address))
 
-            ipv4_address_used = self.ipv4_address_used(ipv4_address)
-            if ipv4_address_used:
-                raise Error("IPv4 address %s already used in network %s by %s"
-                            % (ipv4_address, self.network, ipv4_address_used))
+                ipv4_address_used = self.ipv4_address_used(ipv4_address)
+                if ipv4_address_used:
+                    raise Error("IPv4 address %s already used in network %s by %s"
+                                % (ipv4_address, self.network, ipv4_address_used))
 
-        else:
-            ipv4_address = self.get_next_ipv4_address()
+                self.dynamic_range_check(ipv4_address)
 
-        self.host_create(fqdn)
-        self.host_mac_address_set(fqdn, mac_address)
-        self.host_ipv4_address_set(fqdn, ipv4_address)
+            else:
+                ipv4_address = self.get_next_ipv4_address(policy, range_name)
 
-        return ipv4_address
+            # Validate the map before we change the host directory
+            self.address_map_check()
 
-    def host_del(self, fqdn):
-        """ Remove a host from the network"""
+            self.host_create(fqdn)
 
-        if not self.host_exists(fqdn):
-            raise Error("Host %s does not exist in network %s" % (
-                fqdn, self.network))
+            # Write host, address map and indexes as one batch
+            try:
+                with fsproperty.transaction():
+                    self.host_mac_address_set(fqdn, mac_address)
+                    self.host_ipv4_address_set(fqdn, ipv4_address)
 
-        ipv4_address = self.host_ipv4_address_get(fqdn)
-        log.debug("Removing host %s with ipv4 address %s" % (
-            fqdn, ipv4_address))
+                    self.address_map.set(self.ipv4_address_offset(ipv4_address))
+                    self.ipv4_address_index[ipv4_address] = fqdn
+                    self.mac_address_index[mac_address] = fqdn
+            except BaseException:
+                # Do not leave a half created host behind
+                fsproperty.rmtree(self.host_dir(fqdn), ignore_errors=True)
+                raise
+
+            self.host_dir_stamp_record()
+
+            return ipv4_address
+
+    def host_del(self, fqdn):
+        """ Remove a host from the network"""
 
-        shutil.rmtree(self.host_dir(fqdn))
+        with cinv.lock.Lock("net-ipv4", self.network):
+            if not self.host_exists(fqdn):
+                raise Error("Host %s does not exist in network %s" % (
+                    fqdn, self.network))
+
+            ipv4_address = self.host_ipv4_address_get(fqdn)
+            mac_address = self.host_mac_address_get(fqdn)
+            log.debug("Removing host %s with ipv4 address %s" % (
+                fqdn, ipv4_address))
+
+            self.address_map_check()
+            self.index_check()
+
+            fsproperty.rmtree(self.host_dir(fqdn))
+
+            with fsproperty.transaction():
+                self.address_map.clear(self.ipv4_address_offset(ipv4_address))
+                for index, key in ((self.ipv4_address_index, ipv4_address),
+                                   (self.mac_address_index, mac_address)):
+                    if index.get(key) == fqdn:
+                        del index[key]
+
+            self.host_dir_stamp_record()
+
+    # Field names accepted by host_add_bulk besides those of dump
+    BULK_ALIASES = { "mac": "mac_address", "ipv4": "ipv4_address" }
+    BULK_FIELDS = ["fqdn", "ipv4_address", "mac_address"]
+
+    def host_add_bulk(self, records, strict=False, policy=None,
+                      range_name=None):
+        """Add many hosts, return one result per record
+
+        Records are dicts with fqdn, mac_address and optionally
+        ipv4_address. The network is scanned once, all records are
+        checked and allocated in memory and the valid ones are written
+        in one transaction. With strict nothing is written if any
+        record is invalid. Addresses are allocated like
+        get_next_ipv4_address does.
+
+        Results are dicts with fqdn, ipv4_address, mac_address and
+        error (None if the host was added).
+        """
+        with cinv.lock.Lock("net-ipv4", self.network):
+            self.address_map_check()
+            self.index_check()
+
+            fqdns = set(self.host_list())
+            mac_addresses = set(self.mac_address_index)
+            used = set(self.address_map)
+            policy = self.allocation_policy(policy)
+            intervals = self.allocation_intervals(policy, range_name)
+            dynamic = self.range_intervals(["dynamic"])
+
+            results = []
+            for record in records:
+                record = dict((self.BULK_ALIASES.get(key, key), value)
+                    for key, value in record.items())
+                result = dict((field, record.get(field) or "")
+                    for field in self.BULK_FIELDS)
+                result["error"] = None
+                results.append(result)
+
+                fqdn = result["fqdn"]
+                mac_address = result["mac_address"]
+                ipv4_address = result["ipv4_address"]
+
+                try:
+                    for field in self.BULK_FIELDS:
+                        if not isinstance(result[field], str):
+                            raise Error("%s must be a string, not %r" % (
+                                field, result[field]))
+
+                    if not fqdn:
+                        raise Error("fqdn missing")
+                    if fqdn in fqdns:
+                        raise Error("Host %s exists already in network %s" % (
+                            fqdn, self.network))
+
+                    cinv.mac.Mac.validate_mac(mac_address)
+                    if mac_address in mac_addresses:
+                        raise Error("Mac %s already used in network %s" % (
+                            mac_address, self.network))
+
+                    if ipv4_address:
+                        if not (self.validate_ipv4address(ipv4_address) and
+                                self.ipv4_address_belongs_to_network(ipv4_address)):
+                            raise Error("Requested IPv4 address not in network: %s/%s" % (
+                                self.network, ipv4_address))
+
+                        offset = self.ipv4_address_offset(ipv4_address)
+                        if offset in used:
+                            raise Error("IPv4 address %s already used in network %s"
+                                % (ipv4_address, self.network))
+                        if any(start <= offset <= end for start, end in dynamic):
+                            raise Error("IPv4 address %s is in a dynamic range "
+                                "of network %s" % (ipv4_address, self.network))
+                        used.add(offset)
+                except cinv.Error as e:
+                    result["error"] = str(e)
+                    continue
+
+                fqdns.add(fqdn)
+                mac_addresses.add(mac_address)
+
+            # Requested addresses are known, hand out the others
+            def free_offsets():
+                for first, last in intervals:
+                    if policy == "top-down":
+                        offsets = range(last, first - 1, -1)
+                    else:
+                        offsets = range(first, last + 1)
+                    for offset in offsets:
+                        if offset not in used:
+                            yield offset
+
+            offsets = free_offsets()
+            for result in results:
+                if result["error"] or result["ipv4_address"]:
+                    continue
+
+                offset = next(offsets, None)
+                if offset is None:
+                    result["error"] = self.no_free_address(range_name)
+                    continue
+
+                used.add(offset)
+                result["ipv4_address"] = self.ipv4_address_dotted_quad(
+                    self.network_decimal() + offset)
+
+            added = [result for result in results if not result["error"]]
+            if not added or (strict and len(added) < len(results)):
+                return results
+
+            try:
+                for result in added:
+                    self.host_create(result["fqdn"])
+
+                with fsproperty.transaction():
+                    for result in added:
+                        self.host_mac_address_set(result["fqdn"],
+                            result["mac_address"])
+                        self.host_ipv4_address_set(result["fqdn"],
+                            result["ipv4_address"])
+                        self.ipv4_address_index[result["ipv4_address"]] = result["fqdn"]
+                        self.mac_address_index[result["mac_address"]] = result["fqdn"]
+
+                    self.address_map.set_many([self.ipv4_address_offset(
+                        result["ipv4_address"]) for result in added])
+            except BaseException:
+                # Do not leave half created hosts behind
+                for result in added:
+                    fsproperty.rmtree(self.host_dir(result["fqdn"]),
+                        ignore_errors=True)
+                raise
+
+            self.host_dir_stamp_record()
+
+            log.info("Added %d hosts to network %s" % (len(added), self.network))
+
+            return results
 
     def host_exists(self, fqdn):
         host_path = self.host_dir(fqdn)
 
         log.debug("Checking for host %s at %s" % (fqdn, host_path))
-        return os.path.exists(host_path)
+        return fsproperty.isdir(host_path)
 
     def host_list(self):
         hosts = []
-        for host in os.listdir(self.base_host_dir):
+        for host in fsproperty.listdir(self.base_host_dir):
             hosts.append(host)
 
         return hosts
@@ -270,79 +511,384 @@ class NetIPv4(object):
 
     def host_create(self, host):
         try:
-            os.makedirs(self.host_dir(host))
+            fsproperty.makedirs(self.host_dir(host))
         except OSError as e:
             raise Error(e)
 
     def host_mac_address_get(self, host):
         mac_address_file = os.path.join(self.base_host_dir, host, "mac_address")
 
-        with open(mac_address_file, "r") as fd:
-            return fd.read().rstrip('\n')
+        return fsproperty.read_file(mac_address_file)
 
     def host_mac_address_set(self, host, mac_address):
         mac_address_file = os.path.join(self.base_host_dir, host, "mac_address")
 
-        with open(mac_address_file, "w") as fd:
-            fd.write("%s\n" % mac_address)
+        fsproperty.write_file(mac_address_file, "%s\n" % mac_address)
 
     def host_ipv4_address_get(self, host):
         ipv4_address_file = os.path.join(self.base_host_dir, host,
                                          "ipv4_address")
 
-        with open(ipv4_address_file, "r") as fd:
-            return fd.read().rstrip('\n')
+        return fsproperty.read_file(ipv4_address_file)
 
     def host_ipv4_address_set(self, host, ipv4_address):
         ipv4_address_file = os.path.join(self.base_host_dir,
                                          host, "ipv4_address")
 
-        with open(ipv4_address_file, "w") as fd:
-            fd.write("%s\n" % ipv4_address)
+        fsproperty.write_file(ipv4_address_file, "%s\n" % ipv4_address)
 
     def ipv4_address_used(self, ipv4_address):
+        self.index_check()
+        return self.ipv4_address_index.get(ipv4_address)
+
+    def mac_address_used(self, mac_address):
+        self.index_check()
+        return self.mac_address_index.get(mac_address)
+
+    @staticmethod
+    def stamp_string(path):
+        stamp = fsproperty.stamp(path)
+        if stamp is None:
+            return "-"
+        return "%d:%d:%d" % stamp
+
+    def host_dir_stamp_record(self):
+        """Remember the host directory as left by cinv"""
+        self._host_dir_stamp = self.stamp_string(self.base_host_dir)
+
+    def hosts_changed(self):
+        """Check whether hosts were added or removed without cinv
+
+        After every change cinv records the stamp (mtime in ns, size,
+        identity) of the host directory, any other stamp means hosts
+        were added or removed behind our back. This costs one stat and
+        one small read. Address files rewritten in place are found by
+        index_verify() and fixed by the rebuild commands.
+        """
+        return self._host_dir_stamp != self.stamp_string(self.base_host_dir)
+
+    def hosts_check(self):
+        """Rebuild address map and indexes if hosts changed without cinv
+
+        While the network is locked, this is done only once.
+        """
+        token = cinv.lock.Lock("net-ipv4", self.network).held()
+        if token is not None and token is self._hosts_checked:
+            return
+
+        if self.hosts_changed():
+            log.debug("Hosts of %s changed outside of cinv" % self.network)
+            self.hosts_rebuild()
+
+        self._hosts_checked = token
+
+    def hosts_rebuild(self):
+        """Recreate address map and indexes from the host directories"""
+        self.address_map_rebuild()
+        self.index_rebuild()
+        self.host_dir_stamp_record()
+
+    def host_addresses(self):
+        """Return dict of fqdn -> (ipv4 address, mac address)"""
+        addresses = {}
         for host in self.host_list():
-            host_ipv4_address = self.host_ipv4_address_get(host)
+            addresses[host] = (self.host_ipv4_address_get(host),
+                               self.host_mac_address_get(host))
+        return addresses
 
-            if host_ipv4_address == ipv4_address:
-                return host
+    def index_rebuild(self):
+        """Recreate the reverse indexes from the host directories"""
+        ipv4_addresses = {}
+        mac_addresses = {}
 
-        return None
+        for host, (ipv4_address, mac_address) in self.host_addresses().items():
+            if ipv4_address in ipv4_addresses:
+                raise Error(("Integrity error: address {0} used more than once"
+                             "".format(ipv4_address)))
+            ipv4_addresses[ipv4_address] = host
 
-    def mac_address_used(self, mac_address):
-        for host in self.host_list():
-            host_mac_address = self.host_mac_address_get(host)
+            if mac_address in mac_addresses:
+                log.warning("Mac %s used by %s and %s in network %s" % (
+                    mac_address, mac_addresses[mac_address], host,
+                    self.network))
+            mac_addresses[mac_address] = host
+
+        log.debug("Rebuilding indexes of %s (%d hosts)" % (
+            self.network, len(ipv4_addresses)))
+
+        try:
+            fsproperty.makedirs(self.base_index_dir)
+        except OSError as e:
+            raise Error(e)
 
-            if host_mac_address == mac_address:
-                return host
+        self.ipv4_address_index = ipv4_addresses
+        self.mac_address_index = mac_addresses
+
+    def index_check(self):
+        """Rebuild the reverse indexes if they are missing or outdated"""
+        for name in ("ipv4_address", "mac_address"):
+            if not fsproperty.isdir(os.path.join(self.base_index_dir, name)):
+                self.index_rebuild()
+                break
 
-        return None
+        self.hosts_check()
+
+    def index_verify(self):
+        """Return list of differences between indexes and host directories"""
+        drift = []
+
+        expected = { "ipv4_address": {}, "mac_address": {} }
+        for host, (ipv4_address, mac_address) in self.host_addresses().items():
+            expected["ipv4_address"][ipv4_address] = host
+            expected["mac_address"][mac_address] = host
+
+        for name in sorted(expected):
+            if not fsproperty.isdir(os.path.join(self.base_index_dir, name)):
+                drift.append("%s: %s index missing" % (self.network, name))
+                continue
+
+            indexed = dict(getattr(self, "%s_index" % name))
+
+            for key in sorted(set(expected[name]) | set(indexed)):
+                if key not in indexed:
+                    drift.append("%s: %s %s of %s missing in index" % (
+                        self.network, name, key, expected[name][key]))
+                elif key not in expected[name]:
+                    drift.append("%s: %s %s indexed for unknown host %s" % (
+                        self.network, name, key, indexed[key]))
+                elif indexed[key] != expected[name][key]:
+                    drift.append("%s: %s %s indexed for %s, used by %s" % (
+                        self.network, name, key, indexed[key],
+                        expected[name][key]))
+
+        return drift
+
+    DUMP_FIELDS = ["network", "mask", "router", "bootserver", "bootfilename",
+        "fqdn", "ipv4_address", "mac_address"]
+
+    def dump_records(self):
+        """Yield one record per host of the network
+
+        Networks without hosts yield one record with empty host fields,
+        so they are part of the dump as well.
+        """
+        network = {
+            "network": self.network,
+            "mask": self.mask,
+            "router": self.router,
+            "bootserver": self.bootserver,
+            "bootfilename": self.bootfilename,
+        }
 
-    def get_next_ipv4_address(self):
-        """Get next address from network"""
+        try:
+            hosts = fsproperty.listdir(self.base_host_dir)
+        except FileNotFoundError:
+            hosts = []
+
+        if not hosts:
+            record = dict(network)
+            for field in ("fqdn", "ipv4_address", "mac_address"):
+                record[field] = ""
+            yield record
+
+        for host in hosts:
+            record = dict(network)
+            record["fqdn"] = host
+            record["ipv4_address"] = self.host_ipv4_address_get(host)
+            record["mac_address"] = self.host_mac_address_get(host)
+            yield record
+
+    def address_map_rebuild(self):
+        """Recreate the allocation map from the host directories"""
         used_addrs = set()
 
         # Scan used addresses and also check for integrity:
         # each address is used at most once.
         for host in self.host_list():
             host_ipv4_address = self.host_ipv4_address_get(host)
-            addr_decimal = self.ipv4_address_decimal(host_ipv4_address)
-            if addr_decimal in used_addrs:
+            offset = self.ipv4_address_offset(host_ipv4_address)
+            if offset in used_addrs:
                 raise Error(("Integrity error: address {0} used more than once"
                              "".format(host_ipv4_address)))
             else:
-                used_addrs.add(addr_decimal)
+                used_addrs.add(offset)
+
+        # Network and broadcast address are never handed out
+        size = self.size
+        used_addrs.add(0)
+        used_addrs.add(size - 1)
+
+        log.debug("Rebuilding address map of %s (%d used)" % (
+            self.network, len(used_addrs)))
+
+        self.address_map.reset(size, used_addrs)
+
+    def address_map_check(self):
+        """Rebuild the allocation map if it is missing or outdated
+
+        The map is outdated, if hosts were added or removed
+        without updating it (f.i. by manual db manipulation).
+        """
+        if not fsproperty.exists(self.address_map.path):
+            self.address_map_rebuild()
+
+        self.hosts_check()
+
+    def ranges(self):
+        """Return dict of range name -> (kind, first, last address)"""
+        ranges = {}
+        for line in self._range:
+            fields = line.split()
+            if (len(fields) != 4 or fields[1] not in RANGE_KINDS or
+                    not all([self.validate_ipv4address(ipv4_address)
+                             for ipv4_address in fields[2:]])):
+                raise Error("Invalid range in network %s: %s" % (
+                    self.network, line))
+            name, kind, first, last = fields
+            ranges[name] = (kind, first, last)
+        return ranges
+
+    def range_offsets(self, first, last):
+        return (self.ipv4_address_offset(first),
+                self.ipv4_address_offset(last))
+
+    def range_intervals(self, kinds):
+        """Return merged offset intervals of all ranges of the given kinds"""
+        return intervals_merge([self.range_offsets(first, last)
+            for kind, first, last in self.ranges().values() if kind in kinds])
+
+    def range_add(self, name, first, last, kind="reserved"):
+        """Declare a range of addresses, ranges must not overlap"""
+
+        if not name or len(name.split()) != 1:
+            raise Error("Not a valid range name: %s" % name)
+        if kind not in RANGE_KINDS:
+            raise Error("Range type must be one of %s" % " ".join(RANGE_KINDS))
+
+        for ipv4_address in first, last:
+            if not (self.validate_ipv4address(ipv4_address) and
+                    self.ipv4_address_belongs_to_network(ipv4_address)):
+                raise Error("Range address not in network: %s/%s" % (
+                    self.network, ipv4_address))
+
+        start, end = self.range_offsets(first, last)
+        if start > end:
+            raise Error("Range %s starts after it ends: %s > %s" % (name,
+                first, last))
+
+        with cinv.lock.Lock("net-ipv4", self.network):
+            ranges = self.ranges()
+            if name in ranges:
+                raise Error("Range %s exists already in network %s" % (name,
+                    self.network))
+
+            for other, (other_kind, other_first, other_last) in ranges.items():
+                other_start, other_end = self.range_offsets(other_first,
+                                                            other_last)
+                if start <= other_end and other_start <= end:
+                    raise Error("Range %s overlaps range %s (%s-%s)" % (name,
+                        other, other_first, other_last))
+
+            self._range.append("%s %s %s %s" % (name, kind, first, last))
+
+            if kind != "static":
+                # Hosts keep their addresses, only new ones avoid the range
+                self.address_map_check()
+                used = self.address_map.get_many(range(start, end + 1))
+                if used:
+                    log.warning("%d addresses of %s range %s are in use "
+                        "already" % (len(used), kind, name))
+
+    def range_del(self, name):
+        with cinv.lock.Lock("net-ipv4", self.network):
+            if name not in self.ranges():
+                raise Error("Range %s does not exist in network %s" % (name,
+                    self.network))
+
+            self._range = [line for line in self._range
+                           if line.split()[0] != name]
+
+    def dynamic_range_check(self, ipv4_address):
+        """Refuse addresses handed out by DHCP"""
+        offset = self.ipv4_address_offset(ipv4_address)
+        for name, (kind, first, last) in self.ranges().items():
+            start, end = self.range_offsets(first, last)
+            if kind == "dynamic" and start <= offset <= end:
+                raise Error("IPv4 address %s is in dynamic range %s of "
+                    "network %s" % (ipv4_address, name, self.network))
+
+    def allocation_policy(self, policy=None):
+        """Return given policy or the one of the network"""
+        policy = policy or self.allocation or ALLOCATION_POLICIES[0]
+        if policy not in ALLOCATION_POLICIES:
+            raise Error("Allocation policy must be one of %s" % " ".join(
+                ALLOCATION_POLICIES))
+        return policy
+
+    def allocation_intervals(self, policy, range_name=None):
+        """Return intervals of offsets to allocate from, in policy order
+
+        Without range_name all addresses outside of any range are
+        used, otherwise only the ones of the given range.
+        """
+        # Network and broadcast address are never handed out
+        first, last = 1, self.size - 2
+
+        if range_name:
+            ranges = self.ranges()
+            if range_name not in ranges:
+                raise Error("Range %s does not exist in network %s" % (
+                    range_name, self.network))
+
+            kind, range_first, range_last = ranges[range_name]
+            if kind == "dynamic":
+                raise Error("Range %s is dynamic, its addresses are handed "
+                    "out by DHCP" % range_name)
+
+            start, end = self.range_offsets(range_first, range_last)
+            intervals = [(max(first, start), min(last, end))]
+            intervals = [(start, end) for start, end in intervals
+                         if start <= end]
+        else:
+            intervals = intervals_subtract(first, last,
+                self.range_intervals(RANGE_KINDS))
+
+        if policy == "top-down":
+            intervals.reverse()
+
+        return intervals
+
+    def no_free_address(self, range_name=None):
+        if range_name:
+            return "No free address left in range %s" % range_name
+        return "Next address is broadcast address - no free address left"
+
+    def get_next_ipv4_address(self, policy=None, range_name=None):
+        """Get next address from network
 
-        addr = self.network_decimal() + 1
-        broadcast = self._broadcast_decimal
-        while addr < broadcast:
-            if addr not in used_addrs:
+        Ranges are skipped as a whole, the address map is only
+        searched between them.
+        """
+
+        self.address_map_check()
+
+        policy = self.allocation_policy(policy)
+
+        offset = None
+        for first, last in self.allocation_intervals(policy, range_name):
+            if policy == "top-down":
+                offset = self.address_map.last_clear(first, last + 1)
+            else:
+                offset = self.address_map.first_clear(first, last + 1)
+
+            if offset is not None:
                 break
-            addr += 1
-        next_ipv4_address = self.ipv4_address_dotted_quad(addr)
-        if next_ipv4_address == self.broadcast:
-            raise Error(("Next address is broadcast address - no free "
-                         "address left"))
+
+        if offset is None:
+            raise Error(self.no_free_address(range_name))
+
+        next_ipv4_address = self.ipv4_address_dotted_quad(
+            self.network_decimal() + offset)
 
         log.debug("Next IPv4 address: %s" % next_ipv4_address)
 
@@ -360,6 +906,67 @@ class NetIPv4(object):
 
         cinv.backend_exec("net-ipv4", "add", [args.network, args.mask])
 
+    @classmethod
+    def commandline_networks(cls, args):
+        """Return networks selected by --all or by name"""
+        if not args.all and not args.network:
+            raise Error("Required to pass either networks or --all")
+
+        if args.all:
+            network_names = cls.network_list()
+        else:
+            network_names = args.network
+
+        networks = []
+        for network_name in network_names:
+            if not cls.exists(network_name):
+                raise Error("Network does not exist: %s" % network_name)
+            networks.append(cls(network_name))
+
+        return networks
+
+    @classmethod
+    def commandline_address_map_rebuild(cls, args):
+        for network in cls.commandline_networks(args):
+            with cinv.lock.Lock("net-ipv4", network.network):
+                network.address_map_rebuild()
+
+            log.info("Rebuilt address map of %s" % network.network)
+
+    @classmethod
+    def commandline_dump(cls, args):
+        if args.network:
+            networks = cls.commandline_networks(args)
+        else:
+            networks = [cls(network) for network in cls.network_list()]
+
+        def records():
+            for network in networks:
+                yield from network.dump_records()
+
+        cinv.dump.write(records(), cls.DUMP_FIELDS, args.format)
+
+    @classmethod
+    def commandline_index_rebuild(cls, args):
+        for network in cls.commandline_networks(args):
+            with cinv.lock.Lock("net-ipv4", network.network):
+                network.index_rebuild()
+
+            log.info("Rebuilt indexes of %s" % network.network)
+
+    @classmethod
+    def commandline_index_verify(cls, args):
+        drift_found = False
+
+        for network in cls.commandline_networks(args):
+            for drift in network.index_verify():
+                drift_found = True
+                print(drift)
+
+        if drift_found:
+            raise Error("Indexes differ from host directories - "
+                        "use net-ipv4 index-rebuild")
+
     @classmethod
     def commandline_apply(cls, args):
         """Apply changes using the backend"""
@@ -372,7 +979,8 @@ class NetIPv4(object):
         else:
             networks = args.network
 
-        cinv.backend_exec("net-ipv4", "apply", networks)
+        cinv.backend.apply("net-ipv4", networks, args.targets_via,
+            args.chunk_size, args.jobs)
 
 #    @classmethod
 #    def commandline_del(cls, args):
@@ -431,6 +1039,50 @@ class NetIPv4(object):
         network = cls(args.network)
         network.router = args.router
 
+    @classmethod
+    def commandline_allocation_get(cls, args):
+        if not cls.exists(args.network):
+            raise Error("Network does not exist: %s" % args.network)
+
+        network = cls(args.network)
+        print(network.allocation_policy())
+
+    @classmethod
+    def commandline_allocation_set(cls, args):
+        if not cls.exists(args.network):
+            raise Error("Network does not exist: %s" % args.network)
+
+        network = cls(args.network)
+        network.allocation = args.policy
+
+    @classmethod
+    def commandline_range_add(cls, args):
+        if not cls.exists(args.network):
+            raise Error("Network does not exist: %s" % args.network)
+
+        network = cls(args.network)
+        network.range_add(args.name, args.first, args.last, args.type)
+
+    @classmethod
+    def commandline_range_del(cls, args):
+        if not cls.exists(args.network):
+            raise Error("Network does not exist: %s" % args.network)
+
+        network = cls(args.network)
+        network.range_del(args.name)
+
+    @classmethod
+    def commandline_range_list(cls, args):
+        if not cls.exists(args.network):
+            raise Error("Network does not exist: %s" % args.network)
+
+        network = cls(args.network)
+        ranges = network.ranges()
+        for name in sorted(ranges, key=lambda name:
+                           network.ipv4_address_decimal(ranges[name][1])):
+            kind, first, last = ranges[name]
+            print("%s %s %s %s" % (name, kind, first, last))
+
     @classmethod
     def commandline_bootserver_get(cls, args):
         if not cls.exists(args.network):
@@ -453,7 +1105,55 @@ class NetIPv4(object):
             raise Error("Network does not exist: %s" % args.network)
 
         network = cls(args.network)
-        network.host_add(args.fqdn, args.mac_address, args.ipv4_address)
+        network.host_add(args.fqdn, args.mac_address, args.ipv4_address,
+                         args.policy, args.range)
+
+    @classmethod
+    def commandline_host_add_bulk(cls, args):
+        if not cls.exists(args.network):
+            raise Error("Network does not exist: %s" % args.network)
+
+        network = cls(args.network)
+
+        numbers = []
+        records = []
+        failed = 0
+        with args.file:
+            for number, record, error in cinv.dump.read(args.file, args.format):
+                if error:
+                    print("%d: FAILED: %s" % (number, error), file=sys.stderr)
+                    failed += 1
+                else:
+                    numbers.append(number)
+                    records.append(record)
+
+        total = failed + len(records)
+
+        # With strict, invalid input lines already prevent any change
+        if failed and args.strict:
+            raise Error("%d of %d records failed, nothing added" % (failed,
+                total))
+
+        results = network.host_add_bulk(records, args.strict, args.policy,
+                                        args.range)
+
+        for number, result in zip(numbers, results):
+            if result["error"]:
+                failed += 1
+                print("%d: FAILED: %s: %s" % (number, result["fqdn"],
+                    result["error"]), file=sys.stderr)
+
+        if failed and args.strict:
+            raise Error("%d of %d records failed, nothing added" % (failed,
+                total))
+
+        cinv.dump.write([dict((field, result[field])
+            for field in cls.BULK_FIELDS)
+            for result in results if not result["error"]],
+            cls.BULK_FIELDS, args.format)
+
+        if failed:
+            raise Error("%d of %d records failed" % (failed, total))
 
     @classmethod
     def commandline_host_del(cls, args):
@@ -532,6 +1232,16 @@ class NetIPv4(object):
                                    required=True)
         parser['add'].set_defaults(func=cls.commandline_add)
 
+        parser['address-map-rebuild'] = parser['sub'].add_parser(
+            'address-map-rebuild', parents=parents)
+        parser['address-map-rebuild'].add_argument(
+            'network', help='Network name', nargs='*')
+        parser['address-map-rebuild'].add_argument(
+            '-a', '--all', help='Rebuild address map of all networks',
+            required=False, action='store_true')
+        parser['address-map-rebuild'].set_defaults(
+            func=cls.commandline_address_map_rebuild)
+
         parser['bootfilename-get'] = parser['sub'].add_parser(
             'bootfilename-get', parents=parents)
         parser['bootfilename-get'].add_argument('network', help='Network name')
@@ -577,6 +1287,48 @@ class NetIPv4(object):
         parser['mask-dotted-quad-get'].set_defaults(
             func=cls.commandline_mask_dotted_quad_get)
 
+        parser['allocation-get'] = parser['sub'].add_parser(
+            'allocation-get', parents=parents)
+        parser['allocation-get'].add_argument('network', help='Network name')
+        parser['allocation-get'].set_defaults(
+            func=cls.commandline_allocation_get)
+
+        parser['allocation-set'] = parser['sub'].add_parser(
+            'allocation-set', parents=parents)
+        parser['allocation-set'].add_argument('network', help='Network name')
+        parser['allocation-set'].add_argument('-p', '--policy',
+            help='Allocation policy', choices=ALLOCATION_POLICIES,
+            required=True)
+        parser['allocation-set'].set_defaults(
+            func=cls.commandline_allocation_set)
+
+        parser['range-add'] = parser['sub'].add_parser(
+            'range-add', parents=parents,
+            help="Declare reserved, dynamic (DHCP) or static addresses")
+        parser['range-add'].add_argument('network', help='Network name')
+        parser['range-add'].add_argument('-n', '--name', help='Range name',
+                                         required=True)
+        parser['range-add'].add_argument('--first', help='First address',
+                                         required=True)
+        parser['range-add'].add_argument('--last', help='Last address',
+                                         required=True)
+        parser['range-add'].add_argument('-t', '--type',
+            help='Range type (default: reserved)', choices=RANGE_KINDS,
+            default="reserved")
+        parser['range-add'].set_defaults(func=cls.commandline_range_add)
+
+        parser['range-del'] = parser['sub'].add_parser(
+            'range-del', parents=parents)
+        parser['range-del'].add_argument('network', help='Network name')
+        parser['range-del'].add_argument('-n', '--name', help='Range name',
+                                         required=True)
+        parser['range-del'].set_defaults(func=cls.commandline_range_del)
+
+        parser['range-list'] = parser['sub'].add_parser(
+            'range-list', parents=parents)
+        parser['range-list'].add_argument('network', help='Network name')
+        parser['range-list'].set_defaults(func=cls.commandline_range_list)
+
         parser['router-get'] = parser['sub'].add_parser(
             'router-get', parents=parents)
         parser['router-get'].add_argument('network', help='Network name')
@@ -598,6 +1350,15 @@ class NetIPv4(object):
 #        parser['del'].add_argument('net', help='Network name')
 #        parser['del'].set_defaults(func=cls.commandline_del)
 
+        parser['dump'] = parser['sub'].add_parser('dump', parents=parents,
+            help="Dump hosts of all (or the given) networks")
+        parser['dump'].add_argument('network', help='Network name', nargs='*')
+        cinv.dump.add_format_argument(parser['dump'])
+        parser['dump'].add_argument('-a', '--all',
+            help='Dump all networks (default without network names)',
+            action='store_true')
+        parser['dump'].set_defaults(func=cls.commandline_dump)
+
         parser['host-add'] = parser['sub'].add_parser(
             'host-add', parents=parents)
         parser['host-add'].add_argument('network', help='Network name')
@@ -607,8 +1368,33 @@ class NetIPv4(object):
                                         required=True)
         parser['host-add'].add_argument('-i', '--ipv4-address',
                                         help='Requested IPv4 Address')
+        parser['host-add'].add_argument('-p', '--policy',
+            help='Allocation policy (default: the one of the network)',
+            choices=ALLOCATION_POLICIES)
+        parser['host-add'].add_argument('-r', '--range',
+            help='Allocate from the given range')
         parser['host-add'].set_defaults(func=cls.commandline_host_add)
 
+        parser['host-add-bulk'] = parser['sub'].add_parser(
+            'host-add-bulk', parents=parents,
+            help="Add hosts from JSON Lines or CSV (fqdn, mac_address, "
+                 "optional ipv4_address)")
+        parser['host-add-bulk'].add_argument('network', help='Network name')
+        parser['host-add-bulk'].add_argument('file', nargs='?', default='-',
+            type=argparse.FileType('r'),
+            help='File containing one host per line (default: stdin)')
+        parser['host-add-bulk'].add_argument('-F', '--format',
+            help='Input and output format (default: jsonl)',
+            choices=cinv.dump.FORMATS, default="jsonl")
+        parser['host-add-bulk'].add_argument('-s', '--strict',
+            help='Add nothing if any host is invalid', action='store_true')
+        parser['host-add-bulk'].add_argument('-p', '--policy',
+            help='Allocation policy (default: the one of the network)',
+            choices=ALLOCATION_POLICIES)
+        parser['host-add-bulk'].add_argument('-r', '--range',
+            help='Allocate from the given range')
+        parser['host-add-bulk'].set_defaults(func=cls.commandline_host_add_bulk)
+
         parser['host-del'] = parser['sub'].add_parser('host-del',
                                                       parents=parents)
         parser['host-del'].add_argument('network', help='Network name')
@@ -639,6 +1425,26 @@ class NetIPv4(object):
         parser['host-mac-address-get'].set_defaults(
             func=cls.commandline_host_mac_address_get)
 
+        parser['index-rebuild'] = parser['sub'].add_parser(
+            'index-rebuild', parents=parents)
+        parser['index-rebuild'].add_argument(
+            'network', help='Network name', nargs='*')
+        parser['index-rebuild'].add_argument(
+            '-a', '--all', help='Rebuild indexes of all networks',
+            required=False, action='store_true')
+        parser['index-rebuild'].set_defaults(
+            func=cls.commandline_index_rebuild)
+
+        parser['index-verify'] = parser['sub'].add_parser(
+            'index-verify', parents=parents)
+        parser['index-verify'].add_argument(
+            'network', help='Network name', nargs='*')
+        parser['index-verify'].add_argument(
+            '-a', '--all', help='Verify indexes of all networks',
+            required=False, action='store_true')
+        parser['index-verify'].set_defaults(
+            func=cls.commandline_index_verify)
+
         parser['list'] = parser['sub'].add_parser('list', parents=parents)
         parser['list'].set_defaults(func=cls.commandline_list)
 
@@ -648,4 +1454,5 @@ class NetIPv4(object):
         parser['apply'].add_argument('-a', '--all',
                                      help='Apply settings for all networks',
                                      required=False, action='store_true')
+        cinv.backend.add_apply_arguments(parser['apply'])
         parser['apply'].set_defaults(func=cls.commandline_apply)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2012-2014 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import hashlib
+import html
+import logging
+import os
+import os.path
+import sys
+
+import cinv
+import cinv.host
+import cinv.mac
+import cinv.netipv4
+from cinv import fsproperty
+
+log = logging.getLogger(__name__)
+
+FORMATS = ["html", "text"]
+
+class Error(cinv.Error):
+    pass
+
+class Report(object):
+    """Render networks, hosts and mac addresses as HTML or text
+
+    Network sections are cached and only rendered again if the network
+    changed.
+    """
+
+    def __init__(self, format="html", cache=True):
+        if format not in FORMATS:
+            raise Error("Format must be one of %s" % (" ".join(FORMATS)))
+
+        self.format = format
+        self.cache = cache
+        self.cache_dir = os.path.join(cinv.get_base_dir("cache"), "report",
+            format)
+
+    @staticmethod
+    def network_key(network):
+        """Return cache key of network based on a few stamps
+
+        Replaced files and added or removed hosts change the mtime of
+        the network or host directory, the address map and the range
+        list are changed in place. Host files rewritten without cinv
+        are not noticed, as for the address map.
+        """
+        paths = [network.base_dir, network.base_host_dir]
+        paths.extend([os.path.join(network.base_dir, name)
+            for name in ("host_dir_stamp", "address_map", "range")])
+
+        stamps = []
+        for path in paths:
+            stamp = fsproperty.stamp(path) or (0, 0, 0)
+            stamps.append("%s %d %d" % (path, stamp[0], stamp[1]))
+
+        return hashlib.sha1("\n".join(stamps).encode()).hexdigest()
+
+    def cache_get(self, name, key):
+        try:
+            with open(os.path.join(self.cache_dir, name), "r") as fd:
+                cached_key = fd.readline().rstrip('\n')
+                if cached_key == key:
+                    return fd.read()
+        except EnvironmentError:
+            pass
+        return None
+
+    def cache_set(self, name, key, section):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(os.path.join(self.cache_dir, name), "w") as fd:
+                fd.write("%s\n%s" % (key, section))
+        except EnvironmentError as e:
+            log.warning("Cannot cache report section %s: %s" % (name, e))
+
+    def table(self, title, header, rows, summary=""):
+        if self.format == "html":
+            lines = ["<h2>%s</h2>" % html.escape(title)]
+            if summary:
+                lines.append("<p>%s</p>" % html.escape(summary))
+            lines.append("<table>")
+            lines.append("<tr>%s</tr>" % "".join(
+                ["<th>%s</th>" % html.escape(cell) for cell in header]))
+            for row in rows:
+                lines.append("<tr>%s</tr>" % "".join(
+                    ["<td>%s</td>" % html.escape(str(cell)) for cell in row]))
+            lines.append("</table>")
+        else:
+            lines = [title, "=" * len(title)]
+            if summary:
+                lines.append(summary)
+            widths = [len(cell) for cell in header]
+            rows = [[str(cell) for cell in row] for row in rows]
+            for row in rows:
+                widths = [max(width, len(cell)) for width, cell in zip(widths, row)]
+            for row in [header] + rows:
+                lines.append("  ".join([cell.ljust(width)
+                    for width, cell in zip(widths, row)]).rstrip())
+            lines.append("")
+
+        return "\n".join(lines) + "\n"
+
+    def network_section(self, network):
+        """Render one network, reading each of its files once"""
+        rows = []
+        mask = None
+        for record in network.dump_records():
+            mask = record["mask"]
+            if not record["fqdn"]:
+                continue
+            rows.append([record["fqdn"], record["mac_address"],
+                record["ipv4_address"]])
+        rows.sort(key=lambda row: network.ipv4_address_decimal(row[2]))
+
+        if mask is None:
+            mask = network.mask
+
+        # Reserved and dynamic ranges are never handed out
+        size = 1 << (32 - int(mask))
+        usable = cinv.netipv4.intervals_subtract(1, size - 2,
+            network.range_intervals(["reserved", "dynamic"]))
+        free = sum([last - first + 1 for first, last in usable])
+        for row in rows:
+            offset = network.ipv4_address_offset(row[2])
+            if any([first <= offset <= last for first, last in usable]):
+                free -= 1
+        summary = "%d used, %d free" % (len(rows), max(0, free))
+
+        return self.table("%s/%s" % (network.network, mask),
+            ["FQDN", "Mac Address", "IPv4 address"], rows, summary)
+
+    def networks(self):
+        sections = []
+        for name in sorted(cinv.netipv4.NetIPv4.network_list()):
+            network = cinv.netipv4.NetIPv4(name)
+
+            key = self.network_key(network) if self.cache else None
+            section = self.cache_get(name, key) if key else None
+
+            if section is None:
+                log.debug("Rendering network %s" % name)
+                section = self.network_section(network)
+                if key:
+                    self.cache_set(name, key, section)
+
+            sections.append(section)
+
+        return sections
+
+    def hosts(self):
+        rows = [[host.fqdn, host.host_type, host.cores, host.memory,
+            host.vm_host] for host in cinv.host.Host.load_many()]
+        rows.sort()
+
+        return self.table("Hosts", ["FQDN", "Type", "Cores", "Memory",
+            "VM Host"], rows, "%d hosts" % len(rows))
+
+    def macs(self):
+        mac = cinv.mac.Mac()
+        rows = [["prefix", mac.prefix], ["last", mac.last],
+            ["free", mac.free_count()]]
+
+        return self.table("Mac Addresses", ["Name", "Value"], rows)
+
+    def render(self):
+        try:
+            networks = self.networks()
+        except FileNotFoundError:
+            networks = []
+
+        body = "".join(networks + [self.hosts(), self.macs()])
+
+        if self.format == "html":
+            return ("<html>\n<head>\n<title>cinv Inventory</title>\n</head>\n"
+                "<body>\n%s</body>\n</html>\n" % body)
+
+        return body
+
+    @classmethod
+    def commandline_report(cls, args):
+        report = cls(args.format, not args.no_cache)
+        output = report.render()
+
+        if args.output:
+            try:
+                with open(args.output, "w") as fd:
+                    fd.write(output)
+            except EnvironmentError as e:
+                raise Error(e)
+        else:
+            sys.stdout.write(output)
+
+    @classmethod
+    def commandline_args(cls, parent_parser, parents):
+        """Add us to the parent parser and add all parents to our parsers"""
+
+        parent_parser.add_argument('-f', '--format', help='Report format',
+            choices=FORMATS, default="html")
+        parent_parser.add_argument('-o', '--output', help='Write report to file')
+        parent_parser.add_argument('-n', '--no-cache',
+            help='Render all networks again', action='store_true')
+        parent_parser.set_defaults(func=cls.commandline_report)
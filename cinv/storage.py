@@ -0,0 +1,1188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2012-2014 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import collections
+import contextlib
+import logging
+import os
+import os.path
+import shutil
+import time
+
+import cinv
+import cinv.lock
+
+log = logging.getLogger(__name__)
+
+STORAGES = ["directory", "log", "memory"]
+
+TEMP_PREFIX = ".cinv-tmp-"
+
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".index"
+
+# Write the index after this many bytes were appended to the log
+INDEX_INTERVAL = 1 << 18
+
+# Write a file of the log whole once in place changes split it into
+# more than this many pieces
+SEGMENTS_MAX = 64
+
+# Compact a log bigger than COMPACT_MIN bytes once less than
+# 1/COMPACT_RATIO of it is live data
+COMPACT_MIN = 1 << 20
+COMPACT_RATIO = 2
+
+Entry = collections.namedtuple("Entry", ["name", "path", "is_dir"])
+
+class Error(cinv.Error):
+    pass
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_temp(path, data, fsync):
+    """Write data to a temporary file next to path, return its name"""
+    directory, name = os.path.split(path)
+    temp_path = os.path.join(directory, "%s%d-%s" % (TEMP_PREFIX,
+        os.getpid(), name))
+
+    with open(temp_path, "wb") as fd:
+        fd.write(data)
+        if fsync:
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    return temp_path
+
+def segments_slice(segments, begin, end):
+    """Return the segments covering bytes begin to end of a file
+
+    A file in the log is a sequence of (log offset, size) segments,
+    log offset None stands for size zero bytes.
+    """
+    result = []
+    position = 0
+    for offset, size in segments:
+        low = max(begin, position)
+        high = min(end, position + size)
+        if low < high:
+            result.append((None if offset is None else offset + low - position,
+                high - low))
+        position += size
+    return result
+
+def segments_resize(segments, size, new_size):
+    """Return segments of a file of size cut or zero padded to new_size"""
+    result = segments_slice(segments, 0, min(size, new_size))
+    if new_size > size:
+        result.append((None, new_size - size))
+    return result
+
+def segments_write(segments, size, position, offset, count):
+    """Return segments with count bytes at position taken from log offset"""
+    result = segments_resize(segments, size, position)
+    result.append((offset, count))
+    result.extend(segments_slice(segments, position + count, size))
+    return result
+
+def format_segments(segments):
+    return ",".join(["%s:%d" % ("-" if offset is None else offset, size)
+        for offset, size in segments]) or "-"
+
+def parse_segments(text):
+    if text == "-":
+        return ()
+    segments = []
+    for segment in text.split(","):
+        offset, size = segment.split(":")
+        segments.append((None if offset == "-" else int(offset), int(size)))
+    return tuple(segments)
+
+
+class DirectoryStorage(object):
+    """Every file of the database is a file in the filesystem
+
+    Files are replaced atomically (temporary file + rename).
+    """
+
+    # Changes survive the process
+    persistent = True
+
+    def read(self, path):
+        with open(path, "rb") as fd:
+            return fd.read()
+
+    def stamp(self, path):
+        """Return (mtime in ns, size, identity) of a file"""
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def mtime(self, path):
+        return os.stat(path).st_mtime_ns
+
+    def iter_lines(self, path):
+        with open(path) as fd:
+            for line in fd:
+                yield line.rstrip('\n')
+
+    def write(self, path, data, fsync):
+        temp_path = write_temp(path, data, fsync)
+        try:
+            os.rename(temp_path, path)
+        except EnvironmentError:
+            os.remove(temp_path)
+            raise
+        if fsync:
+            fsync_dir(os.path.dirname(path))
+
+    def append(self, path, data, fsync):
+        with open(path, "ab") as fd:
+            fd.write(data)
+            if fsync:
+                fd.flush()
+                os.fsync(fd.fileno())
+
+    def read_at(self, path, offset, size):
+        """Return up to size bytes of path starting at offset"""
+        with open(path, "rb") as fd:
+            return os.pread(fd.fileno(), size, offset)
+
+    def truncate(self, path, size, fsync):
+        with open(path, "rb+") as fd:
+            fd.truncate(size)
+            if fsync:
+                fd.flush()
+                os.fsync(fd.fileno())
+
+    def write_at(self, path, offset, data, fsync):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+            if fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def remove(self, path, fsync):
+        os.remove(path)
+        if fsync:
+            fsync_dir(os.path.dirname(path))
+
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def listdir(self, path):
+        return [name for name in os.listdir(path)
+            if not name.startswith(TEMP_PREFIX)]
+
+    def scandir(self, path):
+        with os.scandir(path) as entries:
+            return [Entry(entry.name, entry.path, entry.is_dir())
+                for entry in entries if not entry.name.startswith(TEMP_PREFIX)]
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def makedirs(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    def rmtree(self, path):
+        shutil.rmtree(path)
+
+    def utime(self, path):
+        os.utime(path)
+
+    def commit(self, changes, fsync):
+        """Write [(path, content or None to remove)] together
+
+        With fsync, every file is written and synced before any is
+        renamed, then each directory is synced once.
+        """
+        renames = []
+
+        try:
+            for path, data in changes:
+                if data is not None:
+                    renames.append((write_temp(path, data, fsync), path))
+
+            for temp_path, path in renames:
+                os.rename(temp_path, path)
+            renames = []
+
+            for path, data in changes:
+                if data is None:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+            if fsync:
+                for directory in sorted(set([os.path.dirname(path)
+                        for path, data in changes])):
+                    fsync_dir(directory)
+        except EnvironmentError:
+            for temp_path, path in renames:
+                try:
+                    os.remove(temp_path)
+                except EnvironmentError:
+                    pass
+            raise
+
+    def compact(self):
+        log.info("Directory storage needs no compaction")
+
+
+class LogArea(object):
+    """Files and directories of one area (f.i. ~/.cinv/db/host) in a log
+
+    Every change is a record appended to ~/.cinv/db/<area>.log:
+
+        <op> <length> <mtime in ns> <relative path>\\n<length bytes of data>
+
+    with op P (put file), R (remove file), M (make directory),
+    T (remove tree) or U (set mtime). In place changes of a file are
+    A (append data), W (write data at an offset) and S (cut or extend
+    to a size); the offset or size of W and S precedes the path.
+    A file is read from the segments of the log written to it.
+
+    ~/.cinv/db/<area>.index contains the state up to an offset of the
+    log, so only the rest of the log is read when opening it.
+    """
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self.log_path = self.path + LOG_SUFFIX
+        self.index_path = self.path + INDEX_SUFFIX
+
+        self.log = None
+        self.ino = None
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.index_offset = 0
+        # rel -> (segments, size, mtime, record bytes, last record offset)
+        self.files = {}
+        # rel -> mtime, "" is the area itself
+        self.dirs = {}
+        self.children = {}
+        self.live = 0
+
+    def error(self, exception, rel):
+        return exception(os.path.join(self.path, rel))
+
+    ######################################################################
+    # Reading the log
+    #
+
+    def refresh(self):
+        """Follow records appended by other processes or a compaction"""
+        try:
+            st = os.stat(self.log_path)
+        except FileNotFoundError:
+            if os.path.isdir(self.path):
+                self.create()
+                st = os.stat(self.log_path)
+            else:
+                if self.log:
+                    self.log.close()
+                    self.log = None
+                    self.reset()
+                return
+
+        if self.log is None or st.st_ino != self.ino:
+            self.load()
+        elif st.st_size > self.offset:
+            self.replay()
+
+    def load(self):
+        if self.log:
+            self.log.close()
+        self.reset()
+
+        self.log = open(self.log_path, "rb")
+        self.ino = os.fstat(self.log.fileno()).st_ino
+
+        self.read_index()
+        self.replay()
+
+    def read_index(self):
+        try:
+            with open(self.index_path, "r") as fd:
+                header = fd.readline().split()
+                if len(header) != 4 or header[:3] != ["cinv-log-index", "2",
+                        str(self.ino)]:
+                    return
+
+                dirs = {}
+                for line in fd:
+                    line = line.rstrip('\n')
+                    if line.startswith("d "):
+                        kind, mtime, rel = line.split(" ", 2)
+                        dirs[rel] = int(mtime)
+                        self.add_dir(rel, dirs[rel])
+                    else:
+                        (kind, size, mtime, length, start, segments,
+                            rel) = line.split(" ", 6)
+                        self.put(rel, (parse_segments(segments), int(size),
+                            int(mtime), int(length), int(start)))
+
+                # Adding children changed the mtime of their directory
+                self.dirs.update(dirs)
+                self.offset = self.index_offset = int(header[3])
+        except (EnvironmentError, ValueError) as e:
+            log.debug("Ignoring index %s: %s" % (self.index_path, e))
+            self.reset()
+
+    def replay(self):
+        self.log.seek(self.offset)
+        size = os.fstat(self.log.fileno()).st_size
+
+        while True:
+            start = self.log.tell()
+            header = self.log.readline()
+            if not header.endswith(b'\n'):
+                # Record is still being written
+                break
+
+            try:
+                op, length, mtime, rel = header[:-1].decode().split(" ", 3)
+                length = int(length)
+                mtime = int(mtime)
+                position = None
+                if op in ("W", "S"):
+                    position, rel = rel.split(" ", 1)
+                    position = int(position)
+            except ValueError:
+                raise Error("Corrupt record at offset %d of %s" % (start,
+                    self.log_path))
+
+            data_offset = start + len(header)
+            if data_offset + length > size:
+                break
+            self.log.seek(length, os.SEEK_CUR)
+
+            self.apply(op, rel, mtime, position, start, data_offset, length)
+            self.offset = data_offset + length
+
+    @staticmethod
+    def split(rel):
+        parent, _, name = rel.rpartition("/")
+        return parent, name
+
+    @staticmethod
+    def join(parent, name):
+        return "%s/%s" % (parent, name) if parent else name
+
+    def add_child(self, rel, mtime):
+        parent, name = self.split(rel)
+        self.children[parent].add(name)
+        self.dirs[parent] = mtime
+
+    def remove_child(self, rel, mtime):
+        parent, name = self.split(rel)
+        self.children[parent].discard(name)
+        self.dirs[parent] = mtime
+
+    def add_dir(self, rel, mtime):
+        if rel in self.dirs:
+            return
+        if rel:
+            self.add_dir(self.split(rel)[0], mtime)
+            self.add_child(rel, mtime)
+        self.dirs[rel] = mtime
+        self.children[rel] = set()
+
+    def put(self, rel, entry):
+        parent = self.split(rel)[0]
+        mtime = entry[2]
+        self.add_dir(parent, mtime)
+
+        old = self.files.get(rel)
+        if old:
+            self.live -= old[3]
+            self.dirs[parent] = mtime
+        else:
+            self.add_child(rel, mtime)
+
+        self.files[rel] = entry
+        self.live += entry[3]
+
+    def remove_tree(self, rel, mtime):
+        for name in self.children.pop(rel, []):
+            child = self.join(rel, name)
+            if child in self.files:
+                self.live -= self.files.pop(child)[3]
+            else:
+                self.remove_tree(child, None)
+
+        del self.dirs[rel]
+        if rel and mtime is not None:
+            self.remove_child(rel, mtime)
+
+    def apply(self, op, rel, mtime, position, start, offset, size):
+        length = offset + size - start
+
+        if op == "P":
+            self.put(rel, (((offset, size),), size, mtime, length, start))
+        elif op in ("A", "W", "S"):
+            # Changes in place only add segments, old data stays live
+            segments, file_size, _, file_length, _ = self.files.get(rel,
+                ((), 0, None, 0, None))
+            if op == "S":
+                segments = segments_resize(segments, file_size, position)
+                file_size = position
+            else:
+                if op == "A":
+                    position = file_size
+                segments = segments_write(segments, file_size, position,
+                    offset, size)
+                file_size = max(file_size, position + size)
+            self.put(rel, (tuple(segments), file_size, mtime,
+                file_length + length, start))
+        elif op == "R":
+            if rel in self.files:
+                self.live -= self.files.pop(rel)[3]
+                self.remove_child(rel, mtime)
+        elif op == "M":
+            self.add_dir(rel, mtime)
+        elif op == "T":
+            if rel in self.dirs:
+                self.remove_tree(rel, mtime)
+        elif op == "U":
+            if rel in self.files:
+                entry = self.files[rel]
+                self.files[rel] = entry[:2] + (mtime,) + entry[3:]
+            elif rel in self.dirs:
+                self.dirs[rel] = mtime
+        else:
+            raise Error("Unknown record %s in %s" % (op, self.log_path))
+
+    ######################################################################
+    # Queries
+    #
+
+    def read(self, rel, offset=0, size=None):
+        if rel not in self.files:
+            raise self.error(FileNotFoundError, rel)
+        segments, file_size = self.files[rel][:2]
+        end = file_size if size is None else min(file_size, offset + size)
+
+        fd = self.log.fileno()
+        return b"".join([bytes(count) if start is None else
+            os.pread(fd, count, start)
+            for start, count in segments_slice(segments, offset, end)])
+
+    def stamp(self, rel):
+        if rel in self.files:
+            segments, size, mtime, length, start = self.files[rel]
+            return (mtime, size, start)
+        if rel in self.dirs:
+            return (self.dirs[rel], 0, 0)
+        raise self.error(FileNotFoundError, rel)
+
+    def listdir(self, rel):
+        if rel not in self.dirs:
+            raise self.error(FileNotFoundError, rel)
+        return list(self.children[rel])
+
+    def check_parent(self, rel):
+        if self.split(rel)[0] not in self.dirs:
+            raise self.error(FileNotFoundError, rel)
+
+    ######################################################################
+    # Writing the log
+    #
+
+    def encode(self, records):
+        """Return records (op, rel, mtime, data[, offset or size])"""
+        chunks = []
+        for op, rel, mtime, data, *position in records:
+            if position:
+                rel = "%d %s" % (position[0], rel)
+            chunks.append(("%s %d %d %s\n" % (op, len(data), mtime,
+                rel)).encode())
+            chunks.append(data)
+        return b"".join(chunks)
+
+    def write_log(self, records):
+        """Replace the log by a new one containing records"""
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+        temp_path = write_temp(self.log_path, self.encode(records), True)
+        os.rename(temp_path, self.log_path)
+        fsync_dir(os.path.dirname(self.log_path))
+
+    def state_records(self):
+        """Return records recreating the current state"""
+        records = []
+        dirs = sorted(self.dirs, key=lambda rel: (rel.count("/"), rel))
+
+        for rel in dirs:
+            records.append(("M", rel, self.dirs[rel], b""))
+        for rel in sorted(self.files):
+            records.append(("P", rel, self.files[rel][2], self.read(rel)))
+        for rel in dirs:
+            records.append(("U", rel, self.dirs[rel], b""))
+
+        return records
+
+    def create(self):
+        """Create the log from the directory tree of the area"""
+        with cinv.lock.Lock("storage", self.name):
+            if os.path.exists(self.log_path):
+                return
+
+            dir_records = []
+            file_records = []
+            for directory, dirnames, filenames in os.walk(self.path):
+                rel = os.path.relpath(directory, self.path)
+                rel = "" if rel == "." else rel.replace(os.sep, "/")
+                dir_records.append((rel, os.stat(directory).st_mtime_ns))
+
+                for name in filenames:
+                    if name.startswith(TEMP_PREFIX):
+                        continue
+                    path = os.path.join(directory, name)
+                    with open(path, "rb") as fd:
+                        data = fd.read()
+                    file_records.append(("P", self.join(rel, name),
+                        os.stat(path).st_mtime_ns, data))
+
+            self.write_log([("M", rel, mtime, b"") for rel, mtime in dir_records] +
+                file_records +
+                [("U", rel, mtime, b"") for rel, mtime in dir_records])
+
+            log.info("Imported %s into %s" % (self.path, self.log_path))
+
+    def append(self, records, fsync):
+        """Append [(op, rel, data[, offset or size])] in one write
+
+        Files split into too many segments are written whole afterwards.
+        """
+        with cinv.lock.Lock("storage", self.name):
+            os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+            self.refresh()
+
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0o644)
+            try:
+                size = os.fstat(fd).st_size
+                if self.log and size > self.offset:
+                    log.warning("Removing incomplete record at the end of %s"
+                        % self.log_path)
+                    os.ftruncate(fd, self.offset)
+
+                mtime = time.time_ns()
+                data = memoryview(self.encode([(op, rel, mtime,
+                    content or b"", *position)
+                    for op, rel, content, *position in records]))
+                while data:
+                    data = data[os.write(fd, data):]
+
+                if fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            self.refresh()
+
+            fragmented = sorted(set([record[1] for record in records
+                if record[1] in self.files and
+                    len(self.files[record[1]][0]) > SEGMENTS_MAX]))
+            if fragmented:
+                self.append([("P", rel, self.read(rel)) for rel in fragmented],
+                    fsync)
+            elif (self.offset > COMPACT_MIN and
+                    self.offset > COMPACT_RATIO * self.live):
+                self.compact()
+            elif self.offset - self.index_offset > INDEX_INTERVAL:
+                self.write_index()
+
+    def write_index(self):
+        lines = ["cinv-log-index 2 %d %d\n" % (self.ino, self.offset)]
+        for rel, mtime in self.dirs.items():
+            lines.append("d %d %s\n" % (mtime, rel))
+        for rel, (segments, size, mtime, length, start) in self.files.items():
+            lines.append("f %d %d %d %d %s %s\n" % (size, mtime, length, start,
+                format_segments(segments), rel))
+
+        temp_path = write_temp(self.index_path, "".join(lines).encode(), False)
+        os.rename(temp_path, self.index_path)
+        self.index_offset = self.offset
+
+    def compact(self):
+        """Rewrite the log with only the current state"""
+        with cinv.lock.Lock("storage", self.name):
+            self.refresh()
+            if not self.log:
+                return
+
+            size = self.offset
+            self.write_log(self.state_records())
+            self.load()
+            self.write_index()
+
+            log.info("Compacted %s from %d to %d bytes" % (self.log_path,
+                size, self.offset))
+
+
+class LogStorage(DirectoryStorage):
+    """Every area below ~/.cinv/db is stored in one append-only log
+
+    Existing directory trees are imported on first use. Paths outside of
+    the database are stored as files.
+    """
+
+    def __init__(self, root=None):
+        # None: follow ~/.cinv/db
+        self.root = root
+        self.areas = {}
+
+    def get_root(self):
+        return self.root or cinv.get_base_dir("db")
+
+    def locate(self, path):
+        """Return (area, relative path) or (None, None) outside of root"""
+        root = self.get_root()
+        prefix = root + os.sep
+        if not path.startswith(prefix):
+            return None, None
+
+        name, _, rel = path[len(prefix):].rstrip(os.sep).partition(os.sep)
+        area_path = os.path.join(root, name)
+        if area_path not in self.areas:
+            self.areas[area_path] = LogArea(root, name)
+
+        area = self.areas[area_path]
+        area.refresh()
+        return area, rel.replace(os.sep, "/")
+
+    def read(self, path):
+        area, rel = self.locate(path)
+        if not area:
+            return super().read(path)
+        return area.read(rel)
+
+    def stamp(self, path):
+        area, rel = self.locate(path)
+        if not area:
+            return super().stamp(path)
+        return area.stamp(rel)
+
+    def mtime(self, path):
+        return self.stamp(path)[0]
+
+    def iter_lines(self, path):
+        area, rel = self.locate(path)
+        if not area:
+            return super().iter_lines(path)
+        return iter(area.read(rel).decode().splitlines())
+
+    def write(self, path, data, fsync):
+        area, rel = self.locate(path)
+        if not area:
+            return super().write(path, data, fsync)
+        area.check_parent(rel)
+        area.append([("P", rel, data)], fsync)
+
+    def append(self, path, data, fsync):
+        area, rel = self.locate(path)
+        if not area:
+            return super().append(path, data, fsync)
+        area.check_parent(rel)
+        area.append([("A", rel, data)], fsync)
+
+    def read_at(self, path, offset, size):
+        area, rel = self.locate(path)
+        if not area:
+            return super().read_at(path, offset, size)
+        return area.read(rel, offset, size)
+
+    def truncate(self, path, size, fsync):
+        area, rel = self.locate(path)
+        if not area:
+            return super().truncate(path, size, fsync)
+        if rel not in area.files:
+            raise FileNotFoundError(path)
+        area.append([("S", rel, None, size)], fsync)
+
+    def write_at(self, path, offset, data, fsync):
+        area, rel = self.locate(path)
+        if not area:
+            return super().write_at(path, offset, data, fsync)
+        area.check_parent(rel)
+        area.append([("W", rel, data, offset)], fsync)
+
+    def remove(self, path, fsync):
+        area, rel = self.locate(path)
+        if not area:
+            return super().remove(path, fsync)
+        if rel not in area.files:
+            raise FileNotFoundError(path)
+        area.append([("R", rel, None)], fsync)
+
+    def isfile(self, path):
+        area, rel = self.locate(path)
+        if not area:
+            return super().isfile(path)
+        return rel in area.files
+
+    def isdir(self, path):
+        area, rel = self.locate(path)
+        if not area:
+            return super().isdir(path)
+        return rel in area.dirs
+
+    def listdir(self, path):
+        area, rel = self.locate(path)
+        if not area:
+            return super().listdir(path)
+        return area.listdir(rel)
+
+    def scandir(self, path):
+        area, rel = self.locate(path)
+        if not area:
+            return super().scandir(path)
+        return [Entry(name, os.path.join(path, name),
+            area.join(rel, name) in area.dirs) for name in area.listdir(rel)]
+
+    def mkdir(self, path):
+        area, rel = self.locate(path)
+        if not area:
+            return super().mkdir(path)
+        if rel in area.dirs or rel in area.files:
+            raise FileExistsError(path)
+        if rel:
+            area.check_parent(rel)
+        area.append([("M", rel, None)], False)
+
+    def makedirs(self, path):
+        area, rel = self.locate(path)
+        if not area:
+            return super().makedirs(path)
+        if rel not in area.dirs:
+            area.append([("M", rel, None)], False)
+
+    def rmtree(self, path):
+        area, rel = self.locate(path)
+        if not area:
+            return super().rmtree(path)
+        if rel not in area.dirs:
+            raise FileNotFoundError(path)
+        area.append([("T", rel, None)], False)
+
+    def utime(self, path):
+        area, rel = self.locate(path)
+        if not area:
+            return super().utime(path)
+        area.stamp(rel)
+        area.append([("U", rel, None)], False)
+
+    def commit(self, changes, fsync):
+        records = collections.OrderedDict()
+        others = []
+
+        for path, data in changes:
+            area, rel = self.locate(path)
+            if area:
+                records.setdefault(area, []).append(
+                    ("P" if data is not None else "R", rel, data))
+            else:
+                others.append((path, data))
+
+        if others:
+            super().commit(others, fsync)
+        for area, area_records in records.items():
+            area.append(area_records, fsync)
+
+    def compact(self):
+        root = self.get_root()
+        try:
+            names = os.listdir(root)
+        except FileNotFoundError:
+            names = []
+
+        for name in sorted(names):
+            if name.endswith(LOG_SUFFIX):
+                area, rel = self.locate(os.path.join(root,
+                    name[:-len(LOG_SUFFIX)]))
+                area.compact()
+
+
+class MemoryStorage(DirectoryStorage):
+    """All files and directories in memory, nothing is written to disk
+
+    Parent directories are created implicitly.
+    """
+
+    persistent = False
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # path -> (content, mtime, identity)
+        self.files = {}
+        # path -> mtime
+        self.dirs = { os.sep: 0 }
+        self.children = { os.sep: set() }
+        self.identity = 0
+
+    @staticmethod
+    def normalize(path):
+        return path.rstrip(os.sep) or os.sep
+
+    def add_dir(self, path):
+        if path in self.dirs:
+            return
+        self.add_dir(os.path.dirname(path))
+        self.add_child(path)
+        self.dirs[path] = time.time_ns()
+        self.children[path] = set()
+
+    def add_child(self, path):
+        parent, name = os.path.split(path)
+        self.children[parent].add(name)
+        self.dirs[parent] = time.time_ns()
+
+    def remove_child(self, path):
+        parent, name = os.path.split(path)
+        self.children[parent].discard(name)
+        self.dirs[parent] = time.time_ns()
+
+    def read(self, path):
+        path = self.normalize(path)
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        return self.files[path][0]
+
+    def stamp(self, path):
+        path = self.normalize(path)
+        if path in self.files:
+            data, mtime, identity = self.files[path]
+            return (mtime, len(data), identity)
+        if path in self.dirs:
+            return (self.dirs[path], 0, 0)
+        raise FileNotFoundError(path)
+
+    def mtime(self, path):
+        return self.stamp(path)[0]
+
+    def iter_lines(self, path):
+        return iter(self.read(path).decode().splitlines())
+
+    def write(self, path, data, fsync):
+        path = self.normalize(path)
+        self.add_dir(os.path.dirname(path))
+        if path in self.files:
+            self.dirs[os.path.dirname(path)] = time.time_ns()
+        else:
+            self.add_child(path)
+
+        self.identity += 1
+        self.files[path] = (bytes(data), time.time_ns(), self.identity)
+
+    def append(self, path, data, fsync):
+        content = self.read(path) if self.isfile(path) else b""
+        self.write(path, content + data, fsync)
+
+    def read_at(self, path, offset, size):
+        return self.read(path)[offset:offset + size]
+
+    def truncate(self, path, size, fsync):
+        content = self.read(path)[:size]
+        self.write(path, content + bytes(size - len(content)), fsync)
+
+    def write_at(self, path, offset, data, fsync):
+        content = bytearray(self.read(path) if self.isfile(path) else b"")
+        if len(content) < offset:
+            content.extend(bytes(offset - len(content)))
+        content[offset:offset + len(data)] = data
+        self.write(path, bytes(content), fsync)
+
+    def remove(self, path, fsync):
+        path = self.normalize(path)
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        del self.files[path]
+        self.remove_child(path)
+
+    def isfile(self, path):
+        return self.normalize(path) in self.files
+
+    def isdir(self, path):
+        return self.normalize(path) in self.dirs
+
+    def listdir(self, path):
+        path = self.normalize(path)
+        if path not in self.dirs:
+            raise FileNotFoundError(path)
+        return list(self.children[path])
+
+    def scandir(self, path):
+        return [Entry(name, os.path.join(path, name),
+            self.isdir(os.path.join(path, name))) for name in self.listdir(path)]
+
+    def mkdir(self, path):
+        if self.isdir(path) or self.isfile(path):
+            raise FileExistsError(path)
+        self.makedirs(path)
+
+    def makedirs(self, path):
+        self.add_dir(self.normalize(path))
+
+    def rmtree(self, path):
+        path = self.normalize(path)
+        if path not in self.dirs:
+            raise FileNotFoundError(path)
+
+        self.remove_tree(path)
+        self.remove_child(path)
+
+    def remove_tree(self, path):
+        for name in self.children.pop(path):
+            child = os.path.join(path, name)
+            if child in self.files:
+                del self.files[child]
+            else:
+                self.remove_tree(child)
+        del self.dirs[path]
+
+    def utime(self, path):
+        path = self.normalize(path)
+        if path in self.files:
+            data, mtime, identity = self.files[path]
+            self.files[path] = (data, time.time_ns(), identity)
+        elif path in self.dirs:
+            self.dirs[path] = time.time_ns()
+        else:
+            raise FileNotFoundError(path)
+
+    def commit(self, changes, fsync):
+        for path, data in changes:
+            if data is not None:
+                self.write(path, data, fsync)
+            else:
+                try:
+                    self.remove(path, fsync)
+                except FileNotFoundError:
+                    pass
+
+    def compact(self):
+        pass
+
+
+class OverlayStorage(MemoryStorage):
+    """Changes kept in memory on top of another storage
+
+    Reads see the changes, the underlying storage is only modified by
+    apply(). discard() drops all changes.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        super().__init__()
+
+    def reset(self):
+        super().reset()
+        # Removed paths of the underlying storage
+        self.whiteouts = set()
+        # (operation, path, content) in order, replayed by apply()
+        self.operations = []
+
+    def hidden(self, path):
+        """Check whether path of the underlying storage was removed"""
+        while True:
+            if path in self.whiteouts:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    def read(self, path):
+        if super().isfile(path):
+            return super().read(path)
+        if self.hidden(path):
+            raise FileNotFoundError(path)
+        return self.base.read(path)
+
+    def stamp(self, path):
+        if super().isfile(path) or super().isdir(path):
+            return super().stamp(path)
+        if self.hidden(path):
+            raise FileNotFoundError(path)
+        return self.base.stamp(path)
+
+    def isfile(self, path):
+        return super().isfile(path) or (not self.hidden(path) and
+            self.base.isfile(path))
+
+    def isdir(self, path):
+        return super().isdir(path) or (not self.hidden(path) and
+            self.base.isdir(path))
+
+    def listdir(self, path):
+        names = set()
+        found = False
+
+        if super().isdir(path):
+            names.update(super().listdir(path))
+            found = True
+        if not self.hidden(path) and self.base.isdir(path):
+            names.update([name for name in self.base.listdir(path)
+                if not self.hidden(os.path.join(path, name))])
+            found = True
+
+        if not found:
+            raise FileNotFoundError(path)
+        return list(names)
+
+    def write(self, path, data, fsync):
+        if not self.isdir(os.path.dirname(path)):
+            raise FileNotFoundError(path)
+        super().write(path, data, fsync)
+        self.operations.append(("write", path, bytes(data)))
+
+    def remove(self, path, fsync):
+        if not self.isfile(path):
+            raise FileNotFoundError(path)
+        if super().isfile(path):
+            super().remove(path, fsync)
+        self.whiteouts.add(self.normalize(path))
+        self.operations.append(("remove", path, None))
+
+    def mkdir(self, path):
+        if self.isdir(path) or self.isfile(path):
+            raise FileExistsError(path)
+        if not self.isdir(os.path.dirname(self.normalize(path))):
+            raise FileNotFoundError(path)
+        super().makedirs(path)
+        self.operations.append(("mkdir", path, None))
+
+    def makedirs(self, path):
+        if self.isdir(path):
+            return
+        super().makedirs(path)
+        self.operations.append(("makedirs", path, None))
+
+    def rmtree(self, path):
+        if not self.isdir(path):
+            raise FileNotFoundError(path)
+        if super().isdir(path):
+            super().rmtree(path)
+        self.whiteouts.add(self.normalize(path))
+        self.operations.append(("rmtree", path, None))
+
+    def utime(self, path):
+        if super().isfile(path) or super().isdir(path):
+            super().utime(path)
+        elif self.base.isdir(path) and not self.hidden(path):
+            super().makedirs(path)
+        else:
+            super().write(path, self.read(path), False)
+        self.operations.append(("utime", path, None))
+
+    def changes(self):
+        """Return list of (operation, path) done so far"""
+        return [(operation, path) for operation, path, data in self.operations]
+
+    def apply(self, fsync=True):
+        """Replay all changes on the underlying storage"""
+        enabled = cinv.lock.set_enabled(self.base.persistent)
+        try:
+            self.replay(fsync)
+        finally:
+            cinv.lock.set_enabled(enabled)
+
+        self.discard()
+
+    def replay(self, fsync):
+        files = collections.OrderedDict()
+
+        def flush():
+            if files:
+                self.base.commit(list(files.items()), fsync)
+                files.clear()
+
+        for operation, path, data in self.operations:
+            if operation in ("write", "remove"):
+                files.pop(path, None)
+                files[path] = data
+            else:
+                flush()
+                try:
+                    getattr(self.base, operation)(path)
+                except FileExistsError:
+                    pass
+        flush()
+
+    def discard(self):
+        self.reset()
+
+
+@contextlib.contextmanager
+def overlay():
+    """Keep all changes of the block in an OverlayStorage
+
+    Changes are only written if overlay.apply() is called in the block.
+    """
+    base = get_storage()
+    set_storage(OverlayStorage(base))
+    try:
+        yield _storage
+    finally:
+        set_storage(base)
+
+
+_storage = None
+
+def get_storage():
+    """Return the storage selected by ~/.cinv/config/storage"""
+    if _storage is None:
+        name = cinv.get_config("storage", "directory")
+        if name == "directory":
+            set_storage(DirectoryStorage())
+        elif name == "log":
+            set_storage(LogStorage())
+        elif name == "memory":
+            set_storage(MemoryStorage())
+        else:
+            raise Error("storage must be one of %s" % " ".join(STORAGES))
+    return _storage
+
+def set_storage(storage):
+    """Use storage (None: the configured one), lock only if persistent"""
+    global _storage
+    _storage = storage
+    cinv.lock.set_enabled(storage is None or storage.persistent)
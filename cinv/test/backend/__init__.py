@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2011 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import cinv
+import cinv.backend
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+class BackendTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = self.temp_dir
+
+        self.log = os.path.join(self.temp_dir, "log")
+        self.backend("apply", 'echo "$@" >> "%s"' % self.log)
+        self.backend("sleep", 'sleep "$2"')
+        self.backend("fail", 'exit 3')
+
+    def tearDown(self):
+        os.environ['HOME'] = self.home
+        shutil.rmtree(self.temp_dir)
+
+    def backend(self, command, script, interpreter="/bin/sh"):
+        backend_dir = os.path.join(cinv.get_base_dir("backend"), "test")
+        os.makedirs(backend_dir, exist_ok=True)
+        path = os.path.join(backend_dir, command)
+        with open(path, "w") as fd:
+            fd.write("#!%s\n%s\n" % (interpreter, script))
+        os.chmod(path, 0o755)
+
+    def test_concurrent(self):
+        """Hooks of a session run in parallel"""
+        start = time.monotonic()
+        with cinv.backend.session():
+            for i in range(4):
+                cinv.backend_exec("test", "sleep", [str(i), "0.3"])
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_same_object_in_order(self):
+        """Hooks of the same object run one after the other"""
+        self.backend("del", 'sleep 0.3; echo del "$1" >> "%s"' % self.log)
+        self.backend("add", 'echo add "$1" >> "%s"' % self.log)
+        with cinv.backend.session():
+            cinv.backend_exec("test", "del", ["x"])
+            cinv.backend_exec("test", "add", ["x"])
+            cinv.backend_exec("test", "add", ["y"])
+        with open(self.log) as fd:
+            self.assertEqual(fd.read(), "add y\ndel x\nadd x\n")
+
+    def test_deferred_merged(self):
+        """Identical deferred hooks run once at the end of the session"""
+        with cinv.backend.session():
+            cinv.backend_exec("test", "apply", ["a"], defer=True)
+            cinv.backend_exec("test", "apply", ["b"], defer=True)
+            cinv.backend_exec("test", "apply", ["a"], defer=True)
+            self.assertFalse(os.path.exists(self.log))
+
+        # Deferred hooks run in parallel, too
+        with open(self.log) as fd:
+            self.assertEqual(sorted(fd.readlines()), ["a\n", "b\n"])
+
+    def test_apply_jobs(self):
+        """Apply limits only its own chunks to its number of jobs"""
+        self.backend("apply", 'sleep 0.2; echo "$@" >> "%s"' % self.log)
+        start = time.monotonic()
+        with cinv.backend.session() as executor:
+            jobs = executor.jobs
+            cinv.backend.apply("test", ["a", "b", "c"], chunk_size=1, jobs=1)
+        self.assertEqual(executor.jobs, jobs)
+        self.assertGreaterEqual(time.monotonic() - start, 0.6)
+        with open(self.log) as fd:
+            self.assertEqual(fd.read(), "a\nb\nc\n")
+
+    def test_failures_reported(self):
+        """Failed and timed out hooks raise one error at the end"""
+        os.environ['CINV_BACKEND_TIMEOUT_TEST_SLEEP'] = "0.1"
+        try:
+            with self.assertRaisesRegex(cinv.backend.Error, "2 backend"):
+                with cinv.backend.session():
+                    cinv.backend_exec("test", "fail", [])
+                    cinv.backend_exec("test", "sleep", ["x", "5"])
+                    cinv.backend_exec("test", "apply", ["ok"])
+        finally:
+            del os.environ['CINV_BACKEND_TIMEOUT_TEST_SLEEP']
+
+    def test_coprocess(self):
+        """A coprocess is started once and receives all events"""
+        self.backend("coprocess", """
+import json, os, sys
+events = []
+for line in sys.stdin:
+    event = json.loads(line)
+    events.append(event["args"][0])
+    status = 1 if event["command"] == "fail" else 0
+    print(json.dumps({"id": event["id"], "status": status}), flush=True)
+with open("%s", "a") as fd:
+    fd.write("%%d %%s\\n" %% (os.getpid(), " ".join(events)))
+""" % self.log, interpreter=sys.executable)
+
+        with self.assertRaisesRegex(cinv.backend.Error, "1 backend"):
+            with cinv.backend.session():
+                cinv.backend_exec("test", "del", ["a"])
+                cinv.backend_exec("test", "fail", ["b"])
+                cinv.backend_exec("test", "apply", ["c"], defer=True)
+
+        with open(self.log) as fd:
+            lines = fd.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(" a b c\n"))
+
+    def test_apply_chunks(self):
+        """Targets are split into chunks passed on stdin or in a file"""
+        self.backend("apply", 'cat >> "%s"' % self.log)
+        cinv.backend.apply("test", ["a", "b", "c", "d", "e"], "stdin", 2)
+
+        self.backend("apply", 'cat "$__cinv_targets_file" >> "%s"' % self.log)
+        cinv.backend.apply("test", ["f", "g"], "file", 1)
+
+        with open(self.log) as fd:
+            self.assertEqual(sorted(fd.read().split()),
+                ["a", "b", "c", "d", "e", "f", "g"])
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2011 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import argparse
+import cinv.backend
+import cinv.batch
+import contextlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def command(args):
+            if args.name == "fail":
+                raise cinv.Error("failed")
+            self.calls.append(args.name)
+
+        self.parser = argparse.ArgumentParser()
+        self.parser.add_argument('name')
+        self.parser.set_defaults(func=command)
+
+    def run_batch(self, lines, stop_on_error=False):
+        batch = cinv.batch.Batch(self.parser, stop_on_error)
+        with contextlib.redirect_stderr(io.StringIO()):
+            try:
+                batch.run(lines)
+            except cinv.batch.Error:
+                pass
+        return batch
+
+    def test_continue_after_error(self):
+        """All commands run and failures are counted"""
+        batch = self.run_batch(["a", "# comment", "", "fail", "b"])
+        self.assertEqual(self.calls, ["a", "b"])
+        self.assertEqual((batch.failed, batch.total), (1, 3))
+
+    def test_stop_on_error(self):
+        """Stop at first failure if requested"""
+        self.run_batch(["a", "fail", "b"], stop_on_error=True)
+        self.assertEqual(self.calls, ["a"])
+
+    def test_line_options_and_errors(self):
+        """Options apply per line, any exception fails the line only"""
+        levels = []
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-d', '--debug', action='store_true')
+        parser.add_argument('--dry-run', action='store_true')
+        parser.add_argument('--timings', action='store_true')
+        parser.add_argument('--profile')
+        sub = parser.add_subparsers()
+        sub.add_parser('level').set_defaults(
+            func=lambda args: levels.append(logging.root.level))
+        sub.add_parser('crash').set_defaults(func=lambda args: 1 / 0)
+        sub.add_parser('batch').set_defaults(
+            func=cinv.batch.Batch.commandline_batch)
+
+        batch = cinv.batch.Batch(parser)
+        level = logging.root.level
+
+        self.assertIsNone(batch.run_line("-d level"))
+        self.assertEqual(levels, [logging.DEBUG])
+        self.assertEqual(logging.root.level, level)
+
+        self.assertIn("ZeroDivisionError", batch.run_line("crash"))
+        self.assertEqual(batch.run_line("-d batch"), "batch cannot be nested")
+
+        self.assertIn("whole batch", batch.run_line("--dry-run level"))
+        self.assertIn("whole batch", batch.run_line("--timings level"))
+        self.assertIn("whole batch", batch.run_line("--profile x level"))
+
+    def test_hook_status_per_line(self):
+        """A failing backend hook fails the line that started it"""
+        temp_dir = tempfile.mkdtemp()
+        home = os.environ.get('HOME')
+        os.environ['HOME'] = temp_dir
+        try:
+            backend_dir = os.path.join(cinv.get_base_dir("backend"), "test")
+            os.makedirs(backend_dir)
+            path = os.path.join(backend_dir, "fail")
+            with open(path, "w") as fd:
+                fd.write("#!/bin/sh\nexit 3\n")
+            os.chmod(path, 0o755)
+
+            parser = argparse.ArgumentParser()
+            parser.add_argument('command')
+            parser.set_defaults(
+                func=lambda args: cinv.backend_exec("test", args.command, []))
+
+            batch = cinv.batch.Batch(parser)
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                with cinv.backend.session():
+                    with self.assertRaises(cinv.batch.Error):
+                        batch.run(["fail", "missing"])
+
+            self.assertEqual(batch.failed, 1)
+            self.assertIn("1: FAILED: fail: 1 backend hook(s) failed",
+                stderr.getvalue())
+            self.assertIn("2: OK: missing", stderr.getvalue())
+        finally:
+            os.environ['HOME'] = home
+            shutil.rmtree(temp_dir)
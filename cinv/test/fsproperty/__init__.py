@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2011 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import cinv.fsproperty
+import cinv.storage
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+class FileListTest(unittest.TestCase):
+    def setUp(self):
+        cinv.storage.set_storage(cinv.storage.MemoryStorage())
+        self.path = "/fsproperty/list"
+        self.list = cinv.fsproperty.FileList(self.path, index=True)
+
+    def tearDown(self):
+        cinv.storage.set_storage(None)
+
+    def test_append_pop(self):
+        """Pop returns appended items in reverse order"""
+        self.list.append("a")
+        self.list.append("b")
+        self.assertEqual(self.list.pop(), "b")
+        self.assertEqual(self.list.pop(), "a")
+        self.assertFalse(self.list)
+        self.assertRaises(IndexError, self.list.pop)
+
+    def test_pop_without_trailing_newline(self):
+        """Pop handles a manually written last line"""
+        cinv.fsproperty.write_file(self.path, "a\nb")
+        self.assertEqual(self.list.pop(), "b")
+        self.assertEqual(list(self.list), ["a"])
+
+    def test_index_follows_file(self):
+        """Membership index notices changes made by other writers"""
+        self.list.append("a")
+        self.assertTrue("a" in self.list)
+
+        other = cinv.fsproperty.FileList(self.path)
+        other.append("b")
+        self.assertTrue("b" in self.list)
+
+        self.list.pop()
+        self.assertFalse("b" in self.list)
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.dict = cinv.fsproperty.DirectoryDict(
+            os.path.join(self.temp_dir, "dict"))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_commit(self):
+        """Staged writes are visible inside and written on commit"""
+        self.dict["a"] = "1"
+        with cinv.fsproperty.transaction():
+            self.dict["b"] = "2"
+            del self.dict["a"]
+            self.assertEqual(dict(self.dict), { "b": "2" })
+            self.assertFalse(os.path.exists(os.path.join(self.dict.path, "b")))
+
+        self.assertEqual(sorted(os.listdir(self.dict.path)), ["b"])
+
+    def test_discard_on_error(self):
+        """Staged writes are discarded if the block fails"""
+        def fail():
+            with cinv.fsproperty.transaction():
+                self.dict["a"] = "1"
+                raise cinv.Error("failed")
+
+        self.assertRaises(cinv.Error, fail)
+        self.assertEqual(dict(self.dict), {})
+
+    def test_filelist_in_transaction(self):
+        """FileList append and pop work on staged content"""
+        path = os.path.join(self.temp_dir, "list")
+        filelist = cinv.fsproperty.FileList(path, index=True)
+        filelist.append("a")
+        with cinv.fsproperty.transaction():
+            filelist.append("b")
+            filelist.append("c")
+            self.assertEqual(filelist.pop(), "c")
+            self.assertTrue("b" in filelist)
+
+        self.assertEqual(list(filelist), ["a", "b"])
+
+
+class ReadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.size = cinv.fsproperty.get_read_cache_size()
+        cinv.fsproperty.set_read_cache_size(2)
+
+    def tearDown(self):
+        cinv.fsproperty.set_read_cache_size(self.size)
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, text, mtime=1000000000):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, "w") as fd:
+            fd.write(text)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_cached_until_changed(self):
+        """Cached content is dropped once size or mtime change"""
+        path = self.write("a", "1")
+        self.assertEqual(cinv.fsproperty.read_file(path), "1")
+        self.assertIn(path, cinv.fsproperty._read_cache)
+
+        self.write("a", "22")
+        self.assertEqual(cinv.fsproperty.read_file(path), "22")
+
+        self.write("a", "33", mtime=1000000001)
+        self.assertEqual(cinv.fsproperty.read_file(path), "33")
+
+    def test_lru_limit(self):
+        """Only the most recently read files are kept"""
+        paths = [self.write(name, name) for name in "abc"]
+        for path in paths:
+            cinv.fsproperty.read_file(path)
+
+        self.assertEqual(list(cinv.fsproperty._read_cache), paths[1:])
+
+    def test_threads(self):
+        """Reads of several threads share cache and counters safely"""
+        paths = [self.write(name, name) for name in "abcd"]
+        cinv.fsproperty.reset_counters()
+
+        def read():
+            for i in range(200):
+                for path in paths:
+                    cinv.fsproperty.read_file(path)
+
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(cinv.fsproperty.counters()["stat"], 4 * 200 * 4)
+        self.assertLessEqual(len(cinv.fsproperty._read_cache), 2)
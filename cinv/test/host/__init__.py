@@ -20,7 +20,13 @@
 #
 #
 
+import cinv.catalog
+import cinv.fsproperty
 import cinv.host
+import cinv.storage
+import os
+import shutil
+import tempfile
 import unittest
 
 class HostTest(unittest.TestCase):
@@ -50,3 +56,117 @@ class HostTest(unittest.TestCase):
         """Prevent adding wrong core values"""
         self.assertRaises(cinv.host.Error, self.wrong_cores)
 
+
+class HostListTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = self.temp_dir
+
+        for fqdn, host_type, tags in (("hw1", "hw", ["prod"]),
+                                      ("vm1", "vm", ["prod", "web"]),
+                                      ("vm2", "vm", [])):
+            host = cinv.host.Host(fqdn)
+            host._init_base_dir(host_type)
+            for tag in tags:
+                host.tag_add(tag)
+
+    def tearDown(self):
+        os.environ['HOME'] = self.home
+        shutil.rmtree(self.temp_dir)
+
+    def test_filter_type_and_tags(self):
+        """List hosts matching type and all tags"""
+        Host = cinv.host.Host
+        self.assertEqual(sorted(Host.host_list()), ["hw1", "vm1", "vm2"])
+        self.assertEqual(sorted(Host.host_list("vm")), ["vm1", "vm2"])
+        self.assertEqual(Host.host_list("vm", ["prod"]), ["vm1"])
+        self.assertEqual(Host.host_list(tags=["prod", "web"]), ["vm1"])
+
+    def test_filter_with_threads(self):
+        """Threaded scan returns the same hosts"""
+        Host = cinv.host.Host
+        self.assertEqual(sorted(Host.host_list(tags=["prod"], workers=4)),
+                         ["hw1", "vm1"])
+
+    def test_skip_files(self):
+        """Files next to the host directories are no hosts"""
+        Host = cinv.host.Host
+        cinv.fsproperty.write_file(os.path.join(
+            os.path.dirname(Host("hw1").base_dir), "README"), "notes\n")
+
+        self.assertEqual(sorted(Host.host_list()), ["hw1", "vm1", "vm2"])
+        self.assertEqual(sorted(Host.host_list(tags=["prod"], workers=4)),
+                         ["hw1", "vm1"])
+
+    def test_catalog_follows_changes(self):
+        """Catalog is updated by host changes and used for listing"""
+        Host = cinv.host.Host
+        catalog = cinv.catalog.Catalog.open(create=True)
+        catalog.rebuild()
+
+        Host("vm2").tag_add("prod")
+        host = Host("vm3")
+        host._init_base_dir("vm")
+        host.vm_host = "hw1"
+
+        self.assertTrue(catalog.fresh())
+        self.assertEqual(sorted(Host.host_list("vm", ["prod"])), ["vm1", "vm2"])
+        self.assertEqual(Host.vmhosts_vms_list(), { "hw1": ["vm3"] })
+        self.assertEqual(catalog.verify(), [])
+
+    def test_catalog_fresh_operations(self):
+        """Checking the catalog does not look at every host"""
+        catalog = cinv.catalog.Catalog.open(create=True)
+        catalog.rebuild()
+
+        cinv.fsproperty.reset_counters()
+        self.assertTrue(catalog.fresh())
+        counters = cinv.fsproperty.counters()
+
+        self.assertEqual(counters["listdir"], 0)
+        self.assertLessEqual(counters["stat"], 1)
+
+    def test_catalog_notices_changes_in_place(self):
+        """Hosts changed in place are found by verify and refresh"""
+        Host = cinv.host.Host
+        catalog = cinv.catalog.Catalog.open(create=True)
+        catalog.rebuild()
+
+        if type(cinv.storage.get_storage()) is not cinv.storage.DirectoryStorage:
+            self.skipTest("Host files are only visible with directory storage")
+
+        # Same sizes, so only mtimes differ
+        base_dir = Host("vm1").base_dir
+        with open(os.path.join(base_dir, "host_type"), "r+") as fd:
+            fd.write("hw")
+        with open(os.path.join(base_dir, "tag", "web"), "w") as fd:
+            fd.write("x")
+
+        self.assertTrue(catalog.fresh())
+        self.assertEqual(len(catalog.verify()), 2)
+
+        self.assertEqual(catalog.refresh(), ["vm1"])
+        self.assertEqual(sorted(Host.host_list("hw", ["prod"])), ["hw1", "vm1"])
+        self.assertEqual(catalog.host_record("vm1")["tag"]["web"], "x")
+        self.assertEqual(catalog.verify(), [])
+
+    def test_load(self):
+        """Snapshots contain all attributes and are read only"""
+        Host = cinv.host.Host
+        host = Host("vm1")
+        host.cores = "2"
+        host.disk_add("10G", "root")
+
+        snapshot = Host.load("vm1")
+        self.assertEqual((snapshot.host_type, snapshot.cores), ("vm", "2"))
+        self.assertEqual(dict(snapshot.tag), { "prod": "", "web": "" })
+        self.assertEqual(list(snapshot.disk), ["root"])
+        self.assertRaises(AttributeError, setattr, snapshot, "cores", "4")
+        self.assertRaises(cinv.host.Error, Host.load, "missing")
+
+        records = sorted([snapshot.record() for snapshot in
+            Host.load_many(workers=4)], key=lambda record: record["fqdn"])
+        self.assertEqual(records[1], snapshot.record())
+        self.assertEqual([record["fqdn"] for record in records],
+            ["hw1", "vm1", "vm2"])
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2011 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import cinv.lock
+import cinv.mac
+import cinv.storage
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+def generate(base_dir, count, queue):
+    mac = cinv.mac.Mac()
+    mac.base_dir = base_dir
+    queue.put([mac.get_next() for i in range(count)])
+
+class LockTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = self.temp_dir
+
+        mac = cinv.mac.Mac()
+        mac.base_dir = self.temp_dir
+        mac.prefix = "00:16:3e"
+
+    def tearDown(self):
+        os.environ['HOME'] = self.home
+        shutil.rmtree(self.temp_dir)
+
+    def test_reentrant(self):
+        """Taking a held lock again does not block"""
+        with cinv.lock.Lock("test", "reentrant"):
+            with cinv.lock.Lock("test", "reentrant"):
+                pass
+        self.assertEqual(cinv.lock.Lock._held, {})
+
+    def test_not_persistent(self):
+        """Locks are only tracked while changes are not persistent"""
+        cinv.storage.set_storage(cinv.storage.MemoryStorage())
+        try:
+            with cinv.lock.Lock("test", "memory") as lock:
+                self.assertIsNotNone(lock.held())
+        finally:
+            cinv.storage.set_storage(None)
+
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, ".cinv",
+            "lock", "test")))
+
+    def test_threads(self):
+        """A lock held by one thread blocks the others"""
+        events = []
+
+        def hold():
+            with cinv.lock.Lock("test", "threads"):
+                events.append("held")
+                time.sleep(0.2)
+                events.append("released")
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        while not events:
+            time.sleep(0.01)
+
+        with cinv.lock.Lock("test", "threads"):
+            events.append("taken")
+        thread.join()
+
+        self.assertEqual(events, ["held", "released", "taken"])
+
+    def test_concurrent_mac_generate(self):
+        """Parallel processes never hand out the same mac address"""
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=generate,
+            args=(self.temp_dir, 20, queue)) for i in range(4)]
+
+        for process in processes:
+            process.start()
+        macs = []
+        for process in processes:
+            macs.extend(queue.get())
+        for process in processes:
+            process.join()
+
+        self.assertEqual(len(macs), 80)
+        self.assertEqual(len(set(macs)), 80)
@@ -20,23 +20,77 @@
 #
 #
 
+import cinv.fsproperty
 import cinv.mac
+import cinv.storage
+import os
 import shutil
 import tempfile
 import unittest
 
 class MacTest(unittest.TestCase):
+    # Storage class to use, None for the configured one
+    storage = None
+
     def setUp(self):
         self.mac = cinv.mac.Mac()
 
         self.temp_dir = tempfile.mkdtemp()
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = self.temp_dir
+        cinv.storage.set_storage(self.storage and self.storage())
 
         self.mac.base_dir = self.temp_dir
 
     def tearDown(self):
+        cinv.storage.set_storage(None)
+        os.environ['HOME'] = self.home
         shutil.rmtree(self.temp_dir)
 
     def test_overflow(self):
         """ Check that no more than all possible mac addresses with one prefix can be used"""
         self.mac.last = "00:00:00:ff:ff:ff"
         self.assertRaises(cinv.mac.Error, self.mac.get_next)
+
+    def test_reserve(self):
+        """Reserve takes free addresses first, then a block after last"""
+        self.mac.prefix = "00:16:3e"
+        self.mac.last = "00:16:3e:00:00:0f"
+        self.mac.free_append("00:16:3e:aa:aa:aa")
+
+        self.assertEqual(self.mac.reserve(3), ["00:16:3e:aa:aa:aa",
+            "00:16:3e:00:00:10", "00:16:3e:00:00:11"])
+        self.assertEqual(self.mac.last, "00:16:3e:00:00:11")
+
+    def test_reserve_exhausted(self):
+        """A failed reservation keeps the free list"""
+        self.mac.prefix = "00:16:3e"
+        self.mac.last = "00:16:3e:ff:ff:fe"
+        self.mac.free_append("00:16:3e:aa:aa:aa")
+
+        self.assertRaises(cinv.mac.Error, self.mac.reserve, 3)
+        self.assertEqual(list(self.mac.free_list()), ["00:16:3e:aa:aa:aa"])
+
+    def test_free_pool(self):
+        """Old free lists are moved into the pools, duplicates rejected"""
+        cinv.fsproperty.write_file(os.path.join(self.temp_dir, "free"),
+            "00:16:3E:00:00:05\n02:00:00:00:00:01\n")
+
+        self.mac.free_add(["00:16:3e:00:00:%02x" % number
+            for number in range(6, 100)])
+        self.assertRaises(cinv.mac.Error, self.mac.free_add,
+            ["00:16:3e:00:00:63", "00:16:3e:00:01:00"])
+
+        self.assertEqual(self.mac.free_count(), 96)
+        self.assertFalse(cinv.fsproperty.exists(os.path.join(self.temp_dir,
+            "free")))
+
+        # The pool of the current prefix is used first
+        self.mac.prefix = "02:00:00"
+        self.assertEqual(self.mac.free_take(2), ["02:00:00:00:00:01",
+            "00:16:3e:00:00:05"])
+
+
+class MemoryMacTest(MacTest):
+    """Run the same tests with changes kept in memory"""
+    storage = cinv.storage.MemoryStorage
@@ -20,19 +20,30 @@
 #
 #
 
+import cinv.fsproperty
 import cinv.netipv4
+import cinv.storage
+import os
 import shutil
 import tempfile
 import unittest
 
 class HostTest(unittest.TestCase):
+    # Storage class to use, None for the configured one
+    storage = None
+
     def setUp(self):
         self.network = cinv.netipv4.NetIPv4("127.0.0.0")
         self.temp_dir = tempfile.mkdtemp()
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = self.temp_dir
+        cinv.storage.set_storage(self.storage and self.storage())
         self.network.base_dir = self.temp_dir
         self.network._init_base_dir(8)
 
     def tearDown(self):
+        cinv.storage.set_storage(None)
+        os.environ['HOME'] = self.home
         shutil.rmtree(self.temp_dir)
 
     def test_validate_network_address(self):
@@ -78,3 +89,186 @@ class HostTest(unittest.TestCase):
         self.network.host_add("test1", "00:11:22:33:44:55", "127.0.0.1")
         self.assertRaises(cinv.netipv4.Error, self.network.host_add, "test2", "00:11:22:33:44:55", "127.0.0.2")
 
+
+    def test_next_ipv4_address(self):
+        """Next address skips used addresses"""
+        self.network.host_add("test1", "00:11:22:33:44:55")
+        self.network.host_add("test2", "00:11:22:33:44:56", "127.0.0.3")
+        self.assertEqual(self.network.get_next_ipv4_address(), "127.0.0.2")
+
+    def test_next_ipv4_address_after_del(self):
+        """Deleted addresses are handed out again"""
+        self.network.host_add("test1", "00:11:22:33:44:55")
+        self.network.host_add("test2", "00:11:22:33:44:56")
+        self.network.host_del("test1")
+        self.assertEqual(self.network.get_next_ipv4_address(), "127.0.0.1")
+
+    def test_address_map_rebuild_after_manual_change(self):
+        """Address map follows hosts removed behind our back"""
+        self.network.host_add("test1", "00:11:22:33:44:55")
+        cinv.fsproperty.rmtree(self.network.host_dir("test1"))
+
+        self.assertEqual(self.network.get_next_ipv4_address(), "127.0.0.1")
+
+    def test_index_follows_host_del(self):
+        """Addresses of deleted hosts can be used again"""
+        self.network.host_add("test1", "00:11:22:33:44:55", "127.0.0.1")
+        self.network.host_del("test1")
+        self.network.host_add("test2", "00:11:22:33:44:55", "127.0.0.1")
+        self.assertEqual(self.network.ipv4_address_used("127.0.0.1"), "test2")
+        self.assertEqual(self.network.index_verify(), [])
+
+    def test_index_verify_reports_drift(self):
+        """Index verification finds changed host files"""
+        self.network.host_add("test1", "00:11:22:33:44:55", "127.0.0.1")
+        self.network.host_ipv4_address_set("test1", "127.0.0.2")
+        self.assertEqual(len(self.network.index_verify()), 2)
+
+    def test_dump_records(self):
+        """Dump yields one record per host, or one for an empty network"""
+        records = list(self.network.dump_records())
+        self.assertEqual([(record["mask"], record["fqdn"])
+                          for record in records], [("8", "")])
+
+        self.network.host_add("test1", "00:11:22:33:44:55", "127.0.0.1")
+        records = list(self.network.dump_records())
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["fqdn"], "test1")
+        self.assertEqual(records[0]["mask"], "8")
+        self.assertEqual(records[0]["ipv4_address"], "127.0.0.1")
+
+    def test_host_add_operations(self):
+        """Adding a host neither scans the network nor opens many files"""
+        self.network.host_add("test1", "00:11:22:33:44:55")
+
+        cinv.fsproperty.reset_counters()
+        self.network.host_add("test2", "00:11:22:33:44:56")
+        few = cinv.fsproperty.counters()
+
+        self.network.host_add_bulk([
+            { "fqdn": "bulk%d" % i, "mac": "00:11:22:33:45:%02x" % i }
+            for i in range(50) ])
+
+        cinv.fsproperty.reset_counters()
+        self.network.host_add("test3", "00:11:22:33:44:57")
+        many = cinv.fsproperty.counters()
+
+        self.assertEqual(many["listdir"], 0)
+        self.assertLessEqual(many["open"], 12)
+        self.assertLessEqual(many["stat"], few["stat"])
+        self.assertLessEqual(many["bytes_read"], few["bytes_read"] + 16)
+
+    def test_address_used_operations(self):
+        """Looking up an address does not scan the hosts"""
+        self.network.host_add_bulk([
+            { "fqdn": "bulk%d" % i, "mac": "00:11:22:33:45:%02x" % i }
+            for i in range(50) ])
+
+        cinv.fsproperty.reset_counters()
+        self.assertEqual(self.network.ipv4_address_used("127.0.0.3"), "bulk2")
+        self.assertEqual(self.network.mac_address_used("00:11:22:33:45:02"), "bulk2")
+        counters = cinv.fsproperty.counters()
+
+        self.assertEqual(counters["listdir"], 0)
+        self.assertLessEqual(counters["stat"], 12)
+        self.assertLessEqual(counters["open"], 4)
+
+    def test_host_add_bulk(self):
+        """Bulk add allocates addresses and reports invalid records"""
+        self.network.host_add("test1", "00:11:22:33:44:55", "127.0.0.2")
+
+        results = self.network.host_add_bulk([
+            { "fqdn": "test2", "mac": "00:11:22:33:44:56" },
+            { "fqdn": "test3", "mac": "00:11:22:33:44:55" },
+            { "fqdn": "test4", "mac": "00:11:22:33:44:57", "ipv4": "127.0.0.1" },
+            { "fqdn": "test5", "mac_address": "00:11:22:33:44:58" },
+        ])
+
+        self.assertEqual([result["ipv4_address"] for result in results],
+            ["127.0.0.3", "", "127.0.0.1", "127.0.0.4"])
+        self.assertIsNotNone(results[1]["error"])
+        self.assertEqual(self.network.get_next_ipv4_address(), "127.0.0.5")
+        self.assertEqual(self.network.index_verify(), [])
+
+    def test_host_add_bulk_malformed(self):
+        """Records with values other than strings fail alone"""
+        results = self.network.host_add_bulk([
+            { "fqdn": "test1", "mac": "00:11:22:33:44:55" },
+            { "fqdn": 5, "mac": "00:11:22:33:44:56" },
+            { "fqdn": "test3", "mac": 7 },
+        ])
+
+        self.assertEqual([result["error"] is None for result in results],
+            [True, False, False])
+        self.assertEqual(self.network.host_list(), ["test1"])
+        self.assertEqual(self.network.index_verify(), [])
+
+    def test_ranges(self):
+        """Allocation skips reserved and dynamic ranges and follows policies"""
+        self.network.range_add("infra", "127.0.0.1", "127.0.0.10")
+        self.network.range_add("dhcp", "127.0.1.0", "127.0.1.255", "dynamic")
+        self.network.range_add("servers", "127.0.0.11", "127.0.0.12",
+                               "static")
+        self.assertRaises(cinv.netipv4.Error, self.network.range_add,
+                          "overlap", "127.0.0.10", "127.0.0.20")
+
+        self.assertEqual(self.network.get_next_ipv4_address(), "127.0.0.13")
+        self.assertEqual(self.network.get_next_ipv4_address("top-down"),
+                         "127.255.255.254")
+
+        self.network.host_add("test1", "00:11:22:33:44:55",
+                               range_name="servers")
+        self.network.host_add("test2", "00:11:22:33:44:56",
+                               range_name="servers")
+        self.assertRaises(cinv.netipv4.Error, self.network.host_add,
+                          "test3", "00:11:22:33:44:57", range_name="servers")
+        self.assertRaises(cinv.netipv4.Error, self.network.host_add,
+                          "test3", "00:11:22:33:44:57", "127.0.1.1")
+
+        self.network.allocation = "top-down"
+        results = self.network.host_add_bulk([
+            { "fqdn": "test3", "mac": "00:11:22:33:44:57" },
+            { "fqdn": "test4", "mac": "00:11:22:33:44:58" },
+        ])
+        self.assertEqual([result["ipv4_address"] for result in results],
+                         ["127.255.255.254", "127.255.255.253"])
+
+        self.network.range_del("infra")
+        self.assertEqual(self.network.get_next_ipv4_address("bottom-up"),
+                         "127.0.0.1")
+
+    def test_malformed_range(self):
+        """A broken line of the range file is reported as an error"""
+        self.network._range = ["infra reserved 127.0.0.1"]
+        self.assertRaisesRegex(cinv.netipv4.Error, "127.0.0.0: infra",
+            self.network.get_next_ipv4_address)
+
+    def test_host_changed_outside(self):
+        """Adding a host without cinv is noticed"""
+        self.network.host_add("test1", "00:11:22:33:44:55")
+        self.assertEqual(self.network.get_next_ipv4_address(), "127.0.0.2")
+
+        host_dir = self.network.host_dir("test2")
+        cinv.fsproperty.makedirs(host_dir)
+        cinv.fsproperty.write_file(os.path.join(host_dir, "ipv4_address"), "127.0.0.2\n")
+        cinv.fsproperty.write_file(os.path.join(host_dir, "mac_address"), "00:11:22:33:44:56\n")
+
+        self.assertEqual(self.network.get_next_ipv4_address(), "127.0.0.3")
+        self.assertEqual(self.network.ipv4_address_used("127.0.0.2"), "test2")
+
+    def test_host_changed_in_place(self):
+        """Rewriting an address file without cinv is found by verify"""
+        self.network.host_add("test1", "00:11:22:33:44:55")
+
+        cinv.fsproperty.write_file(os.path.join(
+            self.network.host_dir("test1"), "ipv4_address"), "127.0.0.2\n")
+
+        self.assertEqual(len(self.network.index_verify()), 2)
+        self.network.hosts_rebuild()
+        self.assertEqual(self.network.index_verify(), [])
+        self.assertEqual(self.network.get_next_ipv4_address(), "127.0.0.1")
+
+
+class MemoryHostTest(HostTest):
+    """Run the same tests with changes kept in memory"""
+    storage = cinv.storage.MemoryStorage
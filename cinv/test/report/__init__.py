@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2011 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import cinv.fsproperty
+import cinv.netipv4
+import cinv.report
+import os
+import shutil
+import tempfile
+import unittest
+
+class ReportTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = self.temp_dir
+
+        self.network = cinv.netipv4.NetIPv4("10.0.0.0")
+        self.network._init_base_dir(24)
+        self.network.host_add("test1", "00:11:22:33:44:55")
+
+    def tearDown(self):
+        os.environ['HOME'] = self.home
+        shutil.rmtree(self.temp_dir)
+
+    def test_text_report(self):
+        """Text report contains hosts and counts of networks"""
+        output = cinv.report.Report("text").render()
+        self.assertIn("10.0.0.0/24", output)
+        self.assertIn("1 used, 253 free", output)
+        self.assertIn("00:11:22:33:44:55", output)
+
+    def test_free_without_ranges(self):
+        """Reserved and dynamic ranges do not count as free"""
+        self.network.range_add("infra", "10.0.0.1", "10.0.0.10")
+        self.network.range_add("dhcp", "10.0.0.200", "10.0.0.254", "dynamic")
+        self.network.range_add("servers", "10.0.0.11", "10.0.0.20", "static")
+
+        output = cinv.report.Report("text").render()
+        self.assertIn("1 used, 189 free", output)
+
+    def test_cached_network_section(self):
+        """Network sections are only rendered again after changes"""
+        report = cinv.report.Report("html")
+        key = report.network_key(self.network)
+        report.render()
+        self.assertIsNotNone(report.cache_get("10.0.0.0", key))
+
+        self.network.host_add("test2", "00:11:22:33:44:56")
+        self.assertNotEqual(report.network_key(self.network), key)
+        self.assertIn("test2", report.render())
+
+        key = report.network_key(self.network)
+        self.network.range_add("infra", "10.0.0.100", "10.0.0.110")
+        self.assertNotEqual(report.network_key(self.network), key)
+
+    def test_network_key_operations(self):
+        """The cache key does not look at every host"""
+        self.network.host_add_bulk([
+            { "fqdn": "bulk%d" % i, "mac": "00:11:22:33:45:%02x" % i }
+            for i in range(50) ])
+
+        cinv.fsproperty.reset_counters()
+        cinv.report.Report("html").network_key(self.network)
+        counters = cinv.fsproperty.counters()
+
+        self.assertEqual(counters["listdir"], 0)
+        self.assertLessEqual(counters["stat"], 5)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2011 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+# Allowed time of "cinv host cores-get" on top of the bare interpreter
+STARTUP_TARGET = 0.1
+
+base_dir = os.path.dirname(os.path.realpath(__file__))
+top_dir = os.path.abspath(os.path.join(base_dir, "..", "..", ".."))
+cinv_script = os.path.join(top_dir, "scripts", "cinv")
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.env = os.environ.copy()
+        self.env['HOME'] = self.temp_dir
+        self.env['PYTHONPATH'] = top_dir
+
+        # Measure with cached bytecode, as an installed cinv has it
+        self.env.pop('PYTHONDONTWRITEBYTECODE', None)
+        self.env['PYTHONPYCACHEPREFIX'] = os.path.join(self.temp_dir, "pycache")
+
+        self.run_cinv("host", "add", "startup.example.org", "-t", "vm")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_cinv(self, *args, python_args=[]):
+        return subprocess.run([sys.executable] + python_args + [cinv_script] +
+            list(args), env=self.env, check=True, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+
+    @staticmethod
+    def best_of(runs, function):
+        times = []
+        for i in range(runs):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def test_only_requested_area_imported(self):
+        """Running a host command does not import other areas"""
+        result = self.run_cinv("host", "cores-get", "startup.example.org",
+            python_args=["-X", "importtime"])
+        imports = result.stderr.decode()
+
+        self.assertIn("cinv.host", imports)
+        for module in ("cinv.netipv4", "cinv.batch", "subprocess", "sqlite3"):
+            self.assertNotIn(" %s\n" % module, imports)
+
+    @unittest.skipUnless(os.environ.get("CINV_TEST_TIMING"),
+        "timing depends on the machine, set CINV_TEST_TIMING=1 to run")
+    def test_startup_time(self):
+        """host cores-get stays within the startup target"""
+        interpreter = self.best_of(5, lambda: subprocess.run(
+            [sys.executable, "-c", "pass"], check=True))
+        cinv = self.best_of(5, lambda: self.run_cinv("host", "cores-get",
+            "startup.example.org"))
+
+        self.assertLess(cinv - interpreter, STARTUP_TARGET)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# 2011 Nico Schottelius (nico-cinv at schottelius.org)
+#
+# This file is part of cinv.
+#
+# cinv is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cinv is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cinv. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import cinv.fsproperty
+import cinv.storage
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+class LogStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.home = os.environ.get('HOME')
+        self.home_dir = tempfile.mkdtemp()
+        os.environ['HOME'] = self.home_dir
+        self.area = os.path.join(self.temp_dir, "area")
+        cinv.storage.set_storage(cinv.storage.LogStorage(self.temp_dir))
+
+    def tearDown(self):
+        cinv.storage.set_storage(None)
+        os.environ['HOME'] = self.home
+        shutil.rmtree(self.home_dir)
+        shutil.rmtree(self.temp_dir)
+
+    def reopen(self):
+        """Forget all state, as a new process would"""
+        cinv.storage.set_storage(cinv.storage.LogStorage(self.temp_dir))
+
+    def test_properties(self):
+        """Dicts, lists and bitmaps are stored in the log of their area"""
+        cinv.fsproperty.makedirs(self.area)
+        d = cinv.fsproperty.DirectoryDict(os.path.join(self.area, "dict"))
+        d["a"] = "1"
+        d["b"] = "2"
+        del d["a"]
+
+        l = cinv.fsproperty.FileList(os.path.join(self.area, "list"))
+        l.extend(["x", "y", "z"])
+        self.assertEqual(l.pop(), "z")
+
+        bitmap = cinv.fsproperty.FileBitmap(os.path.join(self.area, "bitmap"))
+        bitmap.set(9)
+
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ["area.log"])
+
+        self.reopen()
+        self.assertEqual(dict(d), { "b": "2" })
+        self.assertEqual(list(l), ["x", "y"])
+        self.assertEqual(bitmap.first_clear(9, 16), 10)
+
+        cinv.fsproperty.rmtree(os.path.join(self.area, "dict"))
+        self.assertEqual(sorted(cinv.fsproperty.listdir(self.area)),
+            ["bitmap", "list"])
+
+    def test_in_place_changes(self):
+        """In place changes append only the changed bytes to the log"""
+        cinv.fsproperty.makedirs(self.area)
+        log_path = os.path.join(self.temp_dir, "area.log")
+
+        bitmap = cinv.fsproperty.FileBitmap(os.path.join(self.area, "bitmap"))
+        bitmap.set(1 << 20)
+        size = os.path.getsize(log_path)
+        bitmap.set(5)
+        self.assertLess(os.path.getsize(log_path) - size, 100)
+
+        l = cinv.fsproperty.FileList(os.path.join(self.area, "list"))
+        for i in range(200):
+            l.append(str(i))
+        self.assertEqual(l.pop(), "199")
+
+        area, rel = cinv.storage.get_storage().locate(l.path)
+        self.assertLessEqual(len(area.files[rel][0]),
+            cinv.storage.SEGMENTS_MAX)
+        area.write_index()
+        bitmap.set(6)
+
+        self.reopen()
+        self.assertEqual(list(l), [str(i) for i in range(199)])
+        self.assertEqual(bitmap.first_clear(5, 8), 7)
+        self.assertTrue(bitmap.get(1 << 20))
+
+    def test_import_and_compact(self):
+        """Existing directory trees are imported, compaction keeps the state"""
+        os.makedirs(os.path.join(self.area, "host"))
+        with open(os.path.join(self.area, "host", "cores"), "w") as fd:
+            fd.write("4\n")
+
+        path = os.path.join(self.area, "host", "memory")
+        for size in range(100):
+            cinv.fsproperty.write_file(path, "%dG\n" % size)
+
+        size = os.path.getsize(os.path.join(self.temp_dir, "area.log"))
+        cinv.storage.get_storage().compact()
+        self.assertLess(os.path.getsize(os.path.join(self.temp_dir, "area.log")),
+            size / 10)
+
+        self.reopen()
+        self.assertEqual(cinv.fsproperty.read_file(path), "99G")
+        self.assertEqual(cinv.fsproperty.read_file(os.path.join(self.area,
+            "host", "cores")), "4")
+
+class OverlayStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.home = os.environ.get('HOME')
+        self.home_dir = tempfile.mkdtemp()
+        os.environ['HOME'] = self.home_dir
+        self.hosts = os.path.join(self.temp_dir, "host")
+        for fqdn in ["a", "b"]:
+            os.makedirs(os.path.join(self.hosts, fqdn))
+            with open(os.path.join(self.hosts, fqdn, "cores"), "w") as fd:
+                fd.write("2\n")
+
+    def tearDown(self):
+        cinv.storage.set_storage(None)
+        os.environ['HOME'] = self.home
+        shutil.rmtree(self.home_dir)
+        shutil.rmtree(self.temp_dir)
+
+    def test_memory(self):
+        """Memory storage never touches the disk"""
+        cinv.storage.set_storage(cinv.storage.MemoryStorage())
+
+        path = os.path.join(self.temp_dir, "memory", "list")
+        l = cinv.fsproperty.FileList(path)
+        l.extend(["x", "y"])
+        self.assertEqual(l.pop(), "y")
+        self.assertEqual(list(cinv.fsproperty.FileList(path)), ["x"])
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+    def test_discard_and_apply(self):
+        """Changes are visible in the overlay only until applied"""
+        with cinv.storage.overlay() as overlay:
+            cinv.fsproperty.rmtree(os.path.join(self.hosts, "a"))
+            cinv.fsproperty.makedirs(os.path.join(self.hosts, "c"))
+            cinv.fsproperty.write_file(os.path.join(self.hosts, "b", "cores"),
+                "4")
+
+            self.assertEqual(sorted(cinv.fsproperty.listdir(self.hosts)),
+                ["b", "c"])
+            self.assertEqual(cinv.fsproperty.read_file(
+                os.path.join(self.hosts, "b", "cores")), "4")
+            self.assertEqual(sorted(os.listdir(self.hosts)), ["a", "b"])
+
+            overlay.discard()
+            self.assertEqual(sorted(cinv.fsproperty.listdir(self.hosts)),
+                ["a", "b"])
+
+            cinv.fsproperty.rmtree(os.path.join(self.hosts, "a"))
+            cinv.fsproperty.makedirs(os.path.join(self.hosts, "a", "nic"))
+            self.assertEqual(cinv.fsproperty.listdir(
+                os.path.join(self.hosts, "a")), ["nic"])
+            overlay.apply()
+
+        self.assertEqual(os.listdir(os.path.join(self.hosts, "a")), ["nic"])
+        self.assertNotIsInstance(cinv.storage.get_storage(),
+            cinv.storage.OverlayStorage)
+
+
+class DirectoryStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.storage = cinv.storage.DirectoryStorage()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_commit_fsync(self):
+        """Synced commits write and remove all files, leave no temp files"""
+        a = os.path.join(self.temp_dir, "a")
+        b = os.path.join(self.temp_dir, "b")
+        with open(b, "w") as fd:
+            fd.write("old\n")
+
+        self.storage.commit([(a, b"new\n"), (b, None)], True)
+
+        self.assertEqual(os.listdir(self.temp_dir), ["a"])
+        with open(a) as fd:
+            self.assertEqual(fd.read(), "new\n")